@@ -0,0 +1,35 @@
+import argparse
+from pathlib import Path
+
+from utils.config_manager import Config
+from preprocessing.datasets import TextMelDurDataset, ForwardPreprocessor
+from utils.tflite_conversion import convert_forward_model, TFLiteForwardTransformer, mel_error
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--config', dest='config', type=str, required=True)
+parser.add_argument('--checkpoint', type=str, default=None,
+                    help='Explicit path to model weights. Defaults to the latest checkpoint of the config.')
+parser.add_argument('--quantization', type=str, default=None, choices=['int8', 'float16'],
+                    help='Dynamic range int8 or float16 weight quantization. Defaults to float32.')
+parser.add_argument('--output', type=str, required=True, help='Path of the .tflite file.')
+parser.add_argument('--skip_validation', action='store_true',
+                    help='Do not report the mel error on a validation batch.')
+args = parser.parse_args()
+
+config_loader = Config(config_path=args.config, model_kind='forward')
+model = config_loader.load_model(checkpoint_path=args.checkpoint)
+tflite_content = convert_forward_model(model, quantization=args.quantization)
+Path(args.output).write_bytes(tflite_content)
+print(f'Wrote {len(tflite_content) / 1e6:.1f}MB TFLite model to {args.output}.')
+
+if not args.skip_validation:
+    data_prep = ForwardPreprocessor.from_config(config=config_loader, tokenizer=model.text_pipeline.tokenizer)
+    valid_data_handler = TextMelDurDataset.from_config(config_loader, preprocessor=data_prep, kind='valid')
+    valid_dataset = valid_data_handler.get_dataset(bucket_batch_sizes=config_loader.config['bucket_batch_sizes'],
+                                                   bucket_boundaries=config_loader.config['bucket_boundaries'],
+                                                   shuffle=False)
+    mel, phonemes, durations, fname = valid_dataset.next_batch()
+    tflite_model = TFLiteForwardTransformer(model_content=tflite_content)
+    errors = mel_error(model, tflite_model, phonemes.numpy())
+    print(f"Mean absolute error against the float model on {len(phonemes)} validation samples: "
+          f"mel {errors['mel']:.5f}, duration {errors['duration']:.5f}")
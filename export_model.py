@@ -0,0 +1,40 @@
+import argparse
+
+import tensorflow as tf
+
+from utils.config_manager import Config
+from utils.export import export_saved_model, load_saved_model
+from utils.inference_optimization import optimize_and_verify
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--config', dest='config', type=str, required=True)
+parser.add_argument('--model_kind', type=str, default='forward', choices=['autoregressive', 'forward'])
+parser.add_argument('--checkpoint', type=str, default=None,
+                    help='Explicit path to model weights. Defaults to the latest checkpoint of the config.')
+parser.add_argument('--export_dir', type=str, required=True)
+parser.add_argument('--weights_only', action='store_true',
+                    help='Write an inference checkpoint without optimizer, for Config.load_inference_model.')
+parser.add_argument('--optimize', action='store_true',
+                    help='Fold the batch normalizations before exporting (not with --weights_only).')
+args = parser.parse_args()
+
+config_loader = Config(config_path=args.config, model_kind=args.model_kind)
+model = config_loader.load_model(checkpoint_path=args.checkpoint)
+if args.weights_only:
+    weights_path = config_loader.save_inference_weights(model, f'{args.export_dir}/inference_weights')
+    print(f'Exported {args.model_kind} model weights to {weights_path}.')
+else:
+    if args.optimize:
+        sequence = tf.constant([list(range(1, len(model.text_pipeline.tokenizer.alphabet) + 1))[:20]])
+        if args.model_kind == 'forward':
+            inputs = sequence
+        else:
+            inputs = (sequence, tf.tile(model.start_vec[tf.newaxis], [1, 4 * model.r, 1]))
+        # the autoregressive model relies on the prenet dropout at inference
+        report = optimize_and_verify(model, inputs, prenet_dropout=args.model_kind == 'autoregressive')
+        print(f"Optimized model: max abs error {report['max_abs_error']:.2e}, "
+              f"forward {report['time_before'] * 1000:.1f}ms -> {report['time_after'] * 1000:.1f}ms.")
+    export_saved_model(model, args.export_dir)
+    # loading and warming up checks that the export is complete
+    load_saved_model(args.export_dir, warm_up=True)
+    print(f'Exported {args.model_kind} model to {args.export_dir}.')
@@ -0,0 +1,70 @@
+from collections import OrderedDict
+
+import numpy as np
+import tensorflow as tf
+
+
+class EncoderCache:
+    """ Bounded LRU cache of encoder outputs, keyed by token sequence.
+    
+    Entries are evicted (least recently used first) once either max_entries or max_bytes is exceeded.
+    The key also contains the number of dropped heads and a weights version (the training step), so that
+    outputs computed with different model settings or weights are never mixed up. Weights changed other than
+    by training (loaded, set or pruned) clear the cache instead.
+    """
+    
+    def __init__(self, max_entries: int = None, max_bytes: int = None):
+        assert (max_entries is not None) or (max_bytes is not None), 'Set either max_entries or max_bytes.'
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    @staticmethod
+    def make_key(tokens, drop_n_heads: int, weights_version: int):
+        return tuple(np.array(tokens).flatten().tolist()), int(drop_n_heads), int(weights_version)
+    
+    @staticmethod
+    def _size(value):
+        return sum(int(tf.size(t)) * t.dtype.size for t in tf.nest.flatten(value))
+    
+    def get(self, key):
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+        self.misses += 1
+        return None
+    
+    def put(self, key, value):
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key)[1]
+        size = self._size(value)
+        self.entries[key] = (value, size)
+        self.nbytes += size
+        self._evict()
+    
+    def get_or_compute(self, key, compute_fn):
+        value = self.get(key)
+        if value is None:
+            value = compute_fn()
+            self.put(key, value)
+        return value
+    
+    def _evict(self):
+        while len(self.entries) > 0:
+            too_many = (self.max_entries is not None) and (len(self.entries) > self.max_entries)
+            too_large = (self.max_bytes is not None) and (self.nbytes > self.max_bytes)
+            if not (too_many or too_large):
+                break
+            _, (_, size) = self.entries.popitem(last=False)
+            self.nbytes -= size
+    
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
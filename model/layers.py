@@ -30,20 +30,104 @@ class CNNResNorm(tf.keras.layers.Layer):
             self.normalization = [tf.keras.layers.BatchNormalization() for _ in range(n_layers + 1)]
         else:
             assert False is True, f'normalization must be either "layer" or "batch", not {normalization}.'
+        self.folded_normalization = None
     
-    def call_convs(self, x, training):
+    def _normalize(self, i, x, training):
+        if self.folded_normalization is None:
+            return self.normalization[i](x, training=training)
+        if self.folded_normalization[i] is None:
+            return x
+        scale, offset = self.folded_normalization[i]
+        return x * scale + offset
+    
+    def fold_normalization(self):
+        """ Replaces the batch normalizations with their inference affine transformation (precomputed scale and
+        offset), merging it into the weights of the last convolution if the last activation is linear.
+        Modifies the weights: the layer can only be used for inference afterwards.
+        """
+        assert all(isinstance(norm, tf.keras.layers.BatchNormalization) for norm in self.normalization), \
+            'only batch normalization can be folded.'
+        folded = []
+        for norm in self.normalization:
+            scale = tf.math.rsqrt(norm.moving_variance + norm.epsilon)
+            if norm.scale:
+                scale *= norm.gamma
+            offset = -norm.moving_mean * scale
+            if norm.center:
+                offset += norm.beta
+            folded.append((scale, offset))
+        if self.last_activation.activation is tf.keras.activations.linear:
+            scale, offset = folded[-2]
+            self.last_conv.kernel.assign(self.last_conv.kernel * scale)
+            self.last_conv.bias.assign(self.last_conv.bias * scale + offset)
+            folded[-2] = None
+        # computed from the (float32) variables, applied in the compute dtype, float16 under mixed precision
+        self.folded_normalization = [None if transform is None else
+                                     tuple(tf.constant(tf.cast(t, self.compute_dtype)) for t in transform)
+                                     for transform in folded]
+    
+    @staticmethod
+    def _mask(x, keep):
+        return x if keep is None else x * tf.cast(keep, x.dtype)
+    
+    def call_convs(self, x, training, keep=None):
         for i in range(0, len(self.convolutions)):
-            x = self.convolutions[i](x)
+            x = self.convolutions[i](self._mask(x, keep))
             x = self.inner_activations[i](x)
-            x = self.normalization[i](x, training=training)
+            x = self._normalize(i, x, training=training)
         return x
     
-    def call(self, inputs, training):
-        x = self.call_convs(inputs, training=training)
-        x = self.last_conv(x)
+    def call(self, inputs, training, padding_mask=None):
+        """ padding_mask (batch_size, 1, 1, seq_len), 1 at the padded positions, zeroes them before each
+        convolution, so that the padding of a batch does not change the outputs at the other positions.
+        """
+        keep = None if padding_mask is None else 1. - padding_mask[:, 0, 0, :, tf.newaxis]
+        x = self.call_convs(inputs, training=training, keep=keep)
+        x = self.last_conv(self._mask(x, keep))
         x = self.last_activation(x)
-        x = self.normalization[-2](x, training=training)
-        return self.normalization[-1](inputs + x, training=training)
+        x = self._normalize(-2, x, training=training)
+        return self._normalize(-1, inputs + x, training=training)
+    
+    def init_cache(self, batch_size, input_dim: int):
+        """ Zero-filled receptive field buffers of each (causal) convolution, for incremental calls to step. """
+        buffers = []
+        for conv in self.convolutions + [self.last_conv]:
+            buffers.append(tf.zeros((batch_size, conv.kernel_size[0] - 1, input_dim), dtype=self.compute_dtype))
+            input_dim = conv.filters
+        return buffers
+    
+    def cache_signature(self, input_dim: int):
+        signature = []
+        for conv in self.convolutions + [self.last_conv]:
+            signature.append(tf.TensorSpec(shape=(None, conv.kernel_size[0] - 1, input_dim), dtype=self.compute_dtype))
+            input_dim = conv.filters
+        return signature
+    
+    @staticmethod
+    def _conv_step(conv, x, buffer):
+        assert conv.padding == 'causal', f'incremental convolution requires causal padding, not {conv.padding}.'
+        new_len = tf.shape(x)[1]
+        x = tf.concat([buffer, x], axis=1)
+        new_buffer = x[:, new_len:, :]
+        new_buffer.set_shape(buffer.shape)
+        return conv(x)[:, -new_len:, :], new_buffer
+    
+    def step(self, inputs, cache):
+        """ Inference on the newest positions only, given the buffers returned by init_cache or a previous step.
+        Equivalent to the last positions of call(all_inputs, training=False) for causal padding.
+        """
+        buffers = []
+        x = inputs
+        for i in range(0, len(self.convolutions)):
+            x, buffer = self._conv_step(self.convolutions[i], x, cache[i])
+            buffers.append(buffer)
+            x = self.inner_activations[i](x)
+            x = self._normalize(i, x, training=False)
+        x, buffer = self._conv_step(self.last_conv, x, cache[-1])
+        buffers.append(buffer)
+        x = self.last_activation(x)
+        x = self._normalize(-2, x, training=False)
+        return self._normalize(-1, inputs + x, training=False), buffers
 
 
 class FFNResNorm(tf.keras.layers.Layer):
@@ -76,24 +160,20 @@ class HeadDrop(tf.keras.layers.Layer):
     def __init__(self, **kwargs):
         super(HeadDrop, self).__init__(**kwargs)
     
-    def call(self, batch, training: bool, drop_n_heads: int):
-        if not training or (drop_n_heads == 0):
+    def call(self, batch, training: bool, drop_n_heads):
+        """ drop_n_heads can be a tensor (or variable), so that changing it does not retrace. """
+        if not training:
             return batch
         if len(tf.shape(batch)) != 4:
             raise Exception('attention values must be 4 dimensional')
         batch_size = tf.shape(batch)[0]
         head_n = tf.shape(batch)[1]
-        if head_n == 1:
-            return batch
-        # assert drop_n_heads < head_n, 'drop_n_heads must less than number of heads'
-        keep_head_batch = tf.TensorArray(tf.float32, size=batch_size)
-        keep_mask = tf.concat([tf.ones(head_n - drop_n_heads), tf.zeros(drop_n_heads)], axis=0)
-        for i in range(batch_size):
-            t = tf.random.shuffle(keep_mask)
-            keep_head_batch = keep_head_batch.write(i, t)
-        keep_head_batch = keep_head_batch.stack()
-        keep_head_batch = keep_head_batch[:, :, tf.newaxis, tf.newaxis]
-        return batch * keep_head_batch * tf.cast(head_n / (head_n - drop_n_heads), tf.float32)
+        # at least one head is kept
+        drop_n_heads = tf.minimum(tf.cast(drop_n_heads, tf.int32), head_n - 1)
+        # the heads with the drop_n_heads lowest random ranks of each sample are dropped
+        ranks = tf.argsort(tf.argsort(tf.random.uniform((batch_size, head_n)), axis=-1), axis=-1)
+        keep_head_batch = tf.cast(ranks >= drop_n_heads, batch.dtype)[:, :, tf.newaxis, tf.newaxis]
+        return batch * keep_head_batch * tf.cast(head_n / (head_n - drop_n_heads), batch.dtype)
 
 
 class MultiHeadAttention(tf.keras.layers.Layer):
@@ -113,6 +193,31 @@ class MultiHeadAttention(tf.keras.layers.Layer):
         self.wv = tf.keras.layers.Dense(model_dim)
         
         self.dense = tf.keras.layers.Dense(model_dim)
+        # list collecting the attention weights of (eager) calls, see utils.head_pruning
+        self.attention_recorder = None
+    
+    def prune_heads(self, heads: list):
+        """ Removes the given heads by shrinking the projections, keeping the weights of the other heads
+        if the layer is built.
+        """
+        keep = [head for head in range(self.num_heads) if head not in heads]
+        assert len(keep) > 0, 'at least one head must be kept.'
+        columns = tf.concat([tf.range(head * self.depth, (head + 1) * self.depth) for head in keep], axis=0)
+        projections, dense = [self.wq, self.wk, self.wv], self.dense
+        self.wq, self.wk, self.wv = [tf.keras.layers.Dense(len(keep) * self.depth) for _ in range(3)]
+        self.dense = tf.keras.layers.Dense(self.model_dim)
+        if dense.built:
+            for old, new in zip(projections, [self.wq, self.wk, self.wv]):
+                new.build((None, old.kernel.shape[0]))
+                new.kernel.assign(tf.gather(old.kernel, columns, axis=1))
+                new.bias.assign(tf.gather(old.bias, columns))
+            # the output projection takes the queries concatenated with the heads
+            query_dim = dense.kernel.shape[0] - self.num_heads * self.depth
+            rows = tf.concat([tf.range(query_dim), query_dim + columns], axis=0)
+            self.dense.build((None, query_dim + len(keep) * self.depth))
+            self.dense.kernel.assign(tf.gather(dense.kernel, rows))
+            self.dense.bias.assign(dense.bias)
+        self.num_heads = len(keep)
     
     def split_heads(self, x, batch_size: int):
         """ Split the last dimension into (num_heads, depth).
@@ -122,24 +227,37 @@ class MultiHeadAttention(tf.keras.layers.Layer):
         x = tf.reshape(x, (batch_size, -1, self.num_heads, self.depth))
         return tf.transpose(x, perm=[0, 2, 1, 3])
     
+    def project_key_value(self, v, k):
+        """ Projects keys and values and splits them into heads.
+        Used to compute keys and values once and reuse them across decoding steps.
+        """
+        batch_size = tf.shape(k)[0]
+        k = self.wk(k)  # (batch_size, seq_len, model_dim)
+        v = self.wv(v)  # (batch_size, seq_len, model_dim)
+        k = self.split_heads(k, batch_size)  # (batch_size, num_heads, seq_len_k, depth)
+        v = self.split_heads(v, batch_size)  # (batch_size, num_heads, seq_len_v, depth)
+        return k, v
+    
     def call(self, v, k, q_in, mask, training, drop_n_heads):
+        k, v = self.project_key_value(v, k)
+        return self.attend(q_in, k, v, mask, training=training, drop_n_heads=drop_n_heads)
+    
+    def attend(self, q_in, k, v, mask, training, drop_n_heads):
+        """ Attention of the queries q_in over keys and values already projected by project_key_value. """
         batch_size = tf.shape(q_in)[0]
         
         q = self.wq(q_in)  # (batch_size, seq_len, model_dim)
-        k = self.wk(k)  # (batch_size, seq_len, model_dim)
-        v = self.wv(v)  # (batch_size, seq_len, model_dim)
-        
         q = self.split_heads(q, batch_size)  # (batch_size, num_heads, seq_len_q, depth)
-        k = self.split_heads(k, batch_size)  # (batch_size, num_heads, seq_len_k, depth)
-        v = self.split_heads(v, batch_size)  # (batch_size, num_heads, seq_len_v, depth)
         
         scaled_attention, attention_weights = scaled_dot_product_attention(q, k, v, mask)
+        if self.attention_recorder is not None:
+            self.attention_recorder.append(attention_weights)
         scaled_attention = self.head_drop(scaled_attention, training=training, drop_n_heads=drop_n_heads)
         
         scaled_attention = tf.transpose(scaled_attention,
                                         perm=[0, 2, 1, 3])  # (batch_size, seq_len_q, num_heads, depth)
-        concat_attention = tf.reshape(scaled_attention,
-                                      (batch_size, -1, self.model_dim))  # (batch_size, seq_len_q, model_dim)
+        # (batch_size, seq_len_q, num_heads * depth), i.e. model_dim unless heads were pruned
+        concat_attention = tf.reshape(scaled_attention, (batch_size, -1, self.num_heads * self.depth))
         concat_query = tf.concat([q_in, concat_attention], axis=-1)
         output = self.dense(concat_query)  # (batch_size, seq_len_q, model_dim)
         
@@ -165,6 +283,26 @@ class SelfAttentionResNorm(tf.keras.layers.Layer):
         attn_out = self.ln(attn_out)  # (batch_size, input_seq_len, model_dim)
         out = self.dropout(attn_out, training=training)
         return self.last_ln(out + x), attn_weights
+    
+    def init_cache(self, batch_size):
+        empty = tf.zeros((batch_size, self.mha.num_heads, 0, self.mha.depth), dtype=self.compute_dtype)
+        return {'key': empty, 'value': empty}
+    
+    def cache_signature(self):
+        spec = tf.TensorSpec(shape=(None, self.mha.num_heads, None, self.mha.depth), dtype=self.compute_dtype)
+        return {'key': spec, 'value': spec}
+    
+    def step(self, x, cache, mask):
+        """ Inference on the newest positions x, attending also over the cached keys and values
+        of the previous positions. Returns the updated cache.
+        """
+        k, v = self.mha.project_key_value(x, x)
+        cache = {'key': tf.concat([cache['key'], k], axis=-2),
+                 'value': tf.concat([cache['value'], v], axis=-2)}
+        attn_out, attn_weights = self.mha.attend(x, cache['key'], cache['value'], mask, training=False,
+                                                 drop_n_heads=0)
+        attn_out = self.ln(attn_out)
+        return self.last_ln(attn_out + x), attn_weights, cache
 
 
 class SelfAttentionDenseBlock(tf.keras.layers.Layer):
@@ -207,7 +345,7 @@ class SelfAttentionConvBlock(tf.keras.layers.Layer):
     
     def call(self, x, training, mask, drop_n_heads):
         attn_out, attn_weights = self.sarn(x, mask=mask, training=training, drop_n_heads=drop_n_heads)
-        conv = self.conv(attn_out)
+        conv = self.conv(attn_out, padding_mask=mask)
         return conv, attn_weights
 
 
@@ -240,8 +378,9 @@ class SelfAttentionBlocks(tf.keras.layers.Layer):
     
     def call(self, inputs, training, padding_mask, drop_n_heads, reduction_factor=1):
         seq_len = tf.shape(inputs)[1]
-        x = inputs * tf.math.sqrt(tf.cast(self.model_dim, tf.float32))
-        x += self.pos_encoding_scalar * self.pos_encoding[:, :seq_len * reduction_factor:reduction_factor, :]
+        x = inputs * tf.math.sqrt(tf.cast(self.model_dim, inputs.dtype))
+        x += tf.cast(self.pos_encoding_scalar * self.pos_encoding[:, :seq_len * reduction_factor:reduction_factor, :],
+                     x.dtype)
         x = self.dropout(x, training=training)
         attention_weights = {}
         for i, block in enumerate(self.encoder_SADB):
@@ -271,6 +410,20 @@ class CrossAttentionResnorm(tf.keras.layers.Layer):
         attn_values = self.dropout(attn_values, training=training)
         out = self.layernorm(attn_values + q)
         return out, attn_weights
+    
+    def init_cache(self, enc_output):
+        k, v = self.mha.project_key_value(enc_output, enc_output)
+        return {'key': k, 'value': v}
+    
+    def cache_signature(self):
+        spec = tf.TensorSpec(shape=(None, self.mha.num_heads, None, self.mha.depth), dtype=self.compute_dtype)
+        return {'key': spec, 'value': spec}
+    
+    def step(self, q, cache, mask):
+        attn_values, attn_weights = self.mha.attend(q, cache['key'], cache['value'], mask, training=False,
+                                                    drop_n_heads=0)
+        out = self.layernorm(attn_values + q)
+        return out, attn_weights
 
 
 class CrossAttentionDenseBlock(tf.keras.layers.Layer):
@@ -293,6 +446,23 @@ class CrossAttentionDenseBlock(tf.keras.layers.Layer):
                                                mask=padding_mask, training=training, drop_n_heads=drop_n_heads)
         ffn_out = self.ffn(attn2, training=training)
         return ffn_out, attn_weights_block1, attn_weights_block2
+    
+    def init_cache(self, enc_output):
+        return {'self_attention': self.sarn.init_cache(tf.shape(enc_output)[0]),
+                'cross_attention': self.carn.init_cache(enc_output)}
+    
+    def cache_signature(self):
+        return {'self_attention': self.sarn.cache_signature(),
+                'cross_attention': self.carn.cache_signature()}
+    
+    def step(self, x, cache, look_ahead_mask, padding_mask):
+        attn1, attn_weights_block1, self_attention_cache = self.sarn.step(x, cache['self_attention'],
+                                                                          mask=look_ahead_mask)
+        attn2, attn_weights_block2 = self.carn.step(attn1, cache['cross_attention'], mask=padding_mask)
+        ffn_out = self.ffn(attn2, training=False)
+        cache = {'self_attention': self_attention_cache,
+                 'cross_attention': cache['cross_attention']}
+        return ffn_out, attn_weights_block1, attn_weights_block2, cache
 
 
 class CrossAttentionConvBlock(tf.keras.layers.Layer):
@@ -325,6 +495,27 @@ class CrossAttentionConvBlock(tf.keras.layers.Layer):
                                                mask=padding_mask, training=training, drop_n_heads=drop_n_heads)
         ffn_out = self.conv(attn2, training=training)
         return ffn_out, attn_weights_block1, attn_weights_block2
+    
+    def init_cache(self, enc_output):
+        batch_size = tf.shape(enc_output)[0]
+        return {'self_attention': self.sarn.init_cache(batch_size),
+                'cross_attention': self.carn.init_cache(enc_output),
+                'conv': self.conv.init_cache(batch_size, input_dim=self.sarn.mha.model_dim)}
+    
+    def cache_signature(self):
+        return {'self_attention': self.sarn.cache_signature(),
+                'cross_attention': self.carn.cache_signature(),
+                'conv': self.conv.cache_signature(input_dim=self.sarn.mha.model_dim)}
+    
+    def step(self, x, cache, look_ahead_mask, padding_mask):
+        attn1, attn_weights_block1, self_attention_cache = self.sarn.step(x, cache['self_attention'],
+                                                                          mask=look_ahead_mask)
+        attn2, attn_weights_block2 = self.carn.step(attn1, cache['cross_attention'], mask=padding_mask)
+        ffn_out, conv_cache = self.conv.step(attn2, cache['conv'])
+        cache = {'self_attention': self_attention_cache,
+                 'cross_attention': cache['cross_attention'],
+                 'conv': conv_cache}
+        return ffn_out, attn_weights_block1, attn_weights_block2, cache
 
 
 class CrossAttentionBlocks(tf.keras.layers.Layer):
@@ -359,8 +550,9 @@ class CrossAttentionBlocks(tf.keras.layers.Layer):
     def call(self, inputs, enc_output, training, decoder_padding_mask, encoder_padding_mask, drop_n_heads,
              reduction_factor=1):
         seq_len = tf.shape(inputs)[1]
-        x = inputs * tf.math.sqrt(tf.cast(self.model_dim, tf.float32))
-        x += self.pos_encoding_scalar * self.pos_encoding[:, :seq_len * reduction_factor:reduction_factor, :]
+        x = inputs * tf.math.sqrt(tf.cast(self.model_dim, inputs.dtype))
+        x += tf.cast(self.pos_encoding_scalar * self.pos_encoding[:, :seq_len * reduction_factor:reduction_factor, :],
+                     x.dtype)
         x = self.dropout(x, training=training)
         attention_weights = {}
         for i, block in enumerate(self.CADB):
@@ -373,6 +565,43 @@ class CrossAttentionBlocks(tf.keras.layers.Layer):
             attention_weights[f'{self.name}_ConvBlock{i + 1}_CrossAttention'] = attn_weights
         
         return x, attention_weights
+    
+    def init_cache(self, enc_output):
+        """ Per-block cache for incremental decoding with step: projected encoder keys and values,
+        (empty) self-attention keys and values and causal convolution buffers.
+        """
+        return [block.init_cache(enc_output) for block in self.CADB + self.CACB]
+    
+    def cache_signature(self):
+        return [block.cache_signature() for block in self.CADB + self.CACB]
+    
+    def step(self, inputs, cache, decoder_padding_mask, encoder_padding_mask, reduction_factor=1):
+        """ Incremental inference on the newest decoder inputs.
+        
+        decoder_padding_mask must cover the cached positions and the new ones, i.e. have shape
+        (batch_size, 1, new_seq_len, cached_seq_len + new_seq_len); its last dimension gives the position offset
+        of the new inputs.
+        Returns the output and cross-attention weights of the new positions only and the updated cache.
+        """
+        seq_len = tf.shape(inputs)[1]
+        start = tf.shape(decoder_padding_mask)[-1] - seq_len
+        x = inputs * tf.math.sqrt(tf.cast(self.model_dim, inputs.dtype))
+        x += tf.cast(self.pos_encoding_scalar * self.pos_encoding[:,
+                                                          start * reduction_factor:(start + seq_len) * reduction_factor:
+                                                          reduction_factor, :], x.dtype)
+        attention_weights = {}
+        new_cache = []
+        for i, block in enumerate(self.CADB):
+            x, _, attn_weights, block_cache = block.step(x, cache[i], decoder_padding_mask, encoder_padding_mask)
+            attention_weights[f'{self.name}_DenseBlock{i + 1}_CrossAttention'] = attn_weights
+            new_cache.append(block_cache)
+        for i, block in enumerate(self.CACB):
+            x, _, attn_weights, block_cache = block.step(x, cache[len(self.CADB) + i], decoder_padding_mask,
+                                                         encoder_padding_mask)
+            attention_weights[f'{self.name}_ConvBlock{i + 1}_CrossAttention'] = attn_weights
+            new_cache.append(block_cache)
+        
+        return x, attention_weights, new_cache
 
 
 class DecoderPrenet(tf.keras.layers.Layer):
@@ -389,15 +618,18 @@ class DecoderPrenet(tf.keras.layers.Layer):
         self.rate = tf.Variable(dropout_rate, trainable=False)
         self.dropout_1 = tf.keras.layers.Dropout(self.rate)
         self.dropout_2 = tf.keras.layers.Dropout(self.rate)
+        # use dropout also in inference for positional encoding relevance
+        self.inference_dropout = True
     
-    def call(self, x):
-        self.dropout_1.rate = self.rate
-        self.dropout_2.rate = self.rate
+    def call(self, x, training=False):
+        # the rate of tf.nn.dropout must have the dtype of its inputs
+        self.dropout_1.rate = tf.cast(self.rate, self.compute_dtype)
+        self.dropout_2.rate = tf.cast(self.rate, self.compute_dtype)
+        training = training or self.inference_dropout
         x = self.d1(x)
-        # use dropout also in inference for positional encoding relevance
-        x = self.dropout_1(x, training=True)
+        x = self.dropout_1(x, training=training)
         x = self.d2(x)
-        x = self.dropout_2(x, training=True)
+        x = self.dropout_2(x, training=training)
         return x
 
 
@@ -424,11 +656,28 @@ class Postnet(tf.keras.layers.Layer):
     def call(self, x, training):
         stop = self.stop_linear(x)
         conv_out = self.conv_blocks(x, training=training)
+        # the outputs (and the losses on them) are float32 also under mixed precision
         return {
-            'mel_linear': x,
-            'final_output': conv_out,
-            'stop_prob': stop,
+            'mel_linear': tf.cast(x, tf.float32),
+            'final_output': tf.cast(conv_out, tf.float32),
+            'stop_prob': tf.cast(stop, tf.float32),
         }
+    
+    def init_cache(self, batch_size):
+        return self.conv_blocks.init_cache(batch_size, input_dim=self.mel_channels)
+    
+    def cache_signature(self):
+        return self.conv_blocks.cache_signature(input_dim=self.mel_channels)
+    
+    def step(self, x, cache):
+        """ Inference on the newest frames x only, keeping the receptive field of the causal convolutions in cache. """
+        stop = self.stop_linear(x)
+        conv_out, cache = self.conv_blocks.step(x, cache)
+        return {
+            'mel_linear': tf.cast(x, tf.float32),
+            'final_output': tf.cast(conv_out, tf.float32),
+            'stop_prob': tf.cast(stop, tf.float32),
+        }, cache
 
 
 class DurationPredictor(tf.keras.layers.Layer):
@@ -452,8 +701,8 @@ class DurationPredictor(tf.keras.layers.Layer):
         self.linear = tf.keras.layers.Dense(1, activation=dense_activation,
                                             bias_initializer=tf.keras.initializers.Constant(value=1))
     
-    def call(self, x, training):
-        x = self.conv_blocks(x, training=training)
+    def call(self, x, training, padding_mask=None):
+        x = self.conv_blocks(x, training=training, padding_mask=padding_mask)
         x = self.linear(x)
         return x
 
@@ -480,20 +729,22 @@ class Expand(tf.keras.layers.Layer):
         super(Expand, self).__init__(**kwargs)
         self.model_dimension = model_dim
     
-    def call(self, x, dimensions):
+    def call(self, x, dimensions, max_length=None):
+        """ With max_length, the output has exactly max_length time steps (truncated or zero-padded), which
+        compiles with XLA, since the output shape does not depend on the values of dimensions.
+        """
         dimensions = tf.squeeze(dimensions, axis=-1)
         dimensions = tf.cast(tf.math.round(dimensions), tf.int32)
-        seq_len = tf.shape(x)[1]
-        batch_size = tf.shape(x)[0]
-        # build masks from dimensions
-        max_dim = tf.math.reduce_max(dimensions)
-        tot_dim = tf.math.reduce_sum(dimensions)
-        index_masks = tf.RaggedTensor.from_row_lengths(tf.ones(tot_dim), tf.reshape(dimensions, [-1])).to_tensor()
-        index_masks = tf.cast(tf.reshape(index_masks, (batch_size, seq_len * max_dim)), tf.float32)
-        non_zeros = seq_len * max_dim - tf.reduce_sum(max_dim - dimensions, axis=1)
-        # stack and mask
-        tiled = tf.tile(x, [1, 1, max_dim])
-        reshaped = tf.reshape(tiled, (batch_size, seq_len * max_dim, self.model_dimension))
-        mask_reshape = tf.multiply(reshaped, index_masks[:, :, tf.newaxis])
-        ragged = tf.RaggedTensor.from_row_lengths(mask_reshape[index_masks > 0], non_zeros)
+        if max_length is not None:
+            # each output frame takes the time step whose cumulative end is the first beyond it
+            ends = tf.cumsum(dimensions, axis=1)  # (batch_size, seq_len)
+            frames = tf.range(max_length)[tf.newaxis, :, tf.newaxis]  # (1, max_length, 1)
+            indices = tf.reduce_sum(tf.cast(ends[:, tf.newaxis, :] <= frames, tf.int32), axis=-1)
+            frame_mask = tf.cast(frames[..., 0] < ends[:, -1:], x.dtype)[..., tf.newaxis]
+            indices = tf.minimum(indices, tf.shape(x)[1] - 1)
+            return tf.gather(x, indices, batch_dims=1) * frame_mask
+        # repeat each (flattened) time step, allocating only the output frames
+        flat_x = tf.reshape(x, (-1, self.model_dimension))
+        frames = tf.repeat(flat_x, tf.reshape(dimensions, [-1]), axis=0)
+        ragged = tf.RaggedTensor.from_row_lengths(frames, tf.reduce_sum(dimensions, axis=1))
         return ragged.to_tensor()
@@ -1,14 +1,97 @@
 import sys
 
+import numpy as np
 import tensorflow as tf
 
-from model.transformer_utils import create_encoder_padding_mask, create_mel_padding_mask, create_look_ahead_mask
+from model.transformer_utils import create_encoder_padding_mask, create_mel_padding_mask, create_look_ahead_mask, \
+    create_attention_window_mask
 from utils.losses import weighted_sum_losses, masked_mean_absolute_error, new_scaled_crossentropy
 from preprocessing.text import Pipeline
+from model.encoder_cache import EncoderCache
 from model.layers import DecoderPrenet, Postnet, DurationPredictor, Expand, SelfAttentionBlocks, CrossAttentionBlocks, \
     CNNResNorm
 
 
+def _gradients(optimizer, loss, tape, variables):
+    """ The gradients of loss, scaling the loss against float16 underflow for a LossScaleOptimizer.
+    
+    Within a distribution strategy, loss is the mean over the batch of one replica and the optimizer sums the
+    gradients of all replicas, so the loss is divided by their number.
+    """
+    with tape:
+        loss = loss / tf.distribute.get_strategy().num_replicas_in_sync
+    if isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+        with tape:
+            loss = optimizer.get_scaled_loss(loss)
+        return optimizer.get_unscaled_gradients(tape.gradient(loss, variables))
+    return tape.gradient(loss, variables)
+
+
+def _apply_gradients(optimizer, loss, tape, variables, accumulator=None, frames=None):
+    """ Applies the gradients of loss, averaged with the gradients in accumulator if given. """
+    gradients = _gradients(optimizer, loss, tape, variables)
+    if accumulator is not None:
+        gradients = accumulator.mean(gradients, variables, frames)
+    optimizer.apply_gradients(zip(gradients, variables))
+
+
+def _frames(mel):
+    return tf.cast(tf.shape(mel)[0] * tf.shape(mel)[1], tf.float32)
+
+
+class GradientAccumulator:
+    """ Sums the gradients of micro-batches weighted by their (padded) target frames, for a train step to apply
+    their weighted mean with its own gradients: the losses are means over the frames, so this is one step on
+    all the micro-batches.
+    
+    The sums are not model variables, thus neither checkpointed nor exported. Within a distribution strategy
+    every replica sums its own gradients, those of the replicas are summed by the optimizer.
+    """
+    
+    def __init__(self):
+        self.gradients = None
+        self.frames = None
+    
+    def _build(self, variables):
+        # in the first trace of the step functions, since the models create their variables on the first call
+        if self.gradients is None:
+            self.gradients = [self._variable(variable.shape) for variable in variables]
+            self.frames = self._variable(())
+    
+    @staticmethod
+    def _variable(shape):
+        return tf.Variable(lambda: tf.zeros(shape), trainable=False,
+                           synchronization=tf.VariableSynchronization.ON_READ,
+                           aggregation=tf.VariableAggregation.SUM)
+    
+    @staticmethod
+    def _weighted(gradients, variables, frames):
+        # variables without gradient (e.g. the unused layers of a model) contribute zeros
+        return [tf.zeros(variable.shape) if gradient is None else tf.convert_to_tensor(gradient) * frames
+                for gradient, variable in zip(gradients, variables)]
+    
+    def accumulate(self, gradients, variables, frames):
+        self._build(variables)
+        for accumulated, gradient in zip(self.gradients, self._weighted(gradients, variables, frames)):
+            accumulated.assign_add(gradient)
+        self.frames.assign_add(frames)
+    
+    def mean(self, gradients, variables, frames):
+        """ The weighted mean of the accumulated gradients and gradients, after which the sums are reset. """
+        self._build(variables)
+        total_frames = self.frames + frames
+        mean = [(accumulated + gradient) / total_frames
+                for accumulated, gradient in zip(self.gradients, self._weighted(gradients, variables, frames))]
+        self.reset()
+        return mean
+    
+    def reset(self):
+        if self.gradients is not None:
+            for accumulated in self.gradients:
+                accumulated.assign(tf.zeros(accumulated.shape))
+            self.frames.assign(0.)
+
+
 class AutoregressiveTransformer(tf.keras.models.Model):
     
     def __init__(self,
@@ -40,6 +123,8 @@ class AutoregressiveTransformer(tf.keras.models.Model):
                  decoder_prenet_dropout=0.5,
                  max_r: int = 10,
                  debug=False,
+                 jit_compile=False,
+                 gradient_accumulation=False,
                  **kwargs):
         super(AutoregressiveTransformer, self).__init__(**kwargs)
         self.start_vec = tf.ones((1, mel_channels), dtype=tf.float32) * mel_start_value
@@ -48,7 +133,10 @@ class AutoregressiveTransformer(tf.keras.models.Model):
         self.max_r = max_r
         self.r = max_r
         self.mel_channels = mel_channels
-        self.drop_n_heads = 0
+        # a variable, so that the head drop schedule does not retrace the step functions
+        self.drop_n_heads = tf.Variable(0, trainable=False)
+        self.attention_window = None
+        self.encoder_cache = None
         self.text_pipeline = Pipeline.default_pipeline(phoneme_language,
                                                        add_start_end=True,
                                                        with_stress=with_stress)
@@ -104,25 +192,98 @@ class AutoregressiveTransformer(tf.keras.models.Model):
             tf.TensorSpec(shape=(None, None, mel_channels), dtype=tf.float32),
             tf.TensorSpec(shape=(None, None, None, None), dtype=tf.float32),
         ]
+        self.generate_signature = [
+            tf.TensorSpec(shape=(None,), dtype=tf.int32),
+            tf.TensorSpec(shape=(), dtype=tf.int32),
+        ]
+        self.generate_batch_signature = [
+            tf.TensorSpec(shape=(None, None), dtype=tf.int32),
+            tf.TensorSpec(shape=(), dtype=tf.int32),
+        ]
         self.debug = debug
+        # XLA compiles the training steps once per input shape, i.e. once per bucket with static bucket shapes
+        self.jit_compile = jit_compile
+        # accumulate_step sums gradients, for train_step to apply them with its own
+        self.gradient_accumulation = gradient_accumulation
+        self.gradient_accumulator = GradientAccumulator() if gradient_accumulation else None
         self._apply_all_signatures()
     
     @property
     def step(self):
-        return int(self.optimizer.iterations)
+        return int(self.optimizer.iterations.numpy())
     
-    def _apply_signature(self, function, signature):
+    def _decoder_step_signature(self):
+        # built on demand: keras wraps nested dicts stored as attributes, which tf.function does not accept
+        return [
+            tf.TensorSpec(shape=(None, None, self.mel_channels), dtype=tf.float32),
+            tf.TensorSpec(shape=(None, None, None, None), dtype=tf.float32),
+            {'decoder': self.decoder.cache_signature(),
+             'padding_mask': tf.TensorSpec(shape=(None, 1, 1, None), dtype=tf.float32),
+             'postnet': self.decoder_postnet.cache_signature(),
+             'attention_peak': tf.TensorSpec(shape=(None,), dtype=tf.int32)}
+        ]
+    
+    def _apply_signature(self, function, signature, jit_compile=False):
         if self.debug:
             return function
         else:
-            return tf.function(input_signature=signature)(function)
+            return tf.function(input_signature=signature, jit_compile=jit_compile)(function)
     
     def _apply_all_signatures(self):
-        self.forward = self._apply_signature(self._forward, self.forward_input_signature)
-        self.train_step = self._apply_signature(self._train_step, self.training_input_signature)
-        self.val_step = self._apply_signature(self._val_step, self.training_input_signature)
-        self.forward_encoder = self._apply_signature(self._forward_encoder, self.encoder_signature)
-        self.forward_decoder = self._apply_signature(self._forward_decoder, self.decoder_signature)
+        """ Wraps the step functions in new tf.functions, discarding the traces of every reduction factor
+        and attention window. Needed when the layers change, not when switching between those constants.
+        """
+        self._traced_functions = {}
+        self._select_traced_functions()
+    
+    def _select_traced_functions(self):
+        """ Sets the step functions of the current reduction factor and attention window, which are python
+        constants of the traced graphs. The functions of each value are kept, so that schedule transitions
+        retrace each function at most once per value, or not at all after trace_reduction_factors.
+        """
+        # string keys: keras tracks the dictionary
+        key = f'r{self.r}_window{self.attention_window}'
+        if key not in self._traced_functions:
+            self._traced_functions[key] = {
+                'forward': self._apply_signature(self._forward, self.forward_input_signature),
+                'train_step': self._apply_signature(self._train_step, self.training_input_signature,
+                                                    jit_compile=self.jit_compile),
+                'accumulate_step': self._apply_signature(self._accumulate_step, self.training_input_signature,
+                                                         jit_compile=self.jit_compile),
+                'val_step': self._apply_signature(self._val_step, self.training_input_signature,
+                                                  jit_compile=self.jit_compile),
+                'forward_encoder': self._apply_signature(self._forward_encoder, self.encoder_signature),
+                'forward_decoder': self._apply_signature(self._forward_decoder, self.decoder_signature),
+                'forward_decoder_step': self._apply_signature(self._forward_decoder_step,
+                                                              self._decoder_step_signature()),
+                'generate': self._apply_signature(self._generate, self.generate_signature),
+                'generate_batch': self._apply_signature(self._generate_batch, self.generate_batch_signature)}
+        functions = self._traced_functions[key]
+        self.forward = functions['forward']
+        self.train_step = functions['train_step']
+        self.accumulate_step = functions['accumulate_step']
+        self.val_step = functions['val_step']
+        self.forward_encoder = functions['forward_encoder']
+        self.forward_decoder = functions['forward_decoder']
+        self.forward_decoder_step = functions['forward_decoder_step']
+        self.generate = functions['generate']
+        self.generate_batch = functions['generate_batch']
+    
+    def trace_reduction_factors(self, reduction_factors: list):
+        """ Traces the step functions of all the reduction factors (e.g. of the schedule) up front, so that
+        schedule transitions only select already traced functions. The input signatures leave the batch and
+        sequence dimensions free, so each function is traced once per reduction factor, without inputs.
+        """
+        if self.debug:
+            return
+        r = self.r
+        for reduction_factor in sorted(set(reduction_factors)):
+            self.set_constants(reduction_factor=reduction_factor)
+            for name, function in self._traced_functions[f'r{self.r}_window{self.attention_window}'].items():
+                # accumulate_step needs the accumulator of gradient_accumulation
+                if (name != 'accumulate_step') or self.gradient_accumulation:
+                    function.get_concrete_function()
+        self.set_constants(reduction_factor=r)
     
     def _call_encoder(self, inputs, training):
         padding_mask = create_encoder_padding_mask(inputs)
@@ -131,13 +292,13 @@ class AutoregressiveTransformer(tf.keras.models.Model):
                                                 training=training,
                                                 padding_mask=padding_mask,
                                                 drop_n_heads=self.drop_n_heads)
-        return enc_output, padding_mask, attn_weights
+        return tf.cast(enc_output, tf.float32), padding_mask, attn_weights
     
     def _call_decoder(self, encoder_output, targets, encoder_padding_mask, training):
         dec_target_padding_mask = create_mel_padding_mask(targets)
         look_ahead_mask = create_look_ahead_mask(tf.shape(targets)[1])
         combined_mask = tf.maximum(dec_target_padding_mask, look_ahead_mask)
-        dec_input = self.decoder_prenet(targets)
+        dec_input = self.decoder_prenet(targets, training=training)
         dec_output, attention_weights = self.decoder(inputs=dec_input,
                                                      enc_output=encoder_output,
                                                      training=training,
@@ -151,7 +312,52 @@ class AutoregressiveTransformer(tf.keras.models.Model):
         mel = tf.reshape(out_proj, (b, t * self.r, self.mel_channels))
         model_output = self.decoder_postnet(mel, training=training)
         model_output.update(
-            {'decoder_attention': attention_weights, 'decoder_output': dec_output, 'linear': mel})
+            {'decoder_attention': attention_weights, 'decoder_output': tf.cast(dec_output, tf.float32),
+             'linear': tf.cast(mel, tf.float32)})
+        return model_output
+    
+    def _init_decoder_cache(self, encoder_output):
+        batch_size = tf.shape(encoder_output)[0]
+        return {'decoder': self.decoder.init_cache(encoder_output),
+                'padding_mask': tf.zeros((batch_size, 1, 1, 0)),
+                'postnet': self.decoder_postnet.init_cache(batch_size),
+                'attention_peak': tf.zeros((batch_size,), dtype=tf.int32)}
+    
+    def _call_decoder_step(self, targets, encoder_padding_mask, cache):
+        """ Decodes only the newest targets, reusing the keys and values of the previous decoding steps.
+        Same outputs as the last positions of _call_decoder(training=False), but for the decoder attention,
+        which only contains the rows of the new positions. Returns the updated cache under 'cache'.
+        
+        If attention_window is set, the cross-attention is restricted to the encoder positions within
+        attention_window of the previous attention peak (last decoder layer, averaged over heads). The peak
+        can only move forward.
+        """
+        new_len = tf.shape(targets)[1]
+        if self.attention_window is not None:
+            encoder_padding_mask = tf.maximum(encoder_padding_mask,
+                                              create_attention_window_mask(cache['attention_peak'],
+                                                                           size=tf.shape(encoder_padding_mask)[-1],
+                                                                           window=self.attention_window))
+        dec_target_padding_mask = tf.concat([cache['padding_mask'], create_mel_padding_mask(targets)], axis=-1)
+        look_ahead_mask = create_look_ahead_mask(tf.shape(dec_target_padding_mask)[-1])[-new_len:, :]
+        combined_mask = tf.maximum(dec_target_padding_mask, look_ahead_mask)
+        dec_input = self.decoder_prenet(targets)
+        dec_output, attention_weights, decoder_cache = self.decoder.step(inputs=dec_input,
+                                                                         cache=cache['decoder'],
+                                                                         decoder_padding_mask=combined_mask,
+                                                                         encoder_padding_mask=encoder_padding_mask,
+                                                                         reduction_factor=self.r)
+        out_proj = self.final_proj_mel(dec_output)[:, :, :self.r * self.mel_channels]
+        b = tf.shape(out_proj)[0]
+        mel = tf.reshape(out_proj, (b, new_len * self.r, self.mel_channels))
+        model_output, postnet_cache = self.decoder_postnet.step(mel, cache['postnet'])
+        last_attention = tf.reduce_mean(list(attention_weights.values())[-1][:, :, -1, :], axis=1)
+        attention_peak = tf.maximum(cache['attention_peak'], tf.argmax(last_attention, axis=-1, output_type=tf.int32))
+        model_output.update(
+            {'decoder_attention': attention_weights, 'decoder_output': tf.cast(dec_output, tf.float32),
+             'linear': tf.cast(mel, tf.float32),
+             'cache': {'decoder': decoder_cache, 'padding_mask': dec_target_padding_mask, 'postnet': postnet_cache,
+                       'attention_peak': attention_peak}})
         return model_output
     
     def _forward(self, inp, output):
@@ -166,6 +372,74 @@ class AutoregressiveTransformer(tf.keras.models.Model):
     def _forward_decoder(self, encoder_output, targets, encoder_padding_mask):
         return self._call_decoder(encoder_output, targets, encoder_padding_mask, training=False)
     
+    def _forward_decoder_step(self, targets, encoder_padding_mask, cache):
+        return self._call_decoder_step(targets, encoder_padding_mask, cache)
+    
+    def _decode(self, encoder_output, encoder_padding_mask, max_length):
+        """ Batched autoregressive decoding loop, entirely in graph.
+        
+        Each sample is finished at the step its stop token fires; decoding ends when all samples are finished.
+        Returns the mels (zeroed after each sample's stop step), the number of frames of each sample
+        and the decoder attention weights.
+        """
+        batch_size = tf.shape(encoder_output)[0]
+        max_steps = max_length // self.r + 1
+        cache_shapes = tf.nest.map_structure(lambda spec: spec.shape, self._decoder_step_signature()[2])
+        
+        def write_step(i, model_out, mel, attention, finished, mel_lengths):
+            mel = mel.write(i, model_out['final_output'])
+            attention = {k: attention[k].write(i, model_out['decoder_attention'][k][:, :, 0, :]) for k in attention}
+            mel_lengths = tf.where(finished, mel_lengths, (i + 1) * self.r)
+            stop = tf.argmax(model_out['stop_prob'][:, -1], axis=-1, output_type=tf.int32) == self.stop_prob_index
+            return mel, attention, tf.logical_or(finished, stop), mel_lengths
+        
+        def not_finished(i, output, cache, finished, mel_lengths, mel, attention):
+            return tf.logical_and(i < max_steps, tf.logical_not(tf.reduce_all(finished)))
+        
+        def decode_step(i, output, cache, finished, mel_lengths, mel, attention):
+            model_out = self._call_decoder_step(output, encoder_padding_mask, cache)
+            mel, attention, finished, mel_lengths = write_step(i, model_out, mel, attention, finished, mel_lengths)
+            return i + 1, model_out['final_output'][:, -1:, :], model_out['cache'], finished, mel_lengths, mel, attention
+        
+        start_vec = tf.tile(tf.expand_dims(self.start_vec, 0), [batch_size, 1, 1])
+        model_out = self._call_decoder_step(start_vec, encoder_padding_mask, self._init_decoder_cache(encoder_output))
+        mel = tf.TensorArray(tf.float32, size=0, dynamic_size=True)
+        attention = {k: tf.TensorArray(tf.float32, size=0, dynamic_size=True) for k in model_out['decoder_attention']}
+        mel, attention, finished, mel_lengths = write_step(0, model_out, mel, attention,
+                                                           finished=tf.zeros(batch_size, dtype=tf.bool),
+                                                           mel_lengths=tf.zeros(batch_size, dtype=tf.int32))
+        _, _, _, _, mel_lengths, mel, attention = tf.while_loop(
+            not_finished,
+            decode_step,
+            loop_vars=(tf.constant(1), model_out['final_output'][:, -1:, :], model_out['cache'], finished, mel_lengths,
+                       mel, attention),
+            shape_invariants=(tf.TensorShape([]), tf.TensorShape([None, None, self.mel_channels]), cache_shapes,
+                              tf.TensorShape([None]), tf.TensorShape([None]), tf.TensorShape(None),
+                              {k: tf.TensorShape(None) for k in attention}))
+        mel = tf.transpose(mel.stack(), perm=[1, 0, 2, 3])  # (batch_size, steps, r, mel_channels)
+        mel = tf.reshape(mel, (batch_size, -1, self.mel_channels))
+        mel = mel * tf.sequence_mask(mel_lengths, tf.shape(mel)[1], dtype=tf.float32)[:, :, tf.newaxis]
+        decoder_attention = {k: tf.transpose(attention[k].stack(), perm=[1, 2, 0, 3]) for k in attention}
+        return mel, mel_lengths, decoder_attention
+    
+    def _generate(self, inp, max_length):
+        """ Autoregressive prediction of a single encoded sentence, with the decoding loop,
+        stop token check and output accumulation all in one graph. Same outputs as predict.
+        """
+        encoder_output, padding_mask, encoder_attention = self._call_encoder(tf.expand_dims(inp, 0), training=False)
+        mel, _, decoder_attention = self._decode(encoder_output, padding_mask, max_length)
+        return {'mel': mel[0],
+                'decoder_attention': decoder_attention,
+                'encoder_attention': encoder_attention}
+    
+    def _generate_batch(self, inp, max_length):
+        encoder_output, padding_mask, encoder_attention = self._call_encoder(inp, training=False)
+        mel, mel_lengths, decoder_attention = self._decode(encoder_output, padding_mask, max_length)
+        return {'mel': mel,
+                'mel_lengths': mel_lengths,
+                'decoder_attention': decoder_attention,
+                'encoder_attention': encoder_attention}
+    
     def _gta_forward(self, inp, tar, stop_prob, training):
         tar_inp = tar[:, :-1]
         tar_real = tar[:, 1:]
@@ -193,8 +467,14 @@ class AutoregressiveTransformer(tf.keras.models.Model):
     
     def _train_step(self, inp, tar, stop_prob):
         model_out, tape = self._gta_forward(inp, tar, stop_prob, training=True)
-        gradients = tape.gradient(model_out['loss'], self.trainable_variables)
-        self.optimizer.apply_gradients(zip(gradients, self.trainable_variables))
+        _apply_gradients(self.optimizer, model_out['loss'], tape, self.trainable_variables,
+                         accumulator=self.gradient_accumulator, frames=_frames(tar[:, 1:]))
+        return model_out
+    
+    def _accumulate_step(self, inp, tar, stop_prob):
+        model_out, tape = self._gta_forward(inp, tar, stop_prob, training=True)
+        gradients = _gradients(self.optimizer, model_out['loss'], tape, self.trainable_variables)
+        self.gradient_accumulator.accumulate(gradients, self.trainable_variables, _frames(tar[:, 1:]))
         return model_out
     
     def _val_step(self, inp, tar, stop_prob):
@@ -213,13 +493,20 @@ class AutoregressiveTransformer(tf.keras.models.Model):
         if self.r == r:
             return
         self.r = r
-        self._apply_all_signatures()
+        self._select_traced_functions()
     
     def _set_heads(self, heads):
-        if self.drop_n_heads == heads:
+        self.drop_n_heads.assign(heads)
+    
+    def set_attention_window(self, attention_window: int = None):
+        """ Restricts the cross-attention of incremental decoding (predict, which then always uses the cache,
+        generate, predict_batch) to the encoder positions within attention_window of the previous attention peak.
+        None disables it.
+        """
+        if self.attention_window == attention_window:
             return
-        self.drop_n_heads = heads
-        self._apply_all_signatures()
+        self.attention_window = attention_window
+        self._select_traced_functions()
     
     def call(self, inputs, targets, training):
         encoder_output, padding_mask, encoder_attention = self._call_encoder(inputs, training)
@@ -227,22 +514,40 @@ class AutoregressiveTransformer(tf.keras.models.Model):
         model_out.update({'encoder_attention': encoder_attention})
         return model_out
     
-    def predict(self, inp, max_length=1000, encode=True, verbose=True):
+    def predict(self, inp, max_length=1000, encode=True, verbose=True, use_cache=False):
+        """ Autoregressive prediction of a single sentence.
+        
+        :param use_cache: decode incrementally, caching the decoder keys and values instead of recomputing the
+            whole output at each step. Equivalent to the full recompute when the decoder prenet dropout is zero,
+            otherwise the dropout of past frames is not resampled at every step. Always on with an attention
+            window (set_attention_window), which only the incremental decoding applies.
+        """
+        use_cache = use_cache or (self.attention_window is not None)
         if encode:
             inp = self.encode_text(inp)
         inp = tf.cast(tf.expand_dims(inp, 0), tf.int32)
         output = tf.cast(tf.expand_dims(self.start_vec, 0), tf.float32)
         output_concat = tf.cast(tf.expand_dims(self.start_vec, 0), tf.float32)
         out_dict = {}
-        encoder_output, padding_mask, encoder_attention = self.forward_encoder(inp)
+        encoder_output, padding_mask, encoder_attention = self._cached_forward_encoder(inp)
+        if use_cache:
+            cache = self._init_decoder_cache(encoder_output)
+            decoder_attention = {}
         for i in range(int(max_length // self.r) + 1):
-            model_out = self.forward_decoder(encoder_output, output, padding_mask)
+            if use_cache:
+                model_out = self.forward_decoder_step(output[:, -1:, :], padding_mask, cache)
+                cache = model_out['cache']
+                decoder_attention = {k: tf.concat([decoder_attention[k], v], axis=-2) if k in decoder_attention else v
+                                     for k, v in model_out['decoder_attention'].items()}
+            else:
+                model_out = self.forward_decoder(encoder_output, output, padding_mask)
+                decoder_attention = model_out['decoder_attention']
             output = tf.concat([output, model_out['final_output'][:1, -1:, :]], axis=-2)
             output_concat = tf.concat([tf.cast(output_concat, tf.float32), model_out['final_output'][:1, -self.r:, :]],
                                       axis=-2)
             stop_pred = model_out['stop_prob'][:, -1]
             out_dict = {'mel': output_concat[0, 1:, :],
-                        'decoder_attention': model_out['decoder_attention'],
+                        'decoder_attention': decoder_attention,
                         'encoder_attention': encoder_attention}
             if verbose:
                 sys.stdout.write(f'\rpred text mel: {i} stop out: {float(stop_pred[0, 2])}')
@@ -252,6 +557,94 @@ class AutoregressiveTransformer(tf.keras.models.Model):
                 break
         return out_dict
     
+    def predict_stream(self, inp, max_length=1000, encode=True, steps_per_chunk=1):
+        """ Autoregressive prediction of a single sentence, yielding the mel as soon as it is decoded.
+        
+        :param steps_per_chunk: number of decoding steps (of r frames each) per yielded chunk.
+        :return: generator of mel chunks of shape (frames, mel_channels), which concatenated are
+            the mel returned by predict with use_cache.
+        
+        E.g. for a chunked vocoder:
+            for mel_chunk in model.predict_stream(text, steps_per_chunk=4):
+                wav_chunk = audio.reconstruct_waveform(mel_chunk.numpy().T)
+        """
+        if encode:
+            inp = self.encode_text(inp)
+        inp = tf.cast(tf.expand_dims(inp, 0), tf.int32)
+        output = tf.cast(tf.expand_dims(self.start_vec, 0), tf.float32)
+        encoder_output, padding_mask, _ = self._cached_forward_encoder(inp)
+        cache = self._init_decoder_cache(encoder_output)
+        chunk = []
+        for i in range(int(max_length // self.r) + 1):
+            model_out = self.forward_decoder_step(output, padding_mask, cache)
+            cache = model_out['cache']
+            output = model_out['final_output'][:, -1:, :]
+            chunk.append(model_out['final_output'][0])
+            stop = int(tf.argmax(model_out['stop_prob'][0, -1], axis=-1)) == self.stop_prob_index
+            if stop or (len(chunk) == steps_per_chunk):
+                yield tf.concat(chunk, axis=0)
+                chunk = []
+            if stop:
+                return
+        if len(chunk) > 0:
+            yield tf.concat(chunk, axis=0)
+    
+    def predict_batch(self, inputs: list, max_length=1000, encode=True):
+        """ Autoregressive prediction of several sentences of different lengths in a single decoding loop.
+        
+        :param inputs: list of sentences, or of encoded phoneme sequences if encode is False.
+        :return: list with one output per sentence, as returned by predict, with the mel trimmed at the
+            sentence's stop step.
+        """
+        if encode:
+            inputs = self.encode_text(inputs)
+        inputs = [tf.cast(inp, tf.int32) for inp in inputs]
+        inp = tf.RaggedTensor.from_row_lengths(tf.concat(inputs, axis=0),
+                                               [tf.shape(inp)[0] for inp in inputs]).to_tensor()
+        model_out = self.generate_batch(inp, max_length)
+        outputs = []
+        for i, mel_len in enumerate(model_out['mel_lengths'].numpy()):
+            outputs.append(
+                {'mel': model_out['mel'][i, :mel_len],
+                 'decoder_attention': {k: v[i:i + 1, :, :mel_len // self.r, :]
+                                       for k, v in model_out['decoder_attention'].items()},
+                 'encoder_attention': {k: v[i:i + 1] for k, v in model_out['encoder_attention'].items()}})
+        return outputs
+    
+    def set_encoder_cache(self, max_entries: int = None, max_bytes: int = None):
+        """ Caches the encoder outputs of single sentence predictions in a LRU cache bounded by max_entries
+        and/or max_bytes. Disabled if neither is set. """
+        if (max_entries is None) and (max_bytes is None):
+            self.encoder_cache = None
+        else:
+            self.encoder_cache = EncoderCache(max_entries=max_entries, max_bytes=max_bytes)
+    
+    def _weights_version(self):
+        if getattr(self, 'optimizer', None) is None:
+            return 0
+        return self.step
+    
+    def reset_encoder_cache(self):
+        """ Drops the cached encoder outputs. Needed whenever the weights change other than by an optimizer step
+        (which is part of the cache key), e.g. after restoring a checkpoint. """
+        if self.encoder_cache is not None:
+            self.encoder_cache.clear()
+    
+    def load_weights(self, *args, **kwargs):
+        status = super(AutoregressiveTransformer, self).load_weights(*args, **kwargs)
+        self.reset_encoder_cache()
+        return status
+    
+    def set_weights(self, weights):
+        super(AutoregressiveTransformer, self).set_weights(weights)
+        self.reset_encoder_cache()
+    
+    def _cached_forward_encoder(self, inp):
+        if self.encoder_cache is None:
+            return self.forward_encoder(inp)
+        key = self.encoder_cache.make_key(inp, self.drop_n_heads, self._weights_version())
+        return self.encoder_cache.get_or_compute(key, lambda: self.forward_encoder(inp))
+    
     def set_constants(self, decoder_prenet_dropout: float = None, learning_rate: float = None,
                       reduction_factor: float = None, drop_n_heads: int = None):
         if decoder_prenet_dropout is not None:
@@ -291,13 +684,17 @@ class ForwardTransformer(tf.keras.models.Model):
                  encoder_feed_forward_dimension: int = None,
                  decoder_feed_forward_dimension: int = None,
                  debug=False,
+                 jit_compile=False,
+                 gradient_accumulation=False,
                  decoder_prenet_dropout=0.,
                  **kwargs):
         super(ForwardTransformer, self).__init__(**kwargs)
         self.text_pipeline = Pipeline.default_pipeline(phoneme_language,
                                                        add_start_end=False,
                                                        with_stress=with_stress)
-        self.drop_n_heads = 0
+        # a variable, so that the head drop schedule does not retrace the step functions
+        self.drop_n_heads = tf.Variable(0, trainable=False)
+        self.encoder_cache = None
         self.mel_channels = mel_channels
         self.encoder_prenet = tf.keras.layers.Embedding(self.text_pipeline.tokenizer.vocab_size,
                                                         encoder_model_dimension,
@@ -353,31 +750,68 @@ class ForwardTransformer(tf.keras.models.Model):
             tf.TensorSpec(shape=(None, None), dtype=tf.int32),
             tf.TensorSpec(shape=(), dtype=tf.float32),
         ]
+        self.encoder_signature = [
+            tf.TensorSpec(shape=(None, None), dtype=tf.int32)
+        ]
+        self.decoder_signature = [
+            tf.TensorSpec(shape=(None, None, encoder_model_dimension), dtype=tf.float32),
+            tf.TensorSpec(shape=(None, 1, 1, None), dtype=tf.float32),
+            tf.TensorSpec(shape=(), dtype=tf.float32),
+        ]
+        self.expand_signature = [
+            tf.TensorSpec(shape=(None, None, encoder_model_dimension), dtype=tf.float32),
+            tf.TensorSpec(shape=(None, 1, 1, None), dtype=tf.float32),
+            tf.TensorSpec(shape=(), dtype=tf.float32),
+        ]
+        self.expanded_decoder_signature = [
+            tf.TensorSpec(shape=(None, None, encoder_model_dimension), dtype=tf.float32),
+        ]
+        self.multi_speed_decoder_signature = [
+            tf.TensorSpec(shape=(1, None, encoder_model_dimension), dtype=tf.float32),
+            tf.TensorSpec(shape=(1, 1, 1, None), dtype=tf.float32),
+            tf.TensorSpec(shape=(None,), dtype=tf.float32),
+        ]
         self.debug = debug
+        # XLA compiles the training steps once per input shape, i.e. once per bucket with static bucket shapes
+        self.jit_compile = jit_compile
+        # accumulate_step sums gradients, for train_step to apply them with its own
+        self.gradient_accumulation = gradient_accumulation
+        self.gradient_accumulator = GradientAccumulator() if gradient_accumulation else None
         self._apply_all_signatures()
     
-    def _apply_signature(self, function, signature):
+    def _apply_signature(self, function, signature, jit_compile=False):
         if self.debug:
             return function
         else:
-            return tf.function(input_signature=signature)(function)
+            return tf.function(input_signature=signature, jit_compile=jit_compile)(function)
     
     def _apply_all_signatures(self):
         self.forward = self._apply_signature(self._forward, self.forward_input_signature)
-        self.train_step = self._apply_signature(self._train_step, self.training_input_signature)
-        self.val_step = self._apply_signature(self._val_step, self.training_input_signature)
+        self.train_step = self._apply_signature(self._train_step, self.training_input_signature,
+                                                jit_compile=self.jit_compile)
+        self.accumulate_step = self._apply_signature(self._accumulate_step, self.training_input_signature,
+                                                     jit_compile=self.jit_compile)
+        self.val_step = self._apply_signature(self._val_step, self.training_input_signature,
+                                              jit_compile=self.jit_compile)
+        self.forward_encoder = self._apply_signature(self._forward_encoder, self.encoder_signature)
+        self.forward_decoder = self._apply_signature(self._forward_decoder, self.decoder_signature)
+        self.forward_multi_speed_decoder = self._apply_signature(self._forward_multi_speed_decoder,
+                                                                 self.multi_speed_decoder_signature)
+        self.forward_durations = self._apply_signature(self._forward_durations, self.forward_input_signature)
+        self.forward_expand = self._apply_signature(self._forward_expand, self.expand_signature)
+        self.forward_expanded_decoder = self._apply_signature(self._forward_expanded_decoder,
+                                                              self.expanded_decoder_signature)
     
     def _set_heads(self, heads):
-        if self.drop_n_heads == heads:
-            return
-        self.drop_n_heads = heads
-        self._apply_all_signatures()
+        self.drop_n_heads.assign(heads)
     
-    def _train_step(self, input_sequence, target_sequence, target_durations):
+    def _training_forward(self, input_sequence, target_sequence, target_durations):
         target_durations = tf.expand_dims(target_durations, -1)
         mel_len = int(tf.shape(target_sequence)[1])
+        # with XLA, expanded to the target length, a static shape
+        max_length = mel_len if self.jit_compile else None
         with tf.GradientTape() as tape:
-            model_out = self.__call__(input_sequence, target_durations, training=True)
+            model_out = self.__call__(input_sequence, target_durations, training=True, max_length=max_length)
             loss, loss_vals = weighted_sum_losses((target_sequence,
                                                    target_durations),
                                                   (model_out['mel'][:, :mel_len, :],
@@ -386,8 +820,18 @@ class ForwardTransformer(tf.keras.models.Model):
                                                   self.loss_weights)
         model_out.update({'loss': loss})
         model_out.update({'losses': {'mel': loss_vals[0], 'duration': loss_vals[1]}})
-        gradients = tape.gradient(model_out['loss'], self.trainable_variables)
-        self.optimizer.apply_gradients(zip(gradients, self.trainable_variables))
+        return model_out, tape
+    
+    def _train_step(self, input_sequence, target_sequence, target_durations):
+        model_out, tape = self._training_forward(input_sequence, target_sequence, target_durations)
+        _apply_gradients(self.optimizer, model_out['loss'], tape, self.trainable_variables,
+                         accumulator=self.gradient_accumulator, frames=_frames(target_sequence))
+        return model_out
+    
+    def _accumulate_step(self, input_sequence, target_sequence, target_durations):
+        model_out, tape = self._training_forward(input_sequence, target_sequence, target_durations)
+        gradients = _gradients(self.optimizer, model_out['loss'], tape, self.trainable_variables)
+        self.gradient_accumulator.accumulate(gradients, self.trainable_variables, _frames(target_sequence))
         return model_out
     
     def _compile(self, optimizer):
@@ -400,7 +844,8 @@ class ForwardTransformer(tf.keras.models.Model):
     def _val_step(self, input_sequence, target_sequence, target_durations):
         target_durations = tf.expand_dims(target_durations, -1)
         mel_len = int(tf.shape(target_sequence)[1])
-        model_out = self.__call__(input_sequence, target_durations, training=False)
+        max_length = mel_len if self.jit_compile else None
+        model_out = self.__call__(input_sequence, target_durations, training=False, max_length=max_length)
         loss, loss_vals = weighted_sum_losses((target_sequence,
                                                target_durations),
                                               (model_out['mel'][:, :mel_len, :],
@@ -414,34 +859,83 @@ class ForwardTransformer(tf.keras.models.Model):
     def _forward(self, input_sequence, durations_scalar):
         return self.__call__(input_sequence, target_durations=None, training=False, durations_scalar=durations_scalar)
     
+    def _forward_encoder(self, input_sequence):
+        return self._call_encoder(input_sequence, training=False)
+    
+    def _forward_decoder(self, encoder_output, padding_mask, durations_scalar):
+        return self._call_decoder(encoder_output, padding_mask, target_durations=None, training=False,
+                                  durations_scalar=durations_scalar)
+    
+    def _forward_durations(self, input_sequence, durations_scalar):
+        encoder_output, padding_mask, _ = self._call_encoder(input_sequence, training=False)
+        durations = self._call_duration_predictor(encoder_output, padding_mask, training=False,
+                                                  durations_scalar=durations_scalar)
+        durations = tf.cast(tf.math.round(tf.squeeze(durations, axis=-1)), tf.int32)
+        return {'duration': durations, 'mel_length': tf.reduce_sum(durations, axis=-1)}
+    
+    def _forward_expand(self, encoder_output, padding_mask, durations_scalar):
+        durations = self._call_duration_predictor(encoder_output, padding_mask, training=False,
+                                                  durations_scalar=durations_scalar)
+        return tf.cast(self.expand(encoder_output, durations), tf.float32), durations
+    
+    def _forward_expanded_decoder(self, expanded):
+        return self._call_expanded_decoder(expanded, training=False)
+    
+    def _forward_multi_speed_decoder(self, encoder_output, padding_mask, durations_scalars):
+        """ Predicts the durations of a single sentence once and decodes all the duration scalings as one batch. """
+        durations = self._call_duration_predictor(encoder_output, padding_mask, training=False)
+        n_speeds = tf.shape(durations_scalars)[0]
+        durations = tf.tile(durations, [n_speeds, 1, 1]) * durations_scalars[:, tf.newaxis, tf.newaxis]
+        mels = self.expand(tf.tile(encoder_output, [n_speeds, 1, 1]), durations)
+        model_out = self._call_expanded_decoder(mels, training=False)
+        model_out.update({'duration': durations})
+        return model_out
+    
     @property
     def step(self):
-        return int(self.optimizer.iterations)
+        return int(self.optimizer.iterations.numpy())
     
-    def call(self, x, target_durations, training, durations_scalar=1.):
+    def _call_encoder(self, x, training):
         padding_mask = create_encoder_padding_mask(x)
         x = self.encoder_prenet(x)
         x, encoder_attention = self.encoder(x, training=training, padding_mask=padding_mask,
                                             drop_n_heads=self.drop_n_heads)
-        durations = self.dur_pred(x, training=training) * durations_scalar
-        durations = (1. - tf.reshape(padding_mask, tf.shape(durations))) * durations
-        if target_durations is not None:
-            mels = self.expand(x, target_durations)
-        else:
-            mels = self.expand(x, durations)
+        return tf.cast(x, tf.float32), padding_mask, encoder_attention
+    
+    def _call_duration_predictor(self, x, padding_mask, training, durations_scalar=1.):
+        durations = self.dur_pred(x, training=training, padding_mask=padding_mask)
+        durations = tf.cast(durations, tf.float32) * durations_scalar
+        return (1. - tf.reshape(padding_mask, tf.shape(durations))) * durations
+    
+    def _call_expanded_decoder(self, mels, training):
         expanded_mask = create_mel_padding_mask(mels)
-        mels = self.decoder_prenet(mels)
+        mels = self.decoder_prenet(mels, training=training)
         mels, decoder_attention = self.decoder(mels, training=training, padding_mask=expanded_mask,
                                                drop_n_heads=self.drop_n_heads, reduction_factor=1)
         mels = self.out(mels)
-        mels = self.decoder_postnet(mels, training=training)
+        mels = tf.cast(self.decoder_postnet(mels, training=training, padding_mask=expanded_mask), tf.float32)
         model_out = {'mel': mels,
-                     'duration': durations,
                      'expanded_mask': expanded_mask,
-                     'encoder_attention': encoder_attention,
                      'decoder_attention': decoder_attention}
         return model_out
     
+    def _call_decoder(self, x, padding_mask, target_durations, training, durations_scalar=1., max_length=None):
+        durations = self._call_duration_predictor(x, padding_mask, training=training, durations_scalar=durations_scalar)
+        if target_durations is not None:
+            mels = self.expand(x, target_durations, max_length=max_length)
+        else:
+            mels = self.expand(x, durations)
+        model_out = self._call_expanded_decoder(mels, training=training)
+        model_out.update({'duration': durations})
+        return model_out
+    
+    def call(self, x, target_durations, training, durations_scalar=1., max_length=None):
+        x, padding_mask, encoder_attention = self._call_encoder(x, training=training)
+        model_out = self._call_decoder(x, padding_mask, target_durations=target_durations, training=training,
+                                       durations_scalar=durations_scalar, max_length=max_length)
+        model_out.update({'encoder_attention': encoder_attention})
+        return model_out
+    
     def set_constants(self, decoder_prenet_dropout: float = None, learning_rate: float = None,
                       drop_n_heads: int = None, **kwargs):
         if decoder_prenet_dropout is not None:
@@ -451,6 +945,40 @@ class ForwardTransformer(tf.keras.models.Model):
         if drop_n_heads is not None:
             self._set_heads(drop_n_heads)
     
+    def set_encoder_cache(self, max_entries: int = None, max_bytes: int = None):
+        """ Caches the encoder outputs of single sentence predictions in a LRU cache bounded by max_entries
+        and/or max_bytes. Disabled if neither is set. """
+        if (max_entries is None) and (max_bytes is None):
+            self.encoder_cache = None
+        else:
+            self.encoder_cache = EncoderCache(max_entries=max_entries, max_bytes=max_bytes)
+    
+    def _weights_version(self):
+        if getattr(self, 'optimizer', None) is None:
+            return 0
+        return self.step
+    
+    def reset_encoder_cache(self):
+        """ Drops the cached encoder outputs. Needed whenever the weights change other than by an optimizer step
+        (which is part of the cache key), e.g. after restoring a checkpoint. """
+        if self.encoder_cache is not None:
+            self.encoder_cache.clear()
+    
+    def load_weights(self, *args, **kwargs):
+        status = super(ForwardTransformer, self).load_weights(*args, **kwargs)
+        self.reset_encoder_cache()
+        return status
+    
+    def set_weights(self, weights):
+        super(ForwardTransformer, self).set_weights(weights)
+        self.reset_encoder_cache()
+    
+    def _cached_forward_encoder(self, inp):
+        if self.encoder_cache is None:
+            return self.forward_encoder(inp)
+        key = self.encoder_cache.make_key(inp, self.drop_n_heads, self._weights_version())
+        return self.encoder_cache.get_or_compute(key, lambda: self.forward_encoder(inp))
+    
     def encode_text(self, text):
         return self.text_pipeline(text)
     
@@ -459,6 +987,110 @@ class ForwardTransformer(tf.keras.models.Model):
             inp = self.encode_text(inp)
             inp = tf.cast(tf.expand_dims(inp, 0), tf.int32)
         duration_scalar = tf.cast(1. / speed_regulator, tf.float32)
-        out = self.forward(inp, durations_scalar=duration_scalar)
+        if self.encoder_cache is None:
+            out = self.forward(inp, durations_scalar=duration_scalar)
+        else:
+            encoder_output, padding_mask, encoder_attention = self._cached_forward_encoder(inp)
+            out = self.forward_decoder(encoder_output, padding_mask, duration_scalar)
+            out.update({'encoder_attention': encoder_attention})
         out['mel'] = tf.squeeze(out['mel'])
         return out
+    
+    def predict_speeds(self, inp, speed_regulators: list, encode=True):
+        """ Predicts a single sentence at several speeds, running encoder and duration predictor only once.
+        
+        :return: list of mels of shape (frames, mel_channels), one per speed regulator.
+        """
+        if encode:
+            inp = self.encode_text(inp)
+            inp = tf.cast(tf.expand_dims(inp, 0), tf.int32)
+        duration_scalars = tf.cast(1. / tf.constant(speed_regulators, dtype=tf.float32), tf.float32)
+        encoder_output, padding_mask, _ = self._cached_forward_encoder(inp)
+        out = self.forward_multi_speed_decoder(encoder_output, padding_mask, duration_scalars)
+        mel_lengths = tf.reduce_sum(1. - out['expanded_mask'][:, 0, 0, :], axis=-1)
+        return [out['mel'][i, :int(mel_lengths[i])] for i in range(len(speed_regulators))]
+    
+    def predict_long(self, inp, window=1000, overlap=50, batch_size=8, encode=True, speed_regulator=1.):
+        """ Predicts a single, arbitrarily long, sentence decoding the expanded sequence in overlapping windows.
+        
+        The windows are decoded independently, in batches of batch_size, and their overlaps are linearly
+        cross-faded, so that decoder memory is bounded by the window size instead of growing with the
+        squared output length.
+        
+        :param window: window length in frames, at most decoder_maximum_position_encoding.
+        :param overlap: number of frames shared (and cross-faded) by consecutive windows.
+        :return: dictionary with mel of shape (frames, mel_channels) and durations.
+        """
+        assert 0 <= overlap < window, f'Overlap must be smaller than the window, got {overlap} and {window}.'
+        if encode:
+            inp = self.encode_text(inp)
+            inp = tf.cast(tf.expand_dims(inp, 0), tf.int32)
+        duration_scalar = tf.cast(1. / speed_regulator, tf.float32)
+        encoder_output, padding_mask, _ = self._cached_forward_encoder(inp)
+        expanded, durations = self.forward_expand(encoder_output, padding_mask, duration_scalar)
+        mel_len = int(tf.shape(expanded)[1])
+        hop = window - overlap
+        starts = list(range(0, max(mel_len - overlap, 1), hop))
+        windows = [expanded[0, start:start + window] for start in starts]
+        mels = []
+        for i in range(0, len(windows), batch_size):
+            batch = windows[i:i + batch_size]
+            batch = tf.RaggedTensor.from_row_lengths(tf.concat(batch, axis=0),
+                                                     [tf.shape(w)[0] for w in batch]).to_tensor()
+            out = self.forward_expanded_decoder(batch)
+            mels.extend([out['mel'][j, :int(tf.shape(w)[0])].numpy()
+                         for j, w in enumerate(windows[i:i + batch_size])])
+        mel = np.zeros((mel_len, self.mel_channels), dtype=np.float32)
+        fade_in = np.linspace(0., 1., overlap + 2, dtype=np.float32)[1:-1, np.newaxis]
+        for start, window_mel in zip(starts, mels):
+            if start > 0:
+                window_mel[:overlap] *= fade_in
+                mel[start:start + overlap] *= (1. - fade_in)
+            mel[start:start + len(window_mel)] += window_mel
+        return {'mel': tf.constant(mel), 'duration': durations}
+    
+    def predict_batch(self, inputs: list, batch_size=32, speed_regulator=1., encode=True):
+        """ Predicts several sentences in padded batches of sentences of similar length.
+        
+        :param inputs: list of sentences, or of encoded phoneme sequences if encode is False.
+        :return: list of mels of shape (frames, mel_channels), in the order of inputs.
+        """
+        if encode:
+            inputs = self.encode_text(inputs)
+        duration_scalar = tf.cast(1. / speed_regulator, tf.float32)
+        mels = [None] * len(inputs)
+        for batch_indices, batch in self._sorted_padded_batches(inputs, batch_size):
+            out = self.forward(batch, durations_scalar=duration_scalar)
+            mel_lengths = tf.reduce_sum(1. - out['expanded_mask'][:, 0, 0, :], axis=-1).numpy()
+            for j, i in enumerate(batch_indices):
+                mels[i] = out['mel'][j, :int(mel_lengths[j])]
+        return mels
+    
+    def predict_durations(self, inputs: list, batch_size=32, speed_regulator=1., encode=True):
+        """ Predicts only the phoneme durations of several sentences, skipping the decoder.
+        
+        :param inputs: list of sentences, or of encoded phoneme sequences if encode is False.
+        :return: list of dictionaries with the rounded per phoneme durations, as used by Expand,
+            and the resulting mel length, in the order of inputs.
+        """
+        if encode:
+            inputs = self.encode_text(inputs)
+        duration_scalar = tf.cast(1. / speed_regulator, tf.float32)
+        outputs = [None] * len(inputs)
+        for batch_indices, batch in self._sorted_padded_batches(inputs, batch_size):
+            out = self.forward_durations(batch, durations_scalar=duration_scalar)
+            for j, i in enumerate(batch_indices):
+                outputs[i] = {'duration': out['duration'][j, :len(inputs[i])],
+                              'mel_length': int(out['mel_length'][j])}
+        return outputs
+    
+    @staticmethod
+    def _sorted_padded_batches(inputs: list, batch_size: int):
+        """ Yields padded batches of sequences of similar length, with their indices in inputs. """
+        order = np.argsort([len(inp) for inp in inputs], kind='stable')
+        for start in range(0, len(inputs), batch_size):
+            batch_indices = order[start:start + batch_size]
+            batch = [tf.cast(inputs[i], tf.int32) for i in batch_indices]
+            batch = tf.RaggedTensor.from_row_lengths(tf.concat(batch, axis=0),
+                                                     [tf.shape(inp)[0] for inp in batch]).to_tensor()
+            yield batch_indices, batch
@@ -39,7 +39,9 @@ def scaled_dot_product_attention(q, k, v, mask):
     output, attention_weights
   """
     
-    matmul_qk = tf.matmul(q, k, transpose_b=True)  # (..., seq_len_q, seq_len_k)
+    # the logits and the softmax are computed in float32 also under mixed precision,
+    # since -1e9 overflows float16
+    matmul_qk = tf.cast(tf.matmul(q, k, transpose_b=True), tf.float32)  # (..., seq_len_q, seq_len_k)
     
     # scale matmul_qk
     dk = tf.cast(tf.shape(k)[-1], tf.float32)
@@ -47,13 +49,13 @@ def scaled_dot_product_attention(q, k, v, mask):
     
     # add the mask to the scaled tensor.
     if mask is not None:
-        scaled_attention_logits += mask * -1e9
+        scaled_attention_logits += tf.cast(mask, tf.float32) * -1e9
     
     # softmax is normalized on the last axis (seq_len_k) so that the scores
     # add up to 1.
     attention_weights = tf.nn.softmax(scaled_attention_logits, axis=-1)  # (..., seq_len_q, seq_len_k)
     
-    output = tf.matmul(attention_weights, v)  # (..., seq_len_q, depth_v)
+    output = tf.matmul(tf.cast(attention_weights, v.dtype), v)  # (..., seq_len_q, depth_v)
     
     return output, attention_weights
 
@@ -72,3 +74,10 @@ def create_mel_padding_mask(seq):
 def create_look_ahead_mask(size):
     mask = 1 - tf.linalg.band_part(tf.ones((size, size)), -1, 0)
     return mask
+
+
+def create_attention_window_mask(attention_peak, size, window):
+    """ Masks the positions further than window from attention_peak (batch_size,) """
+    distance = tf.abs(tf.range(size)[tf.newaxis, :] - attention_peak[:, tf.newaxis])
+    mask = tf.cast(distance > window, tf.float32)
+    return mask[:, tf.newaxis, tf.newaxis, :]  # (batch_size, 1, 1, size)
@@ -1,3 +1,4 @@
+from functools import partial
 from pathlib import Path
 from random import Random
 from typing import List, Union
@@ -74,7 +75,17 @@ class TextMelDataset:
         mel, text = self._read_sample(sample_name)
         return self.preprocessor(mel=mel, text=text, sample_name=sample_name)
     
-    def get_dataset(self, bucket_batch_sizes, bucket_boundaries, shuffle=True, drop_remainder=False):
+    def _bucket_padded_shapes(self, bucket_phoneme_ratio):
+        if bucket_phoneme_ratio is None:
+            return None
+        return lambda boundary: self.preprocessor.bucket_padded_shapes(boundary, phoneme_ratio=bucket_phoneme_ratio)
+    
+    def get_dataset(self, bucket_batch_sizes, bucket_boundaries, shuffle=True, drop_remainder=False,
+                    bucket_phoneme_ratio: float = None):
+        """
+        :param bucket_phoneme_ratio: if given, pads the batches of each bucket to a static shape: the mels to the
+            bucket boundary and the phonemes to bucket_phoneme_ratio times it (see Dataset).
+        """
         return Dataset(
             samples=self.metadata_reader.filenames,
             preprocessor=self._process_sample,
@@ -84,7 +95,8 @@ class TextMelDataset:
             drop_remainder=drop_remainder,
             len_function=self.preprocessor.get_sample_length,
             bucket_batch_sizes=bucket_batch_sizes,
-            bucket_boundaries=bucket_boundaries)
+            bucket_boundaries=bucket_boundaries,
+            bucket_padded_shapes=self._bucket_padded_shapes(bucket_phoneme_ratio))
     
     @classmethod
     def from_config(cls,
@@ -123,7 +135,17 @@ class TextMelDurDataset:
         mel, text, durations = self._read_sample(sample_name)
         return self.preprocessor(mel=mel, text=text, durations=durations, sample_name=sample_name)
     
-    def get_dataset(self, bucket_batch_sizes, bucket_boundaries, shuffle=True, drop_remainder=False):
+    def _bucket_padded_shapes(self, bucket_phoneme_ratio):
+        if bucket_phoneme_ratio is None:
+            return None
+        return lambda boundary: self.preprocessor.bucket_padded_shapes(boundary, phoneme_ratio=bucket_phoneme_ratio)
+    
+    def get_dataset(self, bucket_batch_sizes, bucket_boundaries, shuffle=True, drop_remainder=False,
+                    bucket_phoneme_ratio: float = None):
+        """
+        :param bucket_phoneme_ratio: if given, pads the batches of each bucket to a static shape: the mels to the
+            bucket boundary and the phonemes to bucket_phoneme_ratio times it (see Dataset).
+        """
         return Dataset(
             samples=self.metadata_reader.filenames,
             preprocessor=self._process_sample,
@@ -133,7 +155,8 @@ class TextMelDurDataset:
             shuffle=shuffle,
             drop_remainder=drop_remainder,
             bucket_batch_sizes=bucket_batch_sizes,
-            bucket_boundaries=bucket_boundaries)
+            bucket_boundaries=bucket_boundaries,
+            bucket_padded_shapes=self._bucket_padded_shapes(bucket_phoneme_ratio))
     
     @classmethod
     def from_config(cls,
@@ -167,24 +190,87 @@ class Dataset:
                  padding_values: tuple = None,
                  shuffle=True,
                  drop_remainder=True,
-                 seed=42):
+                 seed=42,
+                 bucket_padded_shapes=None):
+        """
+        :param bucket_padded_shapes: function of the (exclusive) upper boundary of a bucket, returning the
+            padded shapes of its batches. If given, all batches of a bucket have the same shape, e.g. for XLA,
+            and the samples that do not fit, including those beyond the last boundary, are dropped.
+            Otherwise, each batch is padded to its longest sample.
+        """
         self._random = Random(seed)
         self._samples = samples[:]
         self.preprocessor = preprocessor
-        dataset = tf.data.Dataset.from_generator(lambda: self._datagen(shuffle),
-                                                 output_types=output_types)
-        # TODO: pass bin args
-        binned_data = dataset.apply(
-            tf.data.experimental.bucket_by_sequence_length(
+        self.output_types = output_types
+        self.shuffle = shuffle
+        self.bucket_batch_sizes = bucket_batch_sizes
+        self.bucket_shapes = None
+        if bucket_padded_shapes is not None:
+            self.bucket_shapes = [bucket_padded_shapes(boundary) for boundary in bucket_boundaries]
+            self._bucketing = partial(self._static_buckets,
+                                      len_function=len_function,
+                                      bucket_boundaries=bucket_boundaries,
+                                      padding_values=padding_values,
+                                      drop_remainder=drop_remainder)
+        else:
+            # TODO: pass bin args
+            self._bucketing = tf.data.experimental.bucket_by_sequence_length(
                 len_function,
                 bucket_boundaries=bucket_boundaries,
                 bucket_batch_sizes=bucket_batch_sizes,
                 padded_shapes=padded_shapes,
                 drop_remainder=drop_remainder,
                 padding_values=padding_values
-            ))
-        self.dataset = binned_data
-        self.data_iter = iter(binned_data.repeat(-1))
+            )
+        self.dataset = self._batched_dataset(self._samples)
+        self.data_iter = iter(self.dataset.repeat(-1))
+    
+    def _batched_dataset(self, samples):
+        dataset = tf.data.Dataset.from_generator(lambda: self._datagen(samples),
+                                                 output_types=self.output_types)
+        return dataset.apply(self._bucketing)
+    
+    def _static_buckets(self, dataset, len_function, bucket_boundaries, padding_values, drop_remainder):
+        boundaries = tf.constant(bucket_boundaries, dtype=tf.int64)
+        batch_sizes = tf.constant(self.bucket_batch_sizes[:len(bucket_boundaries)], dtype=tf.int64)
+        # (n_buckets, rank) padded lengths of each component
+        shapes = [tf.constant([bucket[i] for bucket in self.bucket_shapes], dtype=tf.int64,
+                              shape=(len(bucket_boundaries), len(self.bucket_shapes[0][i])))
+                  for i in range(len(self.output_types))]
+        
+        def bucket_id(*sample):
+            return tf.reduce_sum(tf.cast(tf.cast(len_function(*sample), tf.int64) >= boundaries, tf.int64))
+        
+        def fits(*sample):
+            bucket = bucket_id(*sample)
+            valid_bucket = tf.minimum(bucket, len(bucket_boundaries) - 1)
+            fitting = [tf.reduce_all(tf.shape(x, out_type=tf.int64) <= shape[valid_bucket])
+                       for x, shape in zip(sample, shapes)]
+            return tf.logical_and(bucket < len(bucket_boundaries), tf.reduce_all(fitting))
+        
+        def batch_bucket(bucket, window):
+            return window.padded_batch(batch_sizes[bucket],
+                                       padded_shapes=tuple(shape[bucket] for shape in shapes),
+                                       padding_values=padding_values,
+                                       drop_remainder=drop_remainder)
+        
+        return dataset.filter(fits).group_by_window(key_func=bucket_id,
+                                                    reduce_func=batch_bucket,
+                                                    window_size_func=lambda bucket: batch_sizes[bucket])
+    
+    def distribute(self, strategy: tf.distribute.Strategy):
+        """ Distributes the batches over the replicas of strategy, after which next_batch returns per-replica
+        batches. Each worker batches its own shard of the samples and each replica receives whole batches,
+        so that the buckets are not split.
+        """
+        
+        def dataset_fn(input_context):
+            samples = self._samples[input_context.input_pipeline_id::input_context.num_input_pipelines]
+            return self._batched_dataset(samples).repeat(-1)
+        
+        # the sample names (strings) cannot be placed on accelerators
+        options = tf.distribute.InputOptions(experimental_fetch_to_device=False)
+        self.data_iter = iter(strategy.distribute_datasets_from_function(dataset_fn, options=options))
     
     def next_batch(self):
         return next(self.data_iter)
@@ -192,12 +278,19 @@ class Dataset:
     def all_batches(self):
         return iter(self.dataset)
     
-    def _datagen(self, shuffle):
+    def padding_batches(self):
+        """ A batch of padding only for each bucket with static shapes, e.g. to compile the steps up front. """
+        assert self.bucket_shapes is not None, 'padding batches require bucket_padded_shapes.'
+        return [tuple(tf.zeros([batch_size] + list(shape), dtype=dtype)
+                      for shape, dtype in zip(bucket, self.output_types))
+                for bucket, batch_size in zip(self.bucket_shapes, self.bucket_batch_sizes)]
+    
+    def _datagen(self, samples):
         """
         Shuffle once before generating to avoid buffering
         """
-        samples = self._samples[:]
-        if shuffle:
+        samples = samples[:]
+        if self.shuffle:
             self._random.shuffle(samples)
         return (self.preprocessor(s) for s in samples)
 
@@ -206,6 +299,7 @@ class ForwardPreprocessor:
     def __init__(self, mel_channels, tokenizer: Tokenizer):
         self.output_types = (tf.float32, tf.int32, tf.int32, tf.string)
         self.padded_shapes = ([None, mel_channels], [None], [None], [])
+        self.mel_channels = mel_channels
         self.tokenizer = tokenizer
     
     def __call__(self, text, mel, durations, sample_name):
@@ -215,6 +309,11 @@ class ForwardPreprocessor:
     def get_sample_length(self, mel, encoded_phonemes, durations, sample_name):
         return tf.shape(mel)[0]
     
+    def bucket_padded_shapes(self, bucket_boundary, phoneme_ratio):
+        mel_len = bucket_boundary - 1
+        phoneme_len = int(np.ceil(mel_len * phoneme_ratio))
+        return [mel_len, self.mel_channels], [phoneme_len], [phoneme_len], []
+    
     @classmethod
     def from_config(cls, config: Config, tokenizer: Tokenizer):
         return cls(mel_channels=config.config['mel_channels'],
@@ -230,6 +329,7 @@ class AutoregressivePreprocessor:
                  tokenizer: Tokenizer):
         self.output_types = (tf.float32, tf.int32, tf.int32, tf.string)
         self.padded_shapes = ([None, mel_channels], [None], [None], [])
+        self.mel_channels = mel_channels
         self.start_vec = np.ones((1, mel_channels)) * mel_start_value
         self.end_vec = np.ones((1, mel_channels)) * mel_end_value
         self.tokenizer = tokenizer
@@ -244,6 +344,10 @@ class AutoregressivePreprocessor:
     def get_sample_length(self, norm_mel, encoded_phonemes, stop_probs, sample_name):
         return tf.shape(norm_mel)[0]
     
+    def bucket_padded_shapes(self, bucket_boundary, phoneme_ratio):
+        mel_len = bucket_boundary - 1
+        return [mel_len, self.mel_channels], [int(np.ceil(mel_len * phoneme_ratio))], [mel_len], []
+    
     @classmethod
     def from_config(cls, config: Config, tokenizer: Tokenizer):
         return cls(mel_channels=config.config['mel_channels'],
@@ -10,8 +10,11 @@ class Pipeline:
         self.tokenizer = tokenizer
     
     def __call__(self, input_text):
+        """ Encodes a string, or a list of strings with a single call to cleaner and phonemizer. """
         text = self.cleaner(input_text)
         phons = self.phonemizer(text)
+        if isinstance(phons, list):
+            return [self.tokenizer(p) for p in phons]
         tokens = self.tokenizer(phons)
         return tokens
     
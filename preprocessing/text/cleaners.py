@@ -3,7 +3,7 @@ import abc
 from typing import Union
 from abc import abstractmethod
 
-from preprocessing.text.symbols import _alphabet, _punctuations, _numbers
+from preprocessing.text.symbols import _alphabet, _punctuations, _numbers, _sentence_end_punctuation
 from preprocessing.text.numbers import Numbers
 
 
@@ -13,6 +13,15 @@ class Cleaner(abc.ABC):
     def __call__(self, text: Union[str, list]) -> Union[str, list]:
         """ Cleans text. """
         pass
+    
+    def split_sentences(self, text: str) -> list:
+        """ Cleans a line of text and splits it into sentences.
+        
+        Cleaning happens first, so that abbreviations and decimal points are not mistaken for sentence ends.
+        """
+        text = self(text)
+        sentences = re.split(f'(?<=[{re.escape(_sentence_end_punctuation)}])\\s+', text)
+        return [sentence.strip() for sentence in sentences if sentence.strip()]
 
 
 class English(Cleaner):
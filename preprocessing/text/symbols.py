@@ -9,6 +9,7 @@ _phonemes = sorted(list(
 _punctuations = '!,-.:;? '
 _alphabet = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyzäüöß'
 _not_end_punctuation = ',-.:; '
+_sentence_end_punctuation = '!.?'
 _numbers = '1234567890'
 
 all_phonemes = sorted(list(_phonemes) + list(_punctuations))
\ No newline at end of file
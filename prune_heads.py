@@ -0,0 +1,48 @@
+import argparse
+from itertools import islice
+
+import numpy as np
+
+from utils.config_manager import Config
+from preprocessing.datasets import TextMelDataset, AutoregressivePreprocessor, TextMelDurDataset, \
+    ForwardPreprocessor
+from utils.head_pruning import score_heads, prune_heads
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--config', dest='config', type=str, required=True)
+parser.add_argument('--model_kind', type=str, default='forward', choices=['autoregressive', 'forward'])
+parser.add_argument('--checkpoint', type=str, default=None,
+                    help='Explicit path to model weights. Defaults to the latest checkpoint of the config.')
+parser.add_argument('--n_heads', type=int, default=1,
+                    help='Number of heads removed from every attention layer (at least one head is kept).')
+parser.add_argument('--n_batches', type=int, default=None,
+                    help='Number of validation batches the heads are scored on. Defaults to all.')
+parser.add_argument('--output', type=str, required=True,
+                    help='Path of the pruned inference weights, for Config.load_inference_model.')
+args = parser.parse_args()
+
+config_loader = Config(config_path=args.config, model_kind=args.model_kind)
+model = config_loader.load_model(checkpoint_path=args.checkpoint)
+if args.model_kind == 'forward':
+    data_prep = ForwardPreprocessor.from_config(config=config_loader, tokenizer=model.text_pipeline.tokenizer)
+    valid_data_handler = TextMelDurDataset.from_config(config_loader, preprocessor=data_prep, kind='valid')
+else:
+    data_prep = AutoregressivePreprocessor.from_config(config_loader, tokenizer=model.text_pipeline.tokenizer)
+    valid_data_handler = TextMelDataset.from_config(config_loader, preprocessor=data_prep, kind='valid')
+valid_dataset = valid_data_handler.get_dataset(bucket_batch_sizes=config_loader.config['bucket_batch_sizes'],
+                                               bucket_boundaries=config_loader.config['bucket_boundaries'],
+                                               shuffle=False)
+# drop the file names
+batches = [batch[:3] for batch in islice(valid_dataset.all_batches(), args.n_batches)]
+
+n_parameters = np.sum([np.prod(v.shape) for v in model.variables])
+scores, loss = score_heads(model, batches)
+pruned = prune_heads(model, scores, n_heads=args.n_heads)
+for name, layer_scores in scores.items():
+    print(f"{name}: head scores {np.round(layer_scores, 3).tolist()}, removed heads {pruned[name]}")
+_, pruned_loss = score_heads(model, batches)
+pruned_n_parameters = np.sum([np.prod(v.shape) for v in model.variables])
+print(f'Validation loss on {len(batches)} batches: {loss:.5f} -> {pruned_loss:.5f}.')
+print(f'Parameters: {n_parameters} -> {pruned_n_parameters}.')
+weights_path = config_loader.save_inference_weights(model, args.output)
+print(f'Wrote pruned {args.model_kind} model weights to {weights_path}.')
@@ -0,0 +1,25 @@
+import asyncio
+import argparse
+
+from utils.config_manager import Config
+from utils.audio import Audio
+from utils.synthesis_server import BatchingSynthesizer, SynthesisServer
+from utils.scripts_utils import dynamic_memory_allocation
+
+dynamic_memory_allocation()
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--config', dest='config', type=str, required=True)
+parser.add_argument('--checkpoint', type=str, default=None,
+                    help='Explicit path to model weights. Defaults to the latest checkpoint of the config.')
+parser.add_argument('--host', type=str, default='127.0.0.1')
+parser.add_argument('--port', type=int, default=5000)
+parser.add_argument('--max_batch_size', type=int, default=16)
+parser.add_argument('--max_wait', type=float, default=0.01, help='Maximum seconds to wait to fill a batch.')
+args = parser.parse_args()
+
+config_loader = Config(config_path=args.config, model_kind='forward')
+model = config_loader.load_model(checkpoint_path=args.checkpoint)
+synthesizer = BatchingSynthesizer(model, max_batch_size=args.max_batch_size, max_wait=args.max_wait)
+server = SynthesisServer(synthesizer, audio=Audio(config_loader.config), host=args.host, port=args.port)
+asyncio.run(server.serve_forever())
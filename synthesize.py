@@ -0,0 +1,126 @@
+import os
+import re
+import json
+import argparse
+from operator import itemgetter
+from pathlib import Path
+from multiprocessing import get_context, cpu_count
+
+import numpy as np
+
+
+def file_id(item_id) -> str:
+    """ The id as a file name, with the characters other than letters, digits, '-', '_' and '.' replaced. """
+    return re.sub(r'[^\w.-]', '_', str(item_id)).strip('.')
+
+
+def read_inputs(input_path: Path):
+    """ Reads one sentence per line from a text file, or objects with 'text' and optional 'id' from JSONL.
+    
+    The ids name the output files, so they are sanitized with file_id and must be unique.
+    """
+    items = []
+    ids = set()
+    with open(str(input_path), 'r', encoding='utf-8') as f:
+        for i, line in enumerate(f):
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            if input_path.suffix == '.jsonl':
+                item = json.loads(line)
+                item_id, text = file_id(item.get('id', i)), item['text']
+            else:
+                item_id, text = str(i), line
+            if len(item_id) == 0:
+                raise ValueError(f'Empty id in line {i + 1} of {input_path}.')
+            if item_id in ids:
+                raise ValueError(f'Duplicate id {item_id} in line {i + 1} of {input_path}.')
+            ids.add(item_id)
+            items.append({'index': len(items), 'id': item_id, 'text': text})
+    return items
+
+
+def merge_manifests(manifests: list):
+    """ Merges the manifests of the workers in input order, dropping the input indices. """
+    manifest = sorted([entry for shard in manifests for entry in shard], key=itemgetter('index'))
+    return [{key: value for key, value in entry.items() if key != 'index'} for entry in manifest]
+
+
+def synthesize_shard(worker_id: int, items: list, args):
+    """ Loads the model in the worker process and synthesizes its shard of the inputs. """
+    # pin the worker to its own cores before tensorflow creates its thread pools
+    if hasattr(os, 'sched_setaffinity'):
+        first_core = (worker_id * args.threads) % cpu_count()
+        os.sched_setaffinity(0, {(first_core + i) % cpu_count() for i in range(args.threads)})
+    import tensorflow as tf
+    
+    tf.config.threading.set_intra_op_parallelism_threads(args.threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    from utils.config_manager import Config
+    from utils.audio import Audio
+    
+    config_loader = Config(config_path=args.config, model_kind=args.model_kind)
+    model = config_loader.load_model(checkpoint_path=args.checkpoint, verbose=False)
+    audio = Audio(config_loader.config)
+    output_dir = Path(args.output_dir)
+    manifest = []
+    for start in range(0, len(items), args.batch_size):
+        batch = items[start:start + args.batch_size]
+        texts = [item['text'] for item in batch]
+        if args.model_kind == 'forward':
+            mels = model.predict_batch(texts, batch_size=args.batch_size, speed_regulator=args.speed_regulator)
+        else:
+            mels = [out['mel'] for out in model.predict_batch(texts, max_length=args.max_length)]
+        for item, mel in zip(batch, mels):
+            mel = mel.numpy()
+            if args.wav:
+                import soundfile as sf
+                
+                wav = audio.reconstruct_waveform(mel.T)
+                file_path = output_dir / f"{item['id']}.wav"
+                sf.write(str(file_path), wav, config_loader.config['sampling_rate'])
+            else:
+                file_path = output_dir / f"{item['id']}.npy"
+                np.save(str(file_path), mel)
+            manifest.append({'index': item['index'], 'id': item['id'], 'text': item['text'],
+                             'path': str(file_path), 'mel_frames': int(mel.shape[0])})
+        print(f'worker {worker_id}: {min(start + args.batch_size, len(items))}/{len(items)}')
+    return manifest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', dest='config', type=str, required=True)
+    parser.add_argument('--model_kind', type=str, default='forward', choices=['autoregressive', 'forward'])
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help='Explicit path to model weights. Defaults to the latest checkpoint of the config.')
+    parser.add_argument('--input', type=str, required=True,
+                        help='Text file with one sentence per line, or JSONL file with "text" and "id" fields.')
+    parser.add_argument('--output_dir', type=str, required=True)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=None,
+                        help='Tensorflow threads per worker. Defaults to the number of cores divided by workers.')
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--speed_regulator', type=float, default=1.)
+    parser.add_argument('--max_length', type=int, default=1000,
+                        help='Maximum decoding length of the autoregressive model.')
+    parser.add_argument('--wav', action='store_true', help='Write Griffin-Lim wavs instead of mels.')
+    args = parser.parse_args()
+    if args.threads is None:
+        args.threads = max(cpu_count() // args.workers, 1)
+    for arg in vars(args):
+        print('{}: {}'.format(arg, getattr(args, arg)))
+    
+    Path(args.output_dir).mkdir(exist_ok=True, parents=True)
+    items = read_inputs(Path(args.input))
+    # sort by length before sharding, so that each worker gets similar lengths in its batches
+    items = sorted(items, key=lambda item: len(item['text']))
+    shards = [items[i::args.workers] for i in range(args.workers)]
+    # spawn, since tensorflow is not fork-safe
+    with get_context('spawn').Pool(args.workers) as pool:
+        manifests = pool.starmap(synthesize_shard, [(i, shard, args) for i, shard in enumerate(shards)])
+    manifest = merge_manifests(manifests)
+    with open(str(Path(args.output_dir) / 'manifest.jsonl'), 'w', encoding='utf-8') as f:
+        for entry in manifest:
+            f.write(json.dumps(entry) + '\n')
+    print(f"Wrote {len(manifest)} files and manifest to {args.output_dir}.")
@@ -0,0 +1,71 @@
+import tempfile
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+from utils.config_manager import Config
+
+
+class TestInferenceWeights(unittest.TestCase):
+    
+    def test_save_load_inference_weights(self):
+        config = Config(config_path='config/melgan', model_kind='forward')
+        model = config.get_model(ignore_hash=True)
+        config.compile_model(model)
+        inp = tf.constant([[5, 3, 7, 8, 2, 9, 11, 4, 3]], dtype=tf.int32)
+        out = model.forward(inp, durations_scalar=tf.constant(1.))
+        with tempfile.TemporaryDirectory() as weights_dir:
+            weights_path = config.save_inference_weights(model, f'{weights_dir}/inference')
+            saved_variables = [name for name, shape in tf.train.list_variables(weights_path)]
+            loaded = config.load_inference_model(weights_path, verbose=False)
+            # weights are restored when the layers are built
+            loaded_out = loaded.forward(inp, durations_scalar=tf.constant(1.))
+        self.assertIsNone(loaded.optimizer)
+        self.assertFalse(any('optimizer' in name for name in saved_variables))
+        np.testing.assert_allclose(out['mel'], loaded_out['mel'], atol=1e-5)
+    
+    def test_load_wrong_checkpoint(self):
+        forward_config = Config(config_path='config/melgan', model_kind='forward')
+        model = forward_config.get_model(ignore_hash=True)
+        forward_config.compile_model(model)
+        inp = tf.constant([[5, 3, 7, 8, 2, 9, 11, 4, 3]], dtype=tf.int32)
+        # constant durations, since random ones can round to an empty mel
+        model.forward_durations(inp, durations_scalar=tf.constant(1.))
+        dur_linear = model.dur_pred.linear
+        dur_linear.kernel.assign(tf.zeros_like(dur_linear.kernel))
+        dur_linear.bias.assign([2.])
+        model.forward(inp, durations_scalar=tf.constant(1.))
+        autoregressive_config = Config(config_path='config/melgan', model_kind='autoregressive')
+        with tempfile.TemporaryDirectory() as weights_dir:
+            training_path = tf.train.Checkpoint(net=model).write(f'{weights_dir}/training')
+            inference_path = forward_config.save_inference_weights(model, f'{weights_dir}/inference')
+            with self.assertRaises(AssertionError):
+                forward_config.load_inference_model(training_path, verbose=False)
+            with self.assertRaises(AssertionError):
+                autoregressive_config.load_inference_model(inference_path, verbose=False)
+
+
+class TestMixedPrecisionConfig(unittest.TestCase):
+    
+    def setUp(self):
+        self.config = Config(config_path='config/melgan', model_kind='forward')
+        self.inp = tf.constant([[5, 3, 7, 8, 2, 9, 11, 4, 3]], dtype=tf.int32)
+    
+    def test_mixed_float16(self):
+        self.config.mixed_precision = 'mixed_float16'
+        model = self.config.get_model(ignore_hash=True)
+        self.config.compile_model(model)
+        self.assertEqual('float32', tf.keras.mixed_precision.global_policy().name)
+        self.assertEqual(tf.float16, model.dur_pred.linear.compute_dtype)
+        self.assertEqual(tf.float32, model.dur_pred.linear.variable_dtype)
+        self.assertIsInstance(model.optimizer, tf.keras.mixed_precision.LossScaleOptimizer)
+        out = model.forward(self.inp, durations_scalar=tf.constant(1.))
+        self.assertEqual(tf.float32, out['mel'].dtype)
+    
+    def test_float32(self):
+        model = self.config.get_model(ignore_hash=True)
+        self.config.compile_model(model)
+        self.assertEqual('float32', tf.keras.mixed_precision.global_policy().name)
+        self.assertEqual(tf.float32, model.dur_pred.linear.compute_dtype)
+        self.assertNotIsInstance(model.optimizer, tf.keras.mixed_precision.LossScaleOptimizer)
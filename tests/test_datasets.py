@@ -0,0 +1,72 @@
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+from preprocessing.datasets import Dataset, ForwardPreprocessor
+
+
+def forward_dataset(samples, bucket_boundaries, bucket_batch_sizes, bucket_phoneme_ratio=None, drop_remainder=False):
+    """ Dataset of in-memory (mel, phonemes, durations, sample_name) samples. """
+    preprocessor = ForwardPreprocessor(mel_channels=samples[0][0].shape[-1], tokenizer=None)
+    bucket_padded_shapes = None
+    if bucket_phoneme_ratio is not None:
+        bucket_padded_shapes = lambda boundary: preprocessor.bucket_padded_shapes(boundary, bucket_phoneme_ratio)
+    return Dataset(samples=list(range(len(samples))),
+                   preprocessor=lambda i: samples[i],
+                   len_function=preprocessor.get_sample_length,
+                   padded_shapes=preprocessor.padded_shapes,
+                   output_types=preprocessor.output_types,
+                   bucket_boundaries=bucket_boundaries,
+                   bucket_batch_sizes=bucket_batch_sizes,
+                   shuffle=False,
+                   drop_remainder=drop_remainder,
+                   bucket_padded_shapes=bucket_padded_shapes)
+
+
+def random_sample(mel_len, phoneme_len, name):
+    durations = np.zeros(phoneme_len, dtype=np.int32)
+    durations[:mel_len % phoneme_len] = 1
+    durations += mel_len // phoneme_len
+    phonemes = np.random.randint(1, 10, size=phoneme_len).astype(np.int32)
+    return np.random.normal(size=(mel_len, 8)).astype(np.float32), phonemes, durations, name
+
+
+class TestDataset(unittest.TestCase):
+    
+    def setUp(self):
+        np.random.seed(42)
+        lengths = [(3, 1), (5, 2), (12, 3), (15, 4), (25, 2), (7, 6), (11, 5), (9, 2), (4, 1)]
+        self.samples = [random_sample(mel_len, phoneme_len, f'sample_{i}')
+                        for i, (mel_len, phoneme_len) in enumerate(lengths)]
+    
+    def test_dynamic_buckets(self):
+        dataset = forward_dataset(self.samples, bucket_boundaries=[10, 20], bucket_batch_sizes=[2, 2, 1])
+        n_samples = 0
+        for mel, phonemes, durations, names in dataset.all_batches():
+            self.assertEqual(max(self.samples[int(name[7:])][0].shape[0] for name in names.numpy().astype(str)),
+                             mel.shape[1])
+            n_samples += len(names)
+        self.assertEqual(len(self.samples), n_samples)
+    
+    def test_static_buckets(self):
+        dataset = forward_dataset(self.samples, bucket_boundaries=[10, 20], bucket_batch_sizes=[2, 2, 1],
+                                  bucket_phoneme_ratio=.5)
+        names = []
+        for mel, phonemes, durations, batch_names in dataset.all_batches():
+            self.assertIn(mel.shape[1:], [(9, 8), (19, 8)])
+            self.assertEqual(int(np.ceil(mel.shape[1] * .5)), phonemes.shape[1])
+            self.assertEqual(phonemes.shape, durations.shape)
+            np.testing.assert_array_equal(tf.reduce_sum(durations, axis=-1),
+                                          tf.reduce_sum(tf.cast(tf.reduce_any(mel != 0, axis=-1), tf.int32), axis=-1))
+            names += list(batch_names.numpy().astype(str))
+        # beyond the last boundary and more phonemes than the padded length of their bucket
+        self.assertEqual(sorted(f'sample_{i}' for i in [0, 1, 2, 3, 6, 7, 8]), sorted(names))
+        self.assertEqual([[(2, 9, 8), (2, 5), (2, 5), (2,)], [(2, 19, 8), (2, 10), (2, 10), (2,)]],
+                         [[tuple(x.shape) for x in batch] for batch in dataset.padding_batches()])
+    
+    def test_static_buckets_drop_remainder(self):
+        dataset = forward_dataset(self.samples, bucket_boundaries=[10, 20], bucket_batch_sizes=[2, 2, 1],
+                                  bucket_phoneme_ratio=.5, drop_remainder=True)
+        batch_sizes = [len(batch[-1]) for batch in dataset.all_batches()]
+        self.assertEqual([2, 2, 2], batch_sizes)
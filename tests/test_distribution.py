@@ -0,0 +1,121 @@
+import tempfile
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+import tensorflow as tf
+
+from tests.test_datasets import forward_dataset, random_sample
+from tests.test_gradient_accumulation import accumulating_model
+from tests.test_models import small_forward_model
+from utils.distribution import DistributedSteps, save_checkpoint, worker_directory
+
+# two logical CPU devices to replicate on, unless the runtime is already initialized
+try:
+    tf.config.set_logical_device_configuration(tf.config.list_physical_devices('CPU')[0],
+                                               [tf.config.LogicalDeviceConfiguration()] * 2)
+except RuntimeError:
+    pass
+
+
+class TestDistribution(unittest.TestCase):
+    
+    @classmethod
+    def setUpClass(cls):
+        # a single strategy, as the collective instance keys of a second one on the same devices clash
+        cls.strategy = None
+        if len(tf.config.list_logical_devices('CPU')) >= 2:
+            cls.strategy = tf.distribute.MirroredStrategy(devices=['/cpu:0', '/cpu:1'])
+    
+    def setUp(self):
+        if self.strategy is None:
+            self.skipTest('The TensorFlow runtime was initialized with a single CPU device.')
+        tf.random.set_seed(42)
+        np.random.seed(42)
+        samples = [random_sample(mel_len, phoneme_len, f'sample_{i}')
+                   for i, (mel_len, phoneme_len) in enumerate([(5, 2), (7, 3), (13, 4), (17, 6), (8, 3)])]
+        self.dataset = forward_dataset(samples, bucket_boundaries=[10, 20], bucket_batch_sizes=[2, 2, 1])
+    
+    def test_train_step(self):
+        """ The replicas of the same batch update the weights as the batch does without distribution. """
+        mel, phonemes, durations, _ = next(self.dataset.all_batches())
+        # Adam would amplify the rounding differences of the near zero gradients
+        model = small_forward_model()
+        model._compile(optimizer=tf.keras.optimizers.SGD(learning_rate=.1))
+        with self.strategy.scope():
+            distributed_model = small_forward_model()
+            distributed_model._compile(optimizer=tf.keras.optimizers.SGD(learning_rate=.1))
+            distributed_model._val_step(input_sequence=phonemes, target_sequence=mel, target_durations=durations)
+        model._val_step(input_sequence=phonemes, target_sequence=mel, target_durations=durations)
+        distributed_model.set_weights(model.get_weights())
+        for layer in model.submodules + distributed_model.submodules:
+            if isinstance(layer, tf.keras.layers.Dropout):
+                layer.rate = 0.
+        model_out = model.train_step(phonemes, mel, durations)
+        steps = DistributedSteps(self.strategy)
+        batch = steps.replicate({'input_sequence': phonemes, 'target_sequence': mel, 'target_durations': durations})
+        distributed_out = steps(distributed_model.train_step, **batch)
+        self.assertAlmostEqual(float(model_out['loss']), float(distributed_out['loss']), places=5)
+        self.assertEqual(mel.shape, distributed_out['mel'].shape)
+        for weight, distributed_weight in zip(model.get_weights(), distributed_model.get_weights()):
+            np.testing.assert_allclose(weight, distributed_weight, atol=1e-5)
+    
+    def test_accumulated_train_step(self):
+        """ Accumulating the gradients of a batch on every replica, then applying them, is one step on the batch. """
+        mel, phonemes, durations, _ = next(self.dataset.all_batches())
+        model = small_forward_model()
+        model._compile(optimizer=tf.keras.optimizers.SGD(learning_rate=.1))
+        with self.strategy.scope():
+            distributed_model = accumulating_model(small_forward_model())
+            distributed_model._compile(optimizer=tf.keras.optimizers.SGD(learning_rate=.1))
+            distributed_model._val_step(input_sequence=phonemes, target_sequence=mel, target_durations=durations)
+        model._val_step(input_sequence=phonemes, target_sequence=mel, target_durations=durations)
+        distributed_model.set_weights(model.get_weights())
+        for layer in model.submodules + distributed_model.submodules:
+            if isinstance(layer, tf.keras.layers.Dropout):
+                layer.rate = 0.
+        model.train_step(phonemes, mel, durations)
+        steps = DistributedSteps(self.strategy)
+        batch = steps.replicate({'input_sequence': phonemes, 'target_sequence': mel, 'target_durations': durations})
+        steps(distributed_model.accumulate_step, **batch)
+        self.assertEqual(0, distributed_model.step)
+        steps(distributed_model.train_step, **batch)
+        self.assertEqual(1, distributed_model.step)
+        # the batch normalization statistics are updated by both steps, the weights once
+        for variable, distributed_variable in zip(model.trainable_variables, distributed_model.trainable_variables):
+            np.testing.assert_allclose(variable.numpy(), distributed_variable.numpy(), atol=1e-5)
+    
+    def test_distributed_dataset(self):
+        """ Every replica receives whole batches. """
+        self.dataset.distribute(self.strategy)
+        steps = DistributedSteps(self.strategy)
+        names = []
+        for _ in range(2):
+            mel, phonemes, durations, batch_names = self.dataset.next_batch()
+            for replica_batch in self.strategy.experimental_local_results((mel, batch_names)):
+                self.assertEqual(len(replica_batch[0]), len(replica_batch[1]))
+                names += list(replica_batch[1].numpy().astype(str))
+            self.assertEqual(mel.values[0].shape, steps.local_values(mel).shape)
+        self.assertTrue(set(names) <= {f'sample_{i}' for i in range(5)})
+        self.assertLessEqual(4, len(names))
+
+
+class TestCheckpoints(unittest.TestCase):
+    
+    def test_save_checkpoint(self):
+        """ Only the checkpoint of the chief is kept. """
+        chief = SimpleNamespace(extended=SimpleNamespace(should_checkpoint=True))
+        worker = SimpleNamespace(extended=SimpleNamespace(should_checkpoint=False),
+                                 cluster_resolver=SimpleNamespace(task_id=1))
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertEqual(Path(directory), worker_directory(directory, chief))
+            self.assertEqual(Path(directory) / '.worker_1', worker_directory(directory, worker))
+            for strategy in [chief, worker]:
+                checkpoint = tf.train.Checkpoint(step=tf.Variable(1))
+                manager = tf.train.CheckpointManager(checkpoint, str(worker_directory(directory, strategy)),
+                                                     max_to_keep=None)
+                save_path = save_checkpoint(manager, strategy)
+            self.assertFalse((Path(directory) / '.worker_1').exists())
+            self.assertFalse(Path(save_path + '.index').exists())
+            self.assertEqual(str(Path(directory) / 'ckpt-1'), tf.train.latest_checkpoint(directory))
@@ -0,0 +1,44 @@
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+from tests.test_models import set_constant_durations, small_forward_model
+from utils.document_synthesis import DocumentSynthesizer
+
+
+class TestDocumentSynthesizer(unittest.TestCase):
+    
+    def setUp(self):
+        tf.random.set_seed(42)
+        self.model = small_forward_model()
+        set_constant_durations(self.model, tf.constant([[5, 3, 7]]))
+        self.synthesizer = DocumentSynthesizer(self.model, batch_size=2, window_batches=2, sentence_silence=3,
+                                               paragraph_silence=5, silence_value=-1.)
+    
+    def test_segment(self):
+        sentences, silences = self.synthesizer.segment('Mr. Smith is here. Really?\n\nYes, e.g. now!')
+        self.assertEqual(['Mr Smith is here.', 'Really?', 'Yes, e g now!'], sentences)
+        self.assertEqual([3, 5, 5], silences)
+    
+    def test_synthesize_sequences(self):
+        sequences = [[5, 3, 7, 8, 2], [4, 3], [9, 11, 4, 3, 2, 7, 8], [6], [3, 3, 3]]
+        silences = [3, 3, 5, 3, 5]
+        mels = list(self.synthesizer.synthesize_sequences(sequences, silences))
+        self.assertEqual(len(sequences), len(mels))
+        for sequence, silence, mel in zip(sequences, silences, mels):
+            expected = self.model.predict_batch([sequence], encode=False)[0]
+            self.assertEqual(expected.shape[0] + silence, mel.shape[0])
+            np.testing.assert_array_equal(-1., mel[-silence:])
+    
+    def test_one_window_ahead(self):
+        predicted = []
+        predict = self.synthesizer._predict
+        self.synthesizer._predict = lambda batch: predicted.append(batch) or predict(batch)
+        sequences = [[5, 3, 7], [4, 3], [9, 11, 4]] * 4
+        mels = self.synthesizer.synthesize_sequences(sequences, [3] * len(sequences))
+        next(mels)
+        mels.close()
+        # the first window of two batches, and at most the two batches of the next one
+        self.assertLessEqual(len(predicted), 4)
+        self.assertGreaterEqual(len(predicted), 2)
@@ -0,0 +1,32 @@
+import unittest
+
+import tensorflow as tf
+
+from model.encoder_cache import EncoderCache
+
+
+class TestEncoderCache(unittest.TestCase):
+    
+    def test_entry_eviction(self):
+        cache = EncoderCache(max_entries=2)
+        for i in range(3):
+            cache.put(cache.make_key([i], 0, 0), tf.zeros((1, 4)))
+        cache.get(cache.make_key([1], 0, 0))
+        cache.put(cache.make_key([3], 0, 0), tf.zeros((1, 4)))
+        self.assertEqual(2, len(cache))
+        self.assertIsNone(cache.get(cache.make_key([0], 0, 0)))
+        self.assertIsNone(cache.get(cache.make_key([2], 0, 0)))
+        self.assertIsNotNone(cache.get(cache.make_key([1], 0, 0)))
+    
+    def test_byte_eviction(self):
+        cache = EncoderCache(max_bytes=40)
+        cache.put(cache.make_key([1, 2], 0, 0), (tf.zeros((1, 4)), tf.zeros((1, 4))))
+        self.assertEqual(32, cache.nbytes)
+        cache.put(cache.make_key([1, 2], 1, 0), tf.zeros((1, 4)))
+        self.assertEqual(1, len(cache))
+        self.assertEqual(16, cache.nbytes)
+    
+    def test_key(self):
+        cache = EncoderCache(max_entries=1)
+        self.assertEqual(cache.make_key(tf.constant([[1, 2]]), 0, 3), cache.make_key([1, 2], 0, 3))
+        self.assertNotEqual(cache.make_key([1, 2], 0, 3), cache.make_key([1, 2], 0, 4))
@@ -0,0 +1,45 @@
+import tempfile
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+from tests.test_models import set_constant_durations, small_autoregressive_model, small_forward_model, never_stop
+from utils.export import export_saved_model, load_saved_model
+
+
+class TestExport(unittest.TestCase):
+    
+    def setUp(self):
+        tf.random.set_seed(42)
+        self.inp = tf.constant([5, 3, 7, 8, 2, 9, 11, 4, 3], dtype=tf.int32)
+    
+    def test_forward_export(self):
+        model = small_forward_model()
+        set_constant_durations(model, self.inp[tf.newaxis])
+        out = model.forward(self.inp[tf.newaxis], durations_scalar=tf.constant(1.))
+        with tempfile.TemporaryDirectory() as export_dir:
+            export_saved_model(model, export_dir)
+            loaded = load_saved_model(export_dir)
+            loaded_out = loaded.signatures['forward'](input_sequence=self.inp[tf.newaxis],
+                                                      durations_scalar=tf.constant(1.))
+            vocab = loaded.vocab.numpy()
+        np.testing.assert_allclose(out['mel'], loaded_out['mel'], atol=1e-5)
+        self.assertEqual(model.text_pipeline.tokenizer.vocab_size, len(vocab))
+        self.assertEqual(model.text_pipeline.tokenizer('aʊ b'), loaded.tokenize(tf.constant('aʊ b')).numpy().tolist())
+    
+    def test_autoregressive_export(self):
+        model = small_autoregressive_model()
+        model.predict(self.inp, max_length=3, encode=False, verbose=False)
+        never_stop(model)
+        out = model.generate(self.inp, 12)
+        with tempfile.TemporaryDirectory() as export_dir:
+            export_saved_model(model, export_dir)
+            loaded = load_saved_model(export_dir)
+            loaded_out = loaded.signatures['generate'](inp=self.inp, max_length=tf.constant(12))
+            encoder_out = loaded.encoder(self.inp[tf.newaxis])
+            cache = loaded.init_decoder_cache(encoder_out['encoder_output'])
+            step_out = loaded.decoder_step(tf.convert_to_tensor(loaded.start_vec)[tf.newaxis], encoder_out['padding_mask'], cache)
+        np.testing.assert_allclose(out['mel'], loaded_out['mel'], atol=1e-5)
+        np.testing.assert_allclose(out['mel'][:model.r], step_out['final_output'][0], atol=1e-5)
+        self.assertEqual(model.text_pipeline.tokenizer('ab'), loaded.tokenize(tf.constant('ab')).numpy().tolist())
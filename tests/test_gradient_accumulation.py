@@ -0,0 +1,81 @@
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+from model.models import GradientAccumulator
+from tests.test_models import small_forward_model
+from utils.distribution import DistributedSteps
+from utils.gradient_accumulation import GradientAccumulation
+
+
+def accumulating_model(model):
+    model.gradient_accumulation = True
+    model.gradient_accumulator = GradientAccumulator()
+    model._apply_all_signatures()
+    return model
+
+
+class TestGradientAccumulator(unittest.TestCase):
+    
+    def setUp(self):
+        tf.random.set_seed(42)
+        np.random.seed(42)
+        self.phonemes = tf.constant(np.random.randint(1, 10, size=(2, 5)), dtype=tf.int32)
+        self.mel = tf.constant(np.random.normal(size=(2, 10, 8)), dtype=tf.float32)
+        self.durations = tf.constant(np.full((2, 5), 2), dtype=tf.int32)
+        # the batch normalization statistics differ between batches, so the steps repeat the same batch
+        self.model = small_forward_model()
+        self.accumulating_model = accumulating_model(small_forward_model())
+        for model in [self.model, self.accumulating_model]:
+            model._compile(optimizer=tf.keras.optimizers.SGD(learning_rate=.1))
+            for layer in model.submodules:
+                if isinstance(layer, tf.keras.layers.Dropout):
+                    layer.rate = 0.
+            model._val_step(self.phonemes, self.mel, self.durations)
+        self.accumulating_model.set_weights(self.model.get_weights())
+    
+    def test_accumulate_step(self):
+        weights = [v.numpy() for v in self.accumulating_model.trainable_variables]
+        self.accumulating_model.accumulate_step(self.phonemes, self.mel, self.durations)
+        self.assertEqual(0, self.accumulating_model.step)
+        for weight, variable in zip(weights, self.accumulating_model.trainable_variables):
+            np.testing.assert_array_equal(weight, variable.numpy())
+        self.assertEqual(20., float(self.accumulating_model.gradient_accumulator.frames))
+    
+    def test_train_step(self):
+        """ Applying the mean of the accumulated gradients of a batch is one step on the batch. """
+        self.model.train_step(self.phonemes, self.mel, self.durations)
+        for _ in range(2):
+            self.accumulating_model.accumulate_step(self.phonemes, self.mel, self.durations)
+        self.accumulating_model.train_step(self.phonemes, self.mel, self.durations)
+        self.assertEqual(1, self.accumulating_model.step)
+        for variable, accumulating_variable in zip(self.model.trainable_variables,
+                                                   self.accumulating_model.trainable_variables):
+            np.testing.assert_allclose(variable.numpy(), accumulating_variable.numpy(), atol=1e-6)
+        self.assertEqual(0., float(self.accumulating_model.gradient_accumulator.frames))
+        for accumulated in self.accumulating_model.gradient_accumulator.gradients:
+            self.assertEqual(0., float(tf.reduce_sum(tf.abs(accumulated))))
+
+
+class TestGradientAccumulation(unittest.TestCase):
+    
+    def setUp(self):
+        self.distributed_steps = DistributedSteps(tf.distribute.get_strategy())
+    
+    def test_bucket_accumulation_steps(self):
+        accumulation = GradientAccumulation(bucket_boundaries=[10, 20], bucket_accumulation_steps=[1, 2, 3])
+        apply = [accumulation.apply_gradients(tf.zeros((2, mel_len, 8)), self.distributed_steps)
+                 for mel_len in [9, 15, 15, 19, 25, 25, 25]]
+        self.assertEqual([True, False, True, False, False, True, False], apply)
+    
+    def test_frame_budget(self):
+        accumulation = GradientAccumulation(bucket_boundaries=[10, 20], frame_budget=40)
+        apply = [accumulation.apply_gradients(tf.zeros((batch_size, mel_len, 8)), self.distributed_steps)
+                 for batch_size, mel_len in [(2, 9), (2, 9), (2, 19), (1, 25), (4, 9)]]
+        self.assertEqual([False, False, True, False, True], apply)
+    
+    def test_disabled(self):
+        accumulation = GradientAccumulation(bucket_boundaries=[10, 20])
+        self.assertFalse(accumulation.enabled)
+        self.assertTrue(accumulation.apply_gradients(tf.zeros((2, 9, 8)), self.distributed_steps))
@@ -0,0 +1,80 @@
+import tempfile
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+from model.layers import MultiHeadAttention
+from tests.test_models import set_constant_durations, small_autoregressive_model, small_forward_model
+from utils.config_manager import Config
+from utils.head_pruning import attention_layers, score_heads, prune_heads
+
+
+class TestHeadPruning(unittest.TestCase):
+    
+    def setUp(self):
+        tf.random.set_seed(42)
+        self.inp = tf.constant([[5, 3, 7, 8, 2, 9, 11, 4, 3], [4, 3, 2, 0, 0, 0, 0, 0, 0]], dtype=tf.int32)
+    
+    def test_prune_heads(self):
+        mha = MultiHeadAttention(model_dim=16, num_heads=4)
+        x = tf.random.normal((2, 5, 16))
+        mha(x, x, x, mask=None, training=False, drop_n_heads=0)
+        # without the output weights of head 1, the other heads give the same output
+        kernel = mha.dense.kernel.numpy()
+        kernel[16 + 4:16 + 8] = 0.
+        mha.dense.kernel.assign(kernel)
+        out, weights = mha(x, x, x, mask=None, training=False, drop_n_heads=0)
+        mha.prune_heads([1])
+        pruned_out, pruned_weights = mha(x, x, x, mask=None, training=False, drop_n_heads=0)
+        self.assertEqual(3, mha.num_heads)
+        self.assertEqual((16, 12), tuple(mha.wq.kernel.shape))
+        self.assertEqual((28, 16), tuple(mha.dense.kernel.shape))
+        np.testing.assert_allclose(out, pruned_out, atol=1e-5)
+        np.testing.assert_allclose(tf.gather(weights, [0, 2, 3], axis=1), pruned_weights, atol=1e-6)
+    
+    def test_forward_model(self):
+        model = small_forward_model()
+        set_constant_durations(model, self.inp)
+        mel = tf.random.normal((2, 18, 8))
+        durations = tf.constant([[2] * 9, [2] * 3 + [0] * 6], dtype=tf.int32)
+        scores, loss = score_heads(model, [(mel, self.inp, durations)])
+        self.assertEqual(4, len(scores))
+        for name, layer_scores in scores.items():
+            self.assertEqual((2,), layer_scores.shape)
+        n_variables = np.sum([np.prod(v.shape) for v in model.variables])
+        pruned = prune_heads(model, scores, n_heads=1)
+        self.assertTrue(all(len(heads) == 1 for heads in pruned.values()))
+        self.assertLess(np.sum([np.prod(v.shape) for v in model.variables]), n_variables)
+        _, pruned_loss = score_heads(model, [(mel, self.inp, durations)])
+        self.assertTrue(np.isfinite(pruned_loss))
+        out = model.predict(self.inp[:1], encode=False)
+        self.assertEqual((18, 8), tuple(out['mel'].shape))
+    
+    def test_autoregressive_model(self):
+        model = small_autoregressive_model()
+        mel = tf.random.normal((2, 13, 8))
+        stop = tf.zeros((2, 13))
+        scores, loss = score_heads(model, [(mel, self.inp, stop)])
+        # self- and cross-attention of each decoder block
+        self.assertEqual(6, len(scores))
+        prune_heads(model, scores, n_heads=1)
+        full = model.predict(self.inp[0], max_length=6, encode=False, verbose=False)
+        cached = model.predict(self.inp[0], max_length=6, encode=False, verbose=False, use_cache=True)
+        np.testing.assert_allclose(full['mel'], cached['mel'], atol=1e-4)
+    
+    def test_save_load_pruned_weights(self):
+        config = Config(config_path='config/melgan', model_kind='forward')
+        model = config.get_model(ignore_hash=True)
+        config.compile_model(model)
+        set_constant_durations(model, self.inp[:1])
+        model.forward(self.inp[:1], durations_scalar=tf.constant(1.))
+        prune_heads(model, {name: np.arange(mha.num_heads) for name, (mha, _, _) in attention_layers(model).items()})
+        out = model.forward(self.inp[:1], durations_scalar=tf.constant(1.))
+        with tempfile.TemporaryDirectory() as weights_dir:
+            weights_path = config.save_inference_weights(model, f'{weights_dir}/inference')
+            loaded = config.load_inference_model(weights_path, verbose=False)
+            loaded_out = loaded.forward(self.inp[:1], durations_scalar=tf.constant(1.))
+        self.assertEqual([mha.num_heads for mha, _, _ in attention_layers(model).values()],
+                         [mha.num_heads for mha, _, _ in attention_layers(loaded).values()])
+        np.testing.assert_allclose(out['mel'], loaded_out['mel'], atol=1e-5)
@@ -0,0 +1,58 @@
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+from tests.test_models import set_constant_durations, small_autoregressive_model, small_forward_model
+from utils.inference_optimization import optimize_and_verify
+
+
+def randomize_batch_normalization(model):
+    """ Non-trivial moving statistics, as after training. """
+    for layer in model.submodules:
+        if isinstance(layer, tf.keras.layers.BatchNormalization):
+            for variable in [layer.gamma, layer.beta, layer.moving_mean]:
+                variable.assign(tf.random.normal(variable.shape, stddev=.5))
+            layer.moving_variance.assign(tf.random.uniform(layer.moving_variance.shape, .5, 2.))
+
+
+class TestInferenceOptimization(unittest.TestCase):
+    
+    def setUp(self):
+        tf.random.set_seed(42)
+        self.inp = tf.constant([[5, 3, 7, 8, 2, 9, 11, 4, 3]], dtype=tf.int32)
+    
+    def test_forward_model(self):
+        model = small_forward_model()
+        set_constant_durations(model, self.inp)
+        model.predict(self.inp, encode=False)
+        randomize_batch_normalization(model)
+        report = optimize_and_verify(model, self.inp, n_runs=2)
+        self.assertLess(report['max_abs_error'], 1e-4)
+        self.assertFalse(model.decoder_prenet.inference_dropout)
+    
+    def test_forward_model_float16(self):
+        tf.keras.mixed_precision.set_global_policy('mixed_float16')
+        try:
+            model = small_forward_model()
+        finally:
+            tf.keras.mixed_precision.set_global_policy('float32')
+        set_constant_durations(model, self.inp)
+        model.predict(self.inp, encode=False)
+        randomize_batch_normalization(model)
+        report = optimize_and_verify(model, self.inp, n_runs=2)
+        self.assertLess(report['max_abs_error'], 1e-2)
+        self.assertEqual(tf.float16, model.decoder_postnet.folded_normalization[-1][0].dtype)
+    
+    def test_autoregressive_model(self):
+        model = small_autoregressive_model()
+        mel = tf.random.normal((1, 12, 8))
+        model.forward(self.inp, mel)
+        randomize_batch_normalization(model)
+        report = optimize_and_verify(model, (self.inp, mel), prenet_dropout=True, n_runs=2)
+        self.assertLess(report['max_abs_error'], 1e-4)
+        self.assertTrue(model.decoder_prenet.inference_dropout)
+        # the folded postnet keeps incremental decoding consistent
+        full = model.predict(self.inp[0], max_length=12, encode=False, verbose=False)
+        cached = model.predict(self.inp[0], max_length=12, encode=False, verbose=False, use_cache=True)
+        np.testing.assert_allclose(full['mel'], cached['mel'], atol=1e-3)
@@ -0,0 +1,74 @@
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+from model.layers import Expand, HeadDrop, Postnet
+
+
+class TestExpand(unittest.TestCase):
+    
+    def setUp(self):
+        self.expand = Expand(model_dim=4)
+        self.x = tf.random.normal((3, 5, 4), seed=1)
+        self.durations = tf.constant([[1., 3., 0., 2., 1.], [4., 0., 0., 1., 0.], [0., 0., 0., 1.2, 8.7]])[..., None]
+    
+    def test_output(self):
+        out = self.expand(self.x, self.durations)
+        rounded = np.round(self.durations.numpy()[..., 0]).astype(int)
+        self.assertEqual((3, 10, 4), out.shape)
+        for i in range(3):
+            expected = np.repeat(self.x[i].numpy(), rounded[i], axis=0)
+            np.testing.assert_array_equal(expected, out[i, :len(expected)])
+            np.testing.assert_array_equal(0., out[i, len(expected):])
+    
+    def test_gradients(self):
+        with tf.GradientTape() as tape:
+            tape.watch(self.x)
+            out = self.expand(self.x, self.durations)
+        grads = tape.gradient(out, self.x)
+        np.testing.assert_array_equal(np.round(self.durations.numpy()), grads[..., :1])
+    
+    def test_max_length(self):
+        out = self.expand(self.x, self.durations)
+        for max_length in [12, 7]:
+            static = tf.function(self.expand, jit_compile=True)(self.x, self.durations, max_length=max_length)
+            self.assertEqual((3, max_length, 4), static.shape)
+            np.testing.assert_array_equal(out[:, :max_length], static[:, :10])
+            np.testing.assert_array_equal(0., static[:, 10:])
+
+
+class TestHeadDrop(unittest.TestCase):
+    
+    def test_drop_n_heads(self):
+        head_drop = HeadDrop()
+        batch = tf.ones((8, 4, 3, 2))
+        drop = tf.function(lambda n: head_drop(batch, training=True, drop_n_heads=n))
+        for n in [0, 1, 3, 5]:
+            out = drop(tf.constant(n)).numpy()
+            kept = min(n, 3)
+            # every sample keeps 4 - n heads, scaled by 4 / (4 - n)
+            np.testing.assert_array_equal(4 - kept, np.sum(out[:, :, 0, 0] > 0, axis=-1))
+            np.testing.assert_allclose(4 / (4 - kept), np.max(out, axis=(1, 2, 3)))
+        self.assertEqual(1, drop.experimental_get_tracing_count())
+        np.testing.assert_array_equal(batch, head_drop(batch, training=False, drop_n_heads=2))
+
+
+class TestPostnet(unittest.TestCase):
+    
+    def setUp(self):
+        tf.random.set_seed(42)
+        self.postnet = Postnet(mel_channels=4, conv_filters=8, conv_layers=3, kernel_size=5)
+        self.mel = tf.random.normal((2, 12, 4), seed=1)
+        self.full = self.postnet(self.mel, training=False)
+    
+    def test_step(self):
+        # r new frames per decoding step
+        for r in [1, 3, 4]:
+            cache = self.postnet.init_cache(batch_size=2)
+            outputs = []
+            for start in range(0, 12, r):
+                out, cache = self.postnet.step(self.mel[:, start:start + r], cache)
+                outputs.append(out)
+            for key, value in self.full.items():
+                np.testing.assert_allclose(value, tf.concat([out[key] for out in outputs], axis=1), atol=1e-5)
@@ -0,0 +1,353 @@
+import unittest
+from unittest import mock
+
+import numpy as np
+import tensorflow as tf
+
+from model.layers import Expand
+from model.models import AutoregressiveTransformer, ForwardTransformer
+
+
+def small_autoregressive_model():
+    model = AutoregressiveTransformer(encoder_model_dimension=32,
+                                      decoder_model_dimension=32,
+                                      encoder_num_heads=[2, 2],
+                                      decoder_num_heads=[2, 2],
+                                      encoder_maximum_position_encoding=100,
+                                      decoder_maximum_position_encoding=1000,
+                                      encoder_dense_blocks=2,
+                                      decoder_dense_blocks=1,
+                                      encoder_prenet_dimension=32,
+                                      decoder_prenet_dimension=16,
+                                      postnet_conv_filters=16,
+                                      postnet_conv_layers=3,
+                                      postnet_kernel_size=5,
+                                      dropout_rate=0.1,
+                                      mel_start_value=.5,
+                                      mel_end_value=-.5,
+                                      mel_channels=8,
+                                      phoneme_language='en',
+                                      with_stress=False,
+                                      encoder_attention_conv_filters=16,
+                                      decoder_attention_conv_filters=16,
+                                      encoder_attention_conv_kernel=3,
+                                      decoder_attention_conv_kernel=3,
+                                      encoder_feed_forward_dimension=16,
+                                      decoder_feed_forward_dimension=16,
+                                      decoder_prenet_dropout=0.,
+                                      max_r=3)
+    model._compile(stop_scaling=1., optimizer=tf.keras.optimizers.Adam())
+    return model
+
+
+def small_forward_model():
+    model = ForwardTransformer(encoder_model_dimension=32,
+                               decoder_model_dimension=32,
+                               dropout_rate=0.1,
+                               decoder_num_heads=[2, 2],
+                               encoder_num_heads=[2, 2],
+                               encoder_maximum_position_encoding=100,
+                               decoder_maximum_position_encoding=1000,
+                               postnet_conv_filters=16,
+                               postnet_conv_layers=2,
+                               postnet_kernel_size=5,
+                               encoder_dense_blocks=1,
+                               decoder_dense_blocks=1,
+                               mel_channels=8,
+                               phoneme_language='en',
+                               with_stress=False,
+                               encoder_attention_conv_filters=16,
+                               decoder_attention_conv_filters=16,
+                               encoder_attention_conv_kernel=3,
+                               decoder_attention_conv_kernel=3,
+                               encoder_feed_forward_dimension=16,
+                               decoder_feed_forward_dimension=16)
+    model._compile(optimizer=tf.keras.optimizers.Adam())
+    return model
+
+
+def set_constant_durations(model, inp, duration=2.):
+    """ Constant durations, so that the mel lengths do not depend on the random initialization or padding. """
+    # builds the encoder and duration predictor only, since random durations can round to an empty mel
+    model.forward_durations(inp, durations_scalar=tf.constant(1.))
+    dur_linear = model.dur_pred.linear
+    dur_linear.kernel.assign(tf.zeros_like(dur_linear.kernel))
+    dur_linear.bias.assign([duration])
+
+
+def never_stop(model):
+    """ Forces the stop token prediction to never fire, so that prediction runs until max_length. """
+    stop_linear = model.decoder_postnet.stop_linear
+    stop_linear.kernel.assign(tf.zeros_like(stop_linear.kernel))
+    stop_linear.bias.assign([0., 10., -10.])
+
+
+class TestAutoregressiveTransformer(unittest.TestCase):
+    
+    def setUp(self):
+        tf.random.set_seed(42)
+        self.model = small_autoregressive_model()
+        self.inp = np.array([5, 3, 7, 8, 2, 9, 11, 4, 3])
+        self.model.predict(self.inp, max_length=3, encode=False, verbose=False)
+        never_stop(self.model)
+    
+    def test_cached_prediction(self):
+        for r in [3, 1]:
+            self.model.set_constants(reduction_factor=r)
+            full = self.model.predict(self.inp, max_length=30, encode=False, verbose=False)
+            cached = self.model.predict(self.inp, max_length=30, encode=False, verbose=False, use_cache=True)
+            self.assertEqual(full['mel'].shape, cached['mel'].shape)
+            np.testing.assert_allclose(full['mel'], cached['mel'], atol=1e-3)
+            for key in full['decoder_attention'].keys():
+                np.testing.assert_allclose(full['decoder_attention'][key], cached['decoder_attention'][key],
+                                           atol=1e-3)
+    
+    def test_schedule_without_retracing(self):
+        mel = tf.random.normal((1, 13, 8))
+        stop = tf.zeros((1, 13), dtype=tf.int32)
+        train_step = self.model.train_step
+        train_step(self.inp[None], mel, stop)
+        tracing_count = train_step.experimental_get_tracing_count()
+        self.model.set_constants(drop_n_heads=1)
+        train_step(self.inp[None], mel, stop)
+        self.assertEqual(tracing_count, train_step.experimental_get_tracing_count())
+        self.model.set_constants(reduction_factor=2)
+        self.assertIsNot(train_step, self.model.train_step)
+        self.model.set_constants(reduction_factor=self.model.max_r)
+        self.assertIs(train_step, self.model.train_step)
+    
+    def test_traced_schedule(self):
+        def tracing_counts():
+            return {f'{key}/{name}': function.experimental_get_tracing_count()
+                    for key, functions in self.model._traced_functions.items()
+                    for name, function in functions.items()}
+        
+        self.model.trace_reduction_factors([3, 2, 1])
+        traced = tracing_counts()
+        self.assertEqual(3 * 9, len(traced))
+        mel = tf.random.normal((1, 12, 8))
+        stop = tf.zeros((1, 12), dtype=tf.int32)
+        for r in [3, 2, 1]:
+            self.model.set_constants(reduction_factor=r)
+            self.model.train_step(self.inp[None], mel, stop)
+            self.model.val_step(self.inp[None], mel, stop)
+            self.model.predict(self.inp, max_length=6, encode=False, verbose=False)
+            self.model.predict(self.inp, max_length=6, encode=False, verbose=False, use_cache=True)
+            self.model.generate(tf.constant(self.inp, dtype=tf.int32), 6)
+        self.assertEqual(traced, tracing_counts())
+    
+    def test_generate(self):
+        full = self.model.predict(self.inp, max_length=30, encode=False, verbose=False)
+        generated = self.model.generate(tf.constant(self.inp, dtype=tf.int32), 30)
+        self.assertEqual(full['mel'].shape, generated['mel'].shape)
+        np.testing.assert_allclose(full['mel'], generated['mel'], atol=1e-3)
+        for key in full['decoder_attention'].keys():
+            np.testing.assert_allclose(full['decoder_attention'][key], generated['decoder_attention'][key],
+                                       atol=1e-3)
+    
+    def test_predict_batch(self):
+        stop_linear = self.model.decoder_postnet.stop_linear
+        stop_linear.kernel.assign(tf.random.normal(stop_linear.kernel.shape, seed=3))
+        stop_linear.bias.assign([0., 0., -2.])
+        self.model.set_constants(reduction_factor=1)
+        sequences = [self.inp, self.inp[:3], self.inp[2:]]
+        batch_outputs = self.model.predict_batch(sequences, max_length=30, encode=False)
+        for sequence, batch_out in zip(sequences, batch_outputs):
+            out = self.model.predict(sequence, max_length=30, encode=False, verbose=False)
+            self.assertEqual(out['mel'].shape, batch_out['mel'].shape)
+            np.testing.assert_allclose(out['mel'], batch_out['mel'], atol=1e-3)
+    
+    def test_attention_window(self):
+        self.model.set_constants(reduction_factor=1)
+        self.model.set_attention_window(1)
+        out = self.model.generate(tf.constant(self.inp, dtype=tf.int32), 20)
+        for attention in out['decoder_attention'].values():
+            attended_positions = tf.reduce_sum(tf.cast(attention > 1e-6, tf.int32), axis=-1)
+            self.assertLessEqual(int(tf.reduce_max(attended_positions)), 3)
+        # predict decodes incrementally with an attention window, also without use_cache
+        out = self.model.predict(self.inp, max_length=20, encode=False, verbose=False)
+        cached = self.model.predict(self.inp, max_length=20, encode=False, verbose=False, use_cache=True)
+        np.testing.assert_allclose(cached['mel'], out['mel'], atol=1e-5)
+        for attention in out['decoder_attention'].values():
+            attended_positions = tf.reduce_sum(tf.cast(attention > 1e-6, tf.int32), axis=-1)
+            self.assertLessEqual(int(tf.reduce_max(attended_positions)), 3)
+    
+    def test_predict_stream(self):
+        cached = self.model.predict(self.inp, max_length=30, encode=False, verbose=False, use_cache=True)
+        chunks = list(self.model.predict_stream(self.inp, max_length=30, encode=False, steps_per_chunk=4))
+        self.assertEqual([12, 12, 9], [int(tf.shape(chunk)[0]) for chunk in chunks])
+        np.testing.assert_allclose(cached['mel'], tf.concat(chunks, axis=0), atol=1e-3)
+    
+    def test_encoder_cache(self):
+        uncached = self.model.predict(self.inp, max_length=30, encode=False, verbose=False, use_cache=True)
+        self.model.set_encoder_cache(max_entries=2)
+        for _ in range(2):
+            cached = self.model.predict(self.inp, max_length=30, encode=False, verbose=False, use_cache=True)
+            np.testing.assert_allclose(uncached['mel'], cached['mel'], atol=1e-3)
+        self.assertEqual(1, self.model.encoder_cache.hits)
+        self.assertEqual(1, self.model.encoder_cache.misses)
+
+
+class TestForwardTransformer(unittest.TestCase):
+    
+    def setUp(self):
+        tf.random.set_seed(42)
+        self.model = small_forward_model()
+        self.inp = tf.constant([[5, 3, 7, 8, 2, 9, 11, 4, 3]], dtype=tf.int32)
+        set_constant_durations(self.model, self.inp)
+    
+    def test_encoder_cache(self):
+        speeds = [1., 2., 1.]
+        uncached = [self.model.predict(self.inp, encode=False, speed_regulator=speed) for speed in speeds]
+        self.model.set_encoder_cache(max_entries=4)
+        cached = [self.model.predict(self.inp, encode=False, speed_regulator=speed) for speed in speeds]
+        for out, cached_out in zip(uncached, cached):
+            self.assertEqual(out['mel'].shape, cached_out['mel'].shape)
+            np.testing.assert_allclose(out['mel'], cached_out['mel'], atol=1e-5)
+        self.assertEqual(2, self.model.encoder_cache.hits)
+        self.assertEqual(1, self.model.encoder_cache.misses)
+    
+    def test_encoder_cache_new_weights(self):
+        self.model.set_encoder_cache(max_entries=4)
+        self.model.predict(self.inp, encode=False)
+        other_model = small_forward_model()
+        set_constant_durations(other_model, self.inp)
+        expected = other_model.predict(self.inp, encode=False)
+        self.model.set_weights(other_model.get_weights())
+        out = self.model.predict(self.inp, encode=False)
+        self.assertEqual(0, self.model.encoder_cache.hits)
+        self.assertEqual(2, self.model.encoder_cache.misses)
+        np.testing.assert_allclose(expected['mel'], out['mel'], atol=1e-5)
+    
+    def test_predict_speeds(self):
+        speeds = [1., 2., .5]
+        mels = self.model.predict_speeds(self.inp, speeds, encode=False)
+        for speed, mel in zip(speeds, mels):
+            out = self.model.predict(self.inp, encode=False, speed_regulator=speed)
+            self.assertEqual(out['mel'].shape, mel.shape)
+            np.testing.assert_allclose(out['mel'], mel, atol=1e-5)
+    
+    def test_predict_batch(self):
+        sequences = [self.inp[0], self.inp[0, :3], self.inp[0, ::-1], self.inp[0, 3:6], self.inp[0, :5],
+                     self.inp[0, 4:], self.inp[0, :1]]
+        outputs = [self.model.predict(sequence[tf.newaxis], encode=False) for sequence in sequences]
+        # independent of the padding and the composition of the batches
+        for batch_size in [2, 4]:
+            mels = self.model.predict_batch(sequences, batch_size=batch_size, encode=False)
+            for out, mel in zip(outputs, mels):
+                self.assertEqual(out['mel'].shape, mel.shape)
+                np.testing.assert_allclose(out['mel'], mel, atol=1e-5)
+    
+    def test_predict_long(self):
+        out = self.model.predict(self.inp, encode=False)
+        single_window = self.model.predict_long(self.inp, window=18, overlap=4, encode=False)
+        np.testing.assert_allclose(out['mel'], single_window['mel'], atol=1e-5)
+        windowed = self.model.predict_long(self.inp, window=8, overlap=3, batch_size=2, encode=False)
+        self.assertEqual(out['mel'].shape, windowed['mel'].shape)
+        np.testing.assert_allclose(out['duration'], windowed['duration'], atol=1e-5)
+    
+    def test_predict_long_interior(self):
+        # without self-attention and position encodings, the decoder only sees the neighbouring frames, so that
+        # the windows match predict but for the frames within its receptive field (6) of the window boundaries
+        set_constant_durations(self.model, self.inp, duration=4.)
+        self.model.predict(self.inp, encode=False)
+        self.model.decoder.pos_encoding_scalar.assign(0.)
+        for block in self.model.decoder.encoder_SADB + self.model.decoder.encoder_SACB:
+            block.sarn.mha.dense.kernel.assign(tf.zeros_like(block.sarn.mha.dense.kernel))
+            block.sarn.mha.dense.bias.assign(tf.zeros_like(block.sarn.mha.dense.bias))
+        out = self.model.predict(self.inp, encode=False)
+        windowed = self.model.predict_long(self.inp, window=32, overlap=16, batch_size=1, encode=False)
+        self.assertEqual((36, 8), tuple(windowed['mel'].shape))
+        # the second window starts at frame 16, the first ends at frame 32
+        interior = np.r_[0:16, 22:26, 32:36]
+        np.testing.assert_allclose(out['mel'].numpy()[interior], windowed['mel'].numpy()[interior], atol=1e-5)
+    
+    def test_training_expand_length(self):
+        mel = tf.random.normal((1, 18, 8))
+        durations = tf.constant([[2] * 9], dtype=tf.int32)
+        for jit_compile in [False, True]:
+            self.model.jit_compile = jit_compile
+            self.model._apply_all_signatures()
+            with mock.patch.object(Expand, 'call', autospec=True, side_effect=Expand.call) as expand_call:
+                self.model.train_step(self.inp, mel, durations)
+                self.model.val_step(self.inp, mel, durations)
+            # only XLA needs the static length, tf.repeat allocates just the expanded frames
+            static_lengths = [call.kwargs.get('max_length') is not None for call in expand_call.call_args_list]
+            self.assertGreaterEqual(len(static_lengths), 2)
+            self.assertEqual([jit_compile] * len(static_lengths), static_lengths)
+    
+    def test_predict_durations(self):
+        sequences = [self.inp[0], self.inp[0, :3], self.inp[0, 2:]]
+        durations = self.model.predict_durations(sequences, batch_size=2, speed_regulator=.5, encode=False)
+        mels = self.model.predict_batch(sequences, batch_size=2, speed_regulator=.5, encode=False)
+        for sequence, duration, mel in zip(sequences, durations, mels):
+            np.testing.assert_array_equal(4, duration['duration'])
+            self.assertEqual(len(sequence), len(duration['duration']))
+            self.assertEqual(mel.shape[0], duration['mel_length'])
+
+
+class TestMixedPrecision(unittest.TestCase):
+    
+    def setUp(self):
+        tf.random.set_seed(42)
+        self.inp = tf.constant([[5, 3, 7, 8, 2, 9, 11, 4, 3], [4, 3, 2, 0, 0, 0, 0, 0, 0]], dtype=tf.int32)
+    
+    def tearDown(self):
+        tf.keras.mixed_precision.set_global_policy('float32')
+    
+    def test_forward_model_float16(self):
+        tf.keras.mixed_precision.set_global_policy('mixed_float16')
+        model = small_forward_model()
+        model._compile(optimizer=tf.keras.mixed_precision.LossScaleOptimizer(tf.keras.optimizers.Adam()))
+        set_constant_durations(model, self.inp)
+        self.assertEqual(tf.float16, model.dur_pred.linear.compute_dtype)
+        self.assertEqual(tf.float32, model.dur_pred.linear.kernel.dtype)
+        durations = tf.constant([[2] * 9, [2] * 3 + [0] * 6], dtype=tf.int32)
+        model_out = model.train_step(self.inp, tf.random.normal((2, 18, 8)), durations)
+        self.assertEqual(tf.float32, model_out['loss'].dtype)
+        self.assertTrue(np.isfinite(model_out['loss']))
+        self.assertEqual(1, int(model.optimizer.iterations))
+        out = model.predict(self.inp[:1], encode=False)
+        self.assertEqual(tf.float32, out['mel'].dtype)
+        self.assertEqual((18, 8), tuple(out['mel'].shape))
+    
+    def test_autoregressive_model_bfloat16(self):
+        tf.keras.mixed_precision.set_global_policy('mixed_bfloat16')
+        model = small_autoregressive_model()
+        model_out = model.train_step(self.inp, tf.random.normal((2, 13, 8)), tf.zeros((2, 13), dtype=tf.int32))
+        self.assertTrue(np.isfinite(model_out['loss']))
+        never_stop(model)
+        full = model.predict(self.inp[0], max_length=6, encode=False, verbose=False)
+        cached = model.predict(self.inp[0], max_length=6, encode=False, verbose=False, use_cache=True)
+        self.assertEqual(tf.float32, full['mel'].dtype)
+        self.assertEqual(full['mel'].shape, cached['mel'].shape)
+        # the padded positions are masked with -1e9 in float32, so that no attention leaks onto them
+        for attention in full['decoder_attention'].values():
+            self.assertEqual(tf.float32, attention.dtype)
+    
+    def test_autoregressive_cached_decoding_float16(self):
+        tf.keras.mixed_precision.set_global_policy('mixed_float16')
+        model = small_autoregressive_model()
+        model.set_constants(reduction_factor=1)
+        model.predict(self.inp[0], max_length=3, encode=False, verbose=False)
+        never_stop(model)
+        full = model.predict(self.inp[0], max_length=10, encode=False, verbose=False)
+        cached = model.predict(self.inp[0], max_length=10, encode=False, verbose=False, use_cache=True)
+        self.assertEqual(tf.float32, cached['mel'].dtype)
+        self.assertEqual(full['mel'].shape, cached['mel'].shape)
+        # the decoding paths round differently in float16
+        np.testing.assert_allclose(full['mel'], cached['mel'], atol=1e-1)
+        batch_outputs = model.predict_batch([self.inp[0], self.inp[1, :3]], max_length=10, encode=False)
+        np.testing.assert_allclose(cached['mel'], batch_outputs[0]['mel'], atol=1e-1)
+    
+    def test_forward_predict_batch_float16(self):
+        tf.keras.mixed_precision.set_global_policy('mixed_float16')
+        model = small_forward_model()
+        set_constant_durations(model, self.inp)
+        sequences = [self.inp[0], self.inp[1, :3]]
+        mels = model.predict_batch(sequences, encode=False)
+        for sequence, mel in zip(sequences, mels):
+            out = model.predict(sequence[tf.newaxis], encode=False)
+            self.assertEqual(tf.float32, mel.dtype)
+            self.assertEqual(out['mel'].shape, mel.shape)
+            np.testing.assert_allclose(out['mel'], mel, atol=5e-2)
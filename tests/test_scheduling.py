@@ -0,0 +1,23 @@
+import unittest
+
+import numpy as np
+
+from utils.scheduling import piecewise_linear, reduction_schedule, PiecewiseLinearSchedule, StepSchedule
+
+
+class TestSchedules(unittest.TestCase):
+    
+    def test_piecewise_linear_schedule(self):
+        schedule = [[0, 0.], [25_000, 0.], [35_000, .5], [35_000, .2], [50_000, 1e-4]]
+        x, y = np.array(schedule)[:, 0], np.array(schedule)[:, 1]
+        precompiled = PiecewiseLinearSchedule(schedule)
+        for step in [0, 10, 25_000, 30_000, 34_999, 35_000, 40_000, 50_000, 90_000]:
+            self.assertAlmostEqual(piecewise_linear(step, x, y), precompiled(step), places=6)
+    
+    def test_step_schedule(self):
+        schedule = [[0, 10], [80_000, 5], [150_000, 3], [250_000, 1]]
+        precompiled = StepSchedule(schedule)
+        expected = {0: 10, 79_999: 10, 80_000: 5, 200_000: 3, 250_000: 1, 900_000: 1}
+        for step, value in expected.items():
+            self.assertEqual(value, precompiled(step))
+            self.assertEqual(value, reduction_schedule(step, schedule))
@@ -0,0 +1,74 @@
+import json
+import asyncio
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+from tests.test_models import set_constant_durations, small_forward_model
+from utils.synthesis_server import BatchingSynthesizer, SynthesisServer
+
+
+async def request(port, method, path, body=None):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    body = json.dumps(body).encode() if body is not None else b''
+    writer.write(f'{method} {path} HTTP/1.1\r\nContent-Length: {len(body)}\r\n\r\n'.encode() + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    headers, content = response.split(b'\r\n\r\n', 1)
+    return headers.split(b'\r\n')[0].decode(), json.loads(content)
+
+
+class TestSynthesisServer(unittest.TestCase):
+    
+    def setUp(self):
+        tf.random.set_seed(42)
+        self.model = small_forward_model()
+        set_constant_durations(self.model, tf.constant([[5, 3, 7]]))
+        self.sequences = [[5, 3, 7, 8, 2], [4, 3], [9, 11, 4, 3, 2, 7, 8], [6]]
+    
+    def test_batched_requests(self):
+        async def run():
+            synthesizer = BatchingSynthesizer(self.model, max_batch_size=3, max_wait=1.)
+            server = SynthesisServer(synthesizer, port=0)
+            await server.start()
+            responses = await asyncio.gather(*[request(server.port, 'POST', '/synthesize', {'tokens': sequence})
+                                               for sequence in self.sequences])
+            _, metrics = await request(server.port, 'GET', '/metrics')
+            status, _ = await request(server.port, 'GET', '/unknown')
+            await server.stop()
+            return responses, metrics, status
+        
+        responses, metrics, status = asyncio.run(run())
+        for sequence, (response_status, response) in zip(self.sequences, responses):
+            self.assertEqual('HTTP/1.1 200 OK', response_status)
+            expected = self.model.predict_batch([sequence], encode=False)[0]
+            self.assertEqual(expected.shape, np.array(response['mel']).shape)
+        self.assertEqual(4, metrics['requests'])
+        self.assertEqual({'3': 1, '1': 1}, metrics['batch_sizes'])
+        self.assertEqual(0, metrics['queue_depth'])
+        self.assertEqual('HTTP/1.1 404 Not Found', status)
+    
+    def test_cancelled_request(self):
+        async def run():
+            synthesizer = BatchingSynthesizer(self.model, max_batch_size=2, max_wait=1.)
+            batching_task = synthesizer.start()
+            cancelled = asyncio.ensure_future(synthesizer.synthesize(tokens=self.sequences[0]))
+            kept = asyncio.ensure_future(synthesizer.synthesize(tokens=self.sequences[1]))
+            await asyncio.sleep(0)  # both requests are queued
+            cancelled.cancel()
+            mels = [await asyncio.wait_for(kept, 10.),
+                    await asyncio.wait_for(synthesizer.synthesize(tokens=self.sequences[2]), 10.)]
+            batching_task.cancel()
+            return mels
+        
+        mels = asyncio.run(run())
+        for sequence, mel in zip(self.sequences[1:], mels):
+            expected = self.model.predict_batch([sequence], encode=False)[0]
+            self.assertEqual(expected.shape, mel.shape)
+    
+    def test_stop_before_start(self):
+        server = SynthesisServer(BatchingSynthesizer(self.model), port=0)
+        asyncio.run(server.stop())
+        self.assertIsNone(server.batching_task)
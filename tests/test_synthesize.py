@@ -0,0 +1,44 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+from synthesize import merge_manifests, read_inputs
+
+
+class TestSynthesize(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+    
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+    
+    def write(self, name: str, content: str) -> Path:
+        path = Path(self.tmp_dir.name) / name
+        path.write_text(content, encoding='utf-8')
+        return path
+    
+    def test_read_text(self):
+        items = read_inputs(self.write('input.txt', 'First sentence.\n\nSecond sentence.\n'))
+        self.assertEqual([{'index': 0, 'id': '0', 'text': 'First sentence.'},
+                          {'index': 1, 'id': '2', 'text': 'Second sentence.'}], items)
+    
+    def test_read_jsonl(self):
+        items = read_inputs(self.write('input.jsonl', '{"id": "../a b/c", "text": "First."}\n'
+                                                      '{"text": "Second."}\n'))
+        self.assertEqual([{'index': 0, 'id': '_a_b_c', 'text': 'First.'},
+                          {'index': 1, 'id': '1', 'text': 'Second.'}], items)
+    
+    def test_read_invalid_ids(self):
+        with self.assertRaises(ValueError):
+            read_inputs(self.write('input.jsonl', '{"id": "a/b", "text": "First."}\n'
+                                                  '{"id": "a:b", "text": "Second."}\n'))
+        with self.assertRaises(ValueError):
+            read_inputs(self.write('input.jsonl', '{"id": "..", "text": "First."}\n'))
+    
+    def test_merge_manifests(self):
+        manifests = [[{'index': 2, 'id': 'c'}, {'index': 0, 'id': 'a'}], [{'index': 1, 'id': 'b'}]]
+        manifest = merge_manifests(manifests)
+        self.assertEqual([{'id': 'a'}, {'id': 'b'}, {'id': 'c'}], manifest)
+        # the worker manifests are left unchanged
+        self.assertEqual(2, manifests[0][0]['index'])
@@ -0,0 +1,26 @@
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+from tests.test_models import set_constant_durations, small_forward_model
+from utils.tflite_conversion import convert_forward_model, TFLiteForwardTransformer, mel_error
+
+
+class TestTFLiteConversion(unittest.TestCase):
+    
+    def setUp(self):
+        tf.random.set_seed(42)
+        self.model = small_forward_model()
+        self.inp = tf.constant([[5, 3, 7, 8, 2, 9, 11, 4, 3], [4, 3, 2, 0, 0, 0, 0, 0, 0]], dtype=tf.int32)
+        set_constant_durations(self.model, self.inp[:1])
+    
+    def test_conversion(self):
+        out = self.model.predict(self.inp[:1], encode=False, speed_regulator=.5)
+        for quantization, tolerance in [(None, 1e-4), ('float16', 1e-2), ('int8', 1e-1)]:
+            tflite_model = TFLiteForwardTransformer(convert_forward_model(self.model, quantization=quantization))
+            tflite_out = tflite_model.predict(self.inp[:1], encode=False, speed_regulator=.5)
+            self.assertEqual(out['mel'].shape, tflite_out['mel'].shape)
+            errors = mel_error(self.model, tflite_model, self.inp.numpy())
+            self.assertLess(errors['mel'], tolerance)
+            self.assertLess(errors['duration'], tolerance)
@@ -0,0 +1,42 @@
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+from tests.test_datasets import forward_dataset, random_sample
+from tests.test_gradient_accumulation import accumulating_model
+from tests.test_models import small_forward_model
+from utils.warm_up import warm_up
+
+
+class TestWarmUp(unittest.TestCase):
+    
+    def setUp(self):
+        tf.random.set_seed(42)
+        np.random.seed(42)
+        self.model = small_forward_model()
+        self.model.jit_compile = True
+        self.model._apply_all_signatures()
+        samples = [random_sample(mel_len, phoneme_len, f'sample_{i}')
+                   for i, (mel_len, phoneme_len) in enumerate([(5, 2), (7, 3), (13, 4), (17, 6)])]
+        self.dataset = forward_dataset(samples, bucket_boundaries=[10, 20], bucket_batch_sizes=[2, 2, 1],
+                                       bucket_phoneme_ratio=.5, drop_remainder=True)
+    
+    def test_warm_up(self):
+        mel, phonemes, durations, _ = next(self.dataset.all_batches())
+        self.model.train_step(phonemes, mel, durations)
+        weights = [v.numpy() for v in self.model.variables + self.model.optimizer.variables]
+        self.assertEqual(2, warm_up(self.model, self.dataset))
+        for weight, variable in zip(weights, self.model.variables + self.model.optimizer.variables):
+            np.testing.assert_array_equal(weight, variable.numpy())
+        self.assertEqual(1, self.model.step)
+        for mel, phonemes, durations, _ in self.dataset.all_batches():
+            model_out = self.model.train_step(phonemes, mel, durations)
+            self.assertTrue(np.isfinite(model_out['loss']))
+        self.assertEqual(3, self.model.step)
+    
+    def test_warm_up_accumulation(self):
+        accumulating_model(self.model)
+        self.assertEqual(4, warm_up(self.model, self.dataset))
+        self.assertEqual(0, self.model.step)
+        self.assertEqual(0., float(self.model.gradient_accumulator.frames))
@@ -5,9 +5,12 @@ from tqdm import trange
 from utils.config_manager import Config
 from preprocessing.datasets import TextMelDataset, AutoregressivePreprocessor
 from utils.decorators import ignore_exception, time_it
-from utils.scheduling import piecewise_linear_schedule, reduction_schedule
+from utils.scheduling import PiecewiseLinearSchedule, StepSchedule
 from utils.logging_utils import SummaryManager
 from utils.scripts_utils import dynamic_memory_allocation, basic_train_parser
+from utils.warm_up import warm_up
+from utils.distribution import get_strategy, is_chief, worker_directory, save_checkpoint, DistributedSteps
+from utils.gradient_accumulation import GradientAccumulation
 from utils.metrics import attention_score
 from utils.spectrogram_ops import mel_lengths, phoneme_lengths
 
@@ -17,6 +20,9 @@ tf.random.set_seed(42)
 dynamic_memory_allocation()
 parser = basic_train_parser()
 args = parser.parse_args()
+strategy = get_strategy(args.strategy)
+chief = is_chief(strategy)
+distributed_steps = DistributedSteps(strategy)
 
 
 @ignore_exception
@@ -55,8 +61,9 @@ config_manager.print_config()
 
 
 # get model, prepare data for model, create datasets
-model = config_manager.get_model()
-config_manager.compile_model(model)
+with strategy.scope():
+    model = config_manager.get_model()
+    config_manager.compile_model(model)
 data_prep = AutoregressivePreprocessor.from_config(config_manager,
                                                    tokenizer=model.text_pipeline.tokenizer)
 train_data_handler = TextMelDataset.from_config(config_manager,
@@ -68,26 +75,34 @@ valid_data_handler = TextMelDataset.from_config(config_manager,
 
 train_dataset = train_data_handler.get_dataset(bucket_batch_sizes=config['bucket_batch_sizes'],
                                                bucket_boundaries=config['bucket_boundaries'],
-                                               shuffle=True)
+                                               shuffle=True,
+                                               drop_remainder=config_manager.jit_compile,
+                                               bucket_phoneme_ratio=config_manager.bucket_phoneme_ratio)
 valid_dataset = valid_data_handler.get_dataset(bucket_batch_sizes=[6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 1],
                                                bucket_boundaries=config['bucket_boundaries'],
-                                               shuffle=False, drop_remainder=True)
+                                               shuffle=False, drop_remainder=True,
+                                               bucket_phoneme_ratio=config_manager.bucket_phoneme_ratio)
+if distributed_steps.distributed:
+    train_dataset.distribute(strategy)
 
 # create logger and checkpointer and restore latest model
 
-summary_manager = SummaryManager(model=model, log_dir=config_manager.log_dir, config=config)
+summary_manager = SummaryManager(model=model, log_dir=config_manager.log_dir, config=config, enabled=chief)
 checkpoint = tf.train.Checkpoint(step=tf.Variable(1),
                                  optimizer=model.optimizer,
                                  net=model)
-manager = tf.train.CheckpointManager(checkpoint, str(config_manager.weights_dir),
+weights_dir = worker_directory(config_manager.weights_dir, strategy)
+manager = tf.train.CheckpointManager(checkpoint, str(weights_dir),
                                      max_to_keep=config['keep_n_weights'],
                                      keep_checkpoint_every_n_hours=config['keep_checkpoint_every_n_hours'])
-manager_training = tf.train.CheckpointManager(checkpoint, str(config_manager.weights_dir / 'latest'),
+manager_training = tf.train.CheckpointManager(checkpoint, str(weights_dir / 'latest'),
                                               max_to_keep=1, checkpoint_name='latest')
 
-checkpoint.restore(manager_training.latest_checkpoint)
-if manager_training.latest_checkpoint:
-    print(f'\nresuming training from step {model.step} ({manager_training.latest_checkpoint})')
+# every worker restores the checkpoint of the chief
+latest_checkpoint = tf.train.latest_checkpoint(str(config_manager.weights_dir / 'latest'))
+checkpoint.restore(latest_checkpoint)
+if latest_checkpoint:
+    print(f'\nresuming training from step {model.step} ({latest_checkpoint})')
 else:
     print(f'\nstarting training from scratch')
 
@@ -96,24 +111,47 @@ if config['debug'] is True:
 # main event
 print('\nTRAINING')
 losses = []
+decoder_prenet_dropout_schedule = PiecewiseLinearSchedule(config['decoder_prenet_dropout_schedule'])
+learning_rate_schedule = PiecewiseLinearSchedule(config['learning_rate_schedule'])
+reduction_factor_schedule = StepSchedule(config['reduction_factor_schedule'])
+head_drop_schedule = StepSchedule(config['head_drop_schedule'])
+gradient_accumulation = GradientAccumulation(bucket_boundaries=config['bucket_boundaries'],
+                                             bucket_accumulation_steps=config_manager.bucket_accumulation_steps,
+                                             frame_budget=config_manager.accumulation_frame_budget)
+if not distributed_steps.distributed:
+    # the step functions of every reduction factor are traced now rather than at the schedule transitions
+    model.trace_reduction_factors([r for _, r in config['reduction_factor_schedule']])
+compiled_r = set()
 test_mel, test_phonemes, test_stop, test_fname = valid_dataset.next_batch()
 _ = train_dataset.next_batch()
 t = trange(model.step, config['max_steps'], leave=True)
 for _ in t:
     t.set_description(f'step {model.step}')
     mel, phonemes, stop, sample_name = train_dataset.next_batch()
-    decoder_prenet_dropout = piecewise_linear_schedule(model.step, config['decoder_prenet_dropout_schedule'])
-    learning_rate = piecewise_linear_schedule(model.step, config['learning_rate_schedule'])
-    reduction_factor = reduction_schedule(model.step, config['reduction_factor_schedule'])
-    drop_n_heads = tf.cast(reduction_schedule(model.step, config['head_drop_schedule']), tf.int32)
+    decoder_prenet_dropout = decoder_prenet_dropout_schedule(model.step)
+    learning_rate = learning_rate_schedule(model.step)
+    reduction_factor = reduction_factor_schedule(model.step)
+    drop_n_heads = head_drop_schedule(model.step)
     t.display(f'reduction factor {reduction_factor}', pos=10)
     model.set_constants(decoder_prenet_dropout=decoder_prenet_dropout,
                         learning_rate=learning_rate,
                         reduction_factor=reduction_factor,
                         drop_n_heads=drop_n_heads)
-    output = model.train_step(inp=phonemes,
-                              tar=mel,
-                              stop_prob=stop)
+    # the steps of each reduction factor are traced (and compiled) separately
+    if config_manager.jit_compile and (config['debug'] is not True) and (model.r not in compiled_r):
+        t.display(f'Compiling the training steps of every bucket', pos=11)
+        n_shapes, time_taken = time_it(warm_up)(model, train_dataset, valid_dataset, distributed_steps)
+        compiled_r.add(model.r)
+        t.display(f'Compiled {n_shapes} step shapes of reduction factor {model.r} in {time_taken}s', pos=11)
+    # the batches before the last one of a step only accumulate their gradients
+    while not gradient_accumulation.apply_gradients(mel, distributed_steps):
+        distributed_steps(model.accumulate_step, inp=phonemes, tar=mel, stop_prob=stop)
+        mel, phonemes, stop, sample_name = train_dataset.next_batch()
+    output = distributed_steps(model.train_step,
+                               inp=phonemes,
+                               tar=mel,
+                               stop_prob=stop)
+    mel, phonemes = distributed_steps.local_values((mel, phonemes))
     losses.append(float(output['loss']))
     
     t.display(f'step loss: {losses[-1]}', pos=1)
@@ -126,7 +164,7 @@ for _ in t:
     summary_manager.display_scalar(tag='Meta/learning_rate', scalar_value=model.optimizer.lr)
     summary_manager.display_scalar(tag='Meta/reduction_factor', scalar_value=model.r)
     summary_manager.display_scalar(tag='Meta/drop_n_heads', scalar_value=model.drop_n_heads)
-    if model.step % config['train_images_plotting_frequency'] == 0:
+    if chief and (model.step % config['train_images_plotting_frequency'] == 0):
         summary_manager.display_attention_heads(output, tag='TrainAttentionHeads')
         summary_manager.display_mel(mel=output['mel_linear'][0], tag=f'Train/linear_mel_out')
         summary_manager.display_mel(mel=output['final_output'][0], tag=f'Train/predicted_mel')
@@ -154,27 +192,27 @@ for _ in t:
                                                scalar_value=tf.reduce_mean(diag_measure[i]))
     
     if model.step % 1000 == 0:
-        save_path = manager_training.save()
+        save_path = save_checkpoint(manager_training, strategy)
     if model.step % config['weights_save_frequency'] == 0:
-        save_path = manager.save()
+        save_path = save_checkpoint(manager, strategy)
         t.display(f'checkpoint at step {model.step}: {save_path}', pos=len(config['n_steps_avg_losses']) + 2)
     
-    if model.step % config['validation_frequency'] == 0:
+    if chief and (model.step % config['validation_frequency'] == 0):
         val_loss, time_taken = validate(model=model,
                                         val_dataset=valid_dataset,
                                         summary_manager=summary_manager)
         t.display(f'validation loss at step {model.step}: {val_loss} (took {time_taken}s)',
                   pos=len(config['n_steps_avg_losses']) + 3)
     
-    if model.step % config['prediction_frequency'] == 0 and (model.step >= config['prediction_start_step']):
-        for j in range(config['n_predictions']):
-            mel, phonemes, stop, fname = test_mel[j], test_phonemes[j], test_stop[j], test_fname[j]
+    if chief and (model.step % config['prediction_frequency'] == 0) and (model.step >= config['prediction_start_step']):
+        t.display(f'Predicting {config["n_predictions"]} samples', pos=len(config['n_steps_avg_losses']) + 4)
+        test_mel_lens = mel_lengths(mel_batch=test_mel[:config['n_predictions']], padding_value=0)
+        preds = model.predict_batch([seq[seq != 0] for seq in test_phonemes[:config['n_predictions']]],
+                                    max_length=int(tf.reduce_max(test_mel_lens)) + 50,
+                                    encode=False)
+        for j, pred in enumerate(preds):
+            mel, fname = test_mel[j], test_fname[j]
             mel = mel[tf.reduce_sum(tf.cast(mel != 0, tf.int32), axis=1) > 0]
-            t.display(f'Predicting {j}', pos=len(config['n_steps_avg_losses']) + 4)
-            pred = model.predict(phonemes,
-                                 max_length=mel.shape[0] + 50,
-                                 encode=False,
-                                 verbose=False)
             pred_mel = pred['mel']
             mel = mel[1:-1]
             target_mel = mel
@@ -7,10 +7,13 @@ from tqdm import trange
 from utils.config_manager import Config
 from preprocessing.datasets import TextMelDurDataset, ForwardPreprocessor
 from utils.decorators import ignore_exception, time_it
-from utils.scheduling import piecewise_linear_schedule, reduction_schedule
+from utils.scheduling import PiecewiseLinearSchedule, StepSchedule
 from utils.logging_utils import SummaryManager
 from model.transformer_utils import create_mel_padding_mask
 from utils.scripts_utils import dynamic_memory_allocation, basic_train_parser
+from utils.warm_up import warm_up
+from utils.distribution import get_strategy, is_chief, worker_directory, save_checkpoint, DistributedSteps
+from utils.gradient_accumulation import GradientAccumulation
 
 np.random.seed(42)
 tf.random.set_seed(42)
@@ -42,6 +45,9 @@ def validate(model,
 
 parser = basic_train_parser()
 args = parser.parse_args()
+strategy = get_strategy(args.strategy)
+chief = is_chief(strategy)
+distributed_steps = DistributedSteps(strategy)
 
 config = Config(config_path=args.config, model_kind='forward')
 config_dict = config.config
@@ -51,8 +57,9 @@ config.create_remove_dirs(clear_dir=args.clear_dir,
 config.dump_config()
 config.print_config()
 
-model = config.get_model()
-config.compile_model(model)
+with strategy.scope():
+    model = config.get_model()
+    config.compile_model(model)
 
 data_prep = ForwardPreprocessor.from_config(config=config,
                                             tokenizer=model.text_pipeline.tokenizer)
@@ -64,48 +71,72 @@ valid_data_handler = TextMelDurDataset.from_config(config,
                                                    kind='valid')
 train_dataset = train_data_handler.get_dataset(bucket_batch_sizes=config_dict['bucket_batch_sizes'],
                                                bucket_boundaries=config_dict['bucket_boundaries'],
-                                               shuffle=True)
+                                               shuffle=True,
+                                               drop_remainder=config.jit_compile,
+                                               bucket_phoneme_ratio=config.bucket_phoneme_ratio)
 valid_dataset = valid_data_handler.get_dataset(bucket_batch_sizes=[6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 1],
                                                bucket_boundaries=config_dict['bucket_boundaries'],
                                                shuffle=False,
-                                               drop_remainder=True)
+                                               drop_remainder=True,
+                                               bucket_phoneme_ratio=config.bucket_phoneme_ratio)
+if distributed_steps.distributed:
+    train_dataset.distribute(strategy)
 
 # create logger and checkpointer and restore latest model
-summary_manager = SummaryManager(model=model, log_dir=config.log_dir, config=config_dict)
+summary_manager = SummaryManager(model=model, log_dir=config.log_dir, config=config_dict, enabled=chief)
 checkpoint = tf.train.Checkpoint(step=tf.Variable(1),
                                  optimizer=model.optimizer,
                                  net=model)
-manager = tf.train.CheckpointManager(checkpoint, config.weights_dir,
+weights_dir = worker_directory(config.weights_dir, strategy)
+manager = tf.train.CheckpointManager(checkpoint, str(weights_dir),
                                      max_to_keep=config_dict['keep_n_weights'],
                                      keep_checkpoint_every_n_hours=config_dict['keep_checkpoint_every_n_hours'])
-manager_training = tf.train.CheckpointManager(checkpoint, str(config.weights_dir / 'latest'),
+manager_training = tf.train.CheckpointManager(checkpoint, str(weights_dir / 'latest'),
                                               max_to_keep=1, checkpoint_name='latest')
 
-checkpoint.restore(manager_training.latest_checkpoint)
-if manager_training.latest_checkpoint:
-    print(f'\nresuming training from step {model.step} ({manager_training.latest_checkpoint})')
+# every worker restores the checkpoint of the chief
+latest_checkpoint = tf.train.latest_checkpoint(str(config.weights_dir / 'latest'))
+checkpoint.restore(latest_checkpoint)
+if latest_checkpoint:
+    print(f'\nresuming training from step {model.step} ({latest_checkpoint})')
 else:
     print(f'\nstarting training from scratch')
 
 if config_dict['debug'] is True:
     print('\nWARNING: DEBUG is set to True. Training in eager mode.')
+elif config.jit_compile:
+    print('\nCompiling the training steps for every bucket.')
+    n_shapes, time_taken = time_it(warm_up)(model, train_dataset, valid_dataset, distributed_steps)
+    print(f'Compiled {n_shapes} step shapes in {time_taken}s.')
 # main event
 print('\nTRAINING')
 losses = []
+learning_rate_schedule = PiecewiseLinearSchedule(config_dict['learning_rate_schedule'])
+decoder_prenet_dropout_schedule = PiecewiseLinearSchedule(config_dict['decoder_prenet_dropout_schedule'])
+head_drop_schedule = StepSchedule(config_dict['head_drop_schedule'])
+gradient_accumulation = GradientAccumulation(bucket_boundaries=config_dict['bucket_boundaries'],
+                                             bucket_accumulation_steps=config.bucket_accumulation_steps,
+                                             frame_budget=config.accumulation_frame_budget)
 test_mel, test_phonemes, test_durs, test_fname = valid_dataset.next_batch()
 t = trange(model.step, config_dict['max_steps'], leave=True)
 for _ in t:
     t.set_description(f'step {model.step}')
     mel, phonemes, durations, fname = train_dataset.next_batch()
-    learning_rate = piecewise_linear_schedule(model.step, config_dict['learning_rate_schedule'])
-    decoder_prenet_dropout = piecewise_linear_schedule(model.step, config_dict['decoder_prenet_dropout_schedule'])
-    drop_n_heads = tf.cast(reduction_schedule(model.step, config_dict['head_drop_schedule']), tf.int32)
+    learning_rate = learning_rate_schedule(model.step)
+    decoder_prenet_dropout = decoder_prenet_dropout_schedule(model.step)
+    drop_n_heads = head_drop_schedule(model.step)
     model.set_constants(decoder_prenet_dropout=decoder_prenet_dropout,
                         learning_rate=learning_rate,
                         drop_n_heads=drop_n_heads)
-    output = model.train_step(input_sequence=phonemes,
-                              target_sequence=mel,
-                              target_durations=durations)
+    # the batches before the last one of a step only accumulate their gradients
+    while not gradient_accumulation.apply_gradients(mel, distributed_steps):
+        distributed_steps(model.accumulate_step, input_sequence=phonemes, target_sequence=mel, target_durations=durations)
+        mel, phonemes, durations, fname = train_dataset.next_batch()
+    output = distributed_steps(model.train_step,
+                               input_sequence=phonemes,
+                               target_sequence=mel,
+                               target_durations=durations)
+    mel, durations = distributed_steps.local_values((mel, durations))
     losses.append(float(output['loss']))
     
     t.display(f'step loss: {losses[-1]}', pos=1)
@@ -117,7 +148,7 @@ for _ in t:
     summary_manager.display_scalar(tag='Meta/learning_rate', scalar_value=model.optimizer.lr)
     summary_manager.display_scalar(tag='Meta/decoder_prenet_dropout', scalar_value=model.decoder_prenet.rate)
     summary_manager.display_scalar(tag='Meta/drop_n_heads', scalar_value=model.drop_n_heads)
-    if model.step % config_dict['train_images_plotting_frequency'] == 0:
+    if chief and (model.step % config_dict['train_images_plotting_frequency'] == 0):
         summary_manager.display_attention_heads(output, tag='TrainAttentionHeads')
         summary_manager.display_mel(mel=output['mel'][0], tag=f'Train/predicted_mel')
         summary_manager.display_mel(mel=mel[0], tag=f'Train/target_mel')
@@ -127,12 +158,12 @@ for _ in t:
         summary_manager.display_audio(tag=f'Train/target', mel=mel[0])
     
     if model.step % 1000 == 0:
-        save_path = manager_training.save()
+        save_path = save_checkpoint(manager_training, strategy)
     if model.step % config_dict['weights_save_frequency'] == 0:
-        save_path = manager.save()
+        save_path = save_checkpoint(manager, strategy)
         t.display(f'checkpoint at step {model.step}: {save_path}', pos=len(config_dict['n_steps_avg_losses']) + 2)
     
-    if model.step % config_dict['validation_frequency'] == 0:
+    if chief and (model.step % config_dict['validation_frequency'] == 0):
         t.display(f'Validating', pos=len(config_dict['n_steps_avg_losses']) + 3)
         val_loss, time_taken = validate(model=model,
                                         val_dataset=valid_dataset,
@@ -140,7 +171,8 @@ for _ in t:
         t.display(f'validation loss at step {model.step}: {val_loss} (took {time_taken}s)',
                   pos=len(config_dict['n_steps_avg_losses']) + 3)
     
-    if model.step % config_dict['prediction_frequency'] == 0 and (model.step >= config_dict['prediction_start_step']):
+    if chief and (model.step % config_dict['prediction_frequency'] == 0) and (
+            model.step >= config_dict['prediction_start_step']):
         t.display(f'Predicting', pos=len(config_dict['n_steps_avg_losses']) + 4)
         timed_pred = time_it(model.predict)
         model_out, time_taken = timed_pred(test_phonemes, encode=False)
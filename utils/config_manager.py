@@ -7,6 +7,7 @@ import tensorflow as tf
 import ruamel.yaml
 
 from model.models import AutoregressiveTransformer, ForwardTransformer
+from utils.head_pruning import prune_to_checkpoint
 from utils.scheduling import piecewise_linear_schedule, reduction_schedule
 
 
@@ -36,6 +37,18 @@ class Config:
         self.mel_dir = self.data_dir / f"mels.{self.config['normalizer']}"
         # training parameters
         self.learning_rate = np.array(self.config['learning_rate_schedule'])[0, 1].astype(np.float32)
+        # None (float32), 'mixed_float16' or 'mixed_bfloat16'
+        self.mixed_precision = self.config.get('mixed_precision', None)
+        assert self.mixed_precision in [None, 'mixed_float16', 'mixed_bfloat16'], \
+            f'Unknown mixed precision policy {self.mixed_precision}.'
+        # XLA compiled training steps, on batches padded to static bucket shapes
+        self.jit_compile = self.config.get('jit_compile', False)
+        self.bucket_phoneme_ratio = self.config.get('bucket_phoneme_ratio', .5) if self.jit_compile else None
+        # gradient accumulation over the batches of a step, per bucket and/or up to a number of mel frames
+        self.bucket_accumulation_steps = self.config.get('bucket_accumulation_steps', None)
+        self.accumulation_frame_budget = self.config.get('accumulation_frame_budget', None)
+        self.gradient_accumulation = (self.bucket_accumulation_steps is not None) or (
+                self.accumulation_frame_budget is not None)
         if model_kind == 'autoregressive':
             self.max_r = np.array(self.config['reduction_factor_schedule'])[0, 1].astype(np.int32)
             self.stop_scaling = self.config.get('stop_loss_scaling', 1.)
@@ -89,6 +102,15 @@ class Config:
     def get_model(self, ignore_hash=False):
         if not ignore_hash:
             self._check_hash()
+        # the layers keep the policy they are created with, the global one is restored for other models
+        global_policy = tf.keras.mixed_precision.global_policy()
+        tf.keras.mixed_precision.set_global_policy(self.mixed_precision or 'float32')
+        try:
+            return self._new_model()
+        finally:
+            tf.keras.mixed_precision.set_global_policy(global_policy)
+    
+    def _new_model(self):
         if self.model_kind == 'autoregressive':
             return AutoregressiveTransformer(mel_channels=self.config['mel_channels'],
                                              encoder_model_dimension=self.config['encoder_model_dimension'],
@@ -120,7 +142,9 @@ class Config:
                                              mel_end_value=self.config['mel_end_value'],
                                              phoneme_language=self.config['phoneme_language'],
                                              with_stress=self.config['with_stress'],
-                                             debug=self.config['debug'])
+                                             debug=self.config['debug'],
+                                             jit_compile=self.jit_compile,
+                                             gradient_accumulation=self.gradient_accumulation)
         
         else:
             return ForwardTransformer(encoder_model_dimension=self.config['encoder_model_dimension'],
@@ -146,13 +170,19 @@ class Config:
                                       decoder_dense_blocks=self.config['decoder_dense_blocks'],
                                       phoneme_language=self.config['phoneme_language'],
                                       with_stress=self.config['with_stress'],
-                                      debug=self.config['debug'])
+                                      debug=self.config['debug'],
+                                      jit_compile=self.jit_compile,
+                                      gradient_accumulation=self.gradient_accumulation)
     
     def compile_model(self, model):
+        optimizer = self.new_adam(self.learning_rate)
+        if self.mixed_precision == 'mixed_float16':
+            # float16 gradients underflow without loss scaling, bfloat16 has the exponent range of float32
+            optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
         if self.model_kind == 'autoregressive':
-            model._compile(stop_scaling=self.stop_scaling, optimizer=self.new_adam(self.learning_rate))
+            model._compile(stop_scaling=self.stop_scaling, optimizer=optimizer)
         else:
-            model._compile(optimizer=self.new_adam(self.learning_rate))
+            model._compile(optimizer=optimizer)
     
     # TODO: move to model
     @staticmethod
@@ -205,9 +235,47 @@ class Config:
             ckpt.restore(manager.latest_checkpoint)
             if verbose:
                 print(f'restored weights from {manager.latest_checkpoint} at step {model.step}')
-        decoder_prenet_dropout = piecewise_linear_schedule(model.step, self.config['decoder_prenet_dropout_schedule'])
+        model.reset_encoder_cache()
+        self._set_scheduled_constants(model, model.step)
+        return model
+    
+    def _set_scheduled_constants(self, model, step):
+        decoder_prenet_dropout = piecewise_linear_schedule(step, self.config['decoder_prenet_dropout_schedule'])
         reduction_factor = None
         if self.model_kind == 'autoregressive':
-            reduction_factor = reduction_schedule(model.step, self.config['reduction_factor_schedule'])
+            reduction_factor = reduction_schedule(step, self.config['reduction_factor_schedule'])
         model.set_constants(reduction_factor=reduction_factor, decoder_prenet_dropout=decoder_prenet_dropout)
+    
+    @staticmethod
+    def _inference_layers(model):
+        return {name: layer for name, layer in vars(model).items() if isinstance(layer, tf.keras.layers.Layer)}
+    
+    def _inference_checkpoint(self, model, step):
+        """ Checkpoint of the model layers and training step only, without the optimizer. """
+        return tf.train.Checkpoint(step=step, **self._inference_layers(model))
+    
+    def save_inference_weights(self, model, weights_path: str):
+        """ Writes the model weights without optimizer slots, to be loaded with load_inference_model. """
+        ckpt = self._inference_checkpoint(model, step=tf.Variable(model.step, dtype=tf.int64))
+        return ckpt.write(weights_path)
+    
+    def load_inference_model(self, weights_path: str, verbose=True):
+        """ Loads weights written by save_inference_weights, without creating an optimizer or compiling.
+        The attention layers are shrunk to the heads in the weights, if these were pruned with utils.head_pruning.
+        """
+        model = self.get_model()
+        prune_to_checkpoint(model, weights_path)
+        step = tf.Variable(0, dtype=tf.int64)
+        ckpt = self._inference_checkpoint(model, step=step)
+        # the layers are built (and their weights restored) on the first call, so only the checkpointed layer
+        # names can be compared up front, e.g. against training checkpoints or weights of the other model kind
+        names = {key.split('/')[0] for key in tf.train.load_checkpoint(weights_path).get_variable_to_shape_map()}
+        unknown = names - set(self._inference_layers(model)) - {'step', '_CHECKPOINTABLE_OBJECT_GRAPH'}
+        assert len(unknown) == 0, f'{weights_path} are not inference weights of a {self.model_kind} model, ' \
+                                  f'unknown objects: {sorted(unknown)}.'
+        ckpt.read(weights_path).assert_existing_objects_matched().expect_partial()
+        if verbose:
+            print(f'restored inference weights from {weights_path} at step {int(step)}')
+        model.reset_encoder_cache()
+        self._set_scheduled_constants(model, int(step))
         return model
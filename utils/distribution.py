@@ -0,0 +1,98 @@
+from pathlib import Path
+
+import tensorflow as tf
+
+STRATEGIES = ['default', 'mirrored', 'multi_worker']
+
+
+def get_strategy(name: str = 'default') -> tf.distribute.Strategy:
+    """ 'mirrored' replicates the model over the local devices, 'multi_worker' over the local devices of the
+    worker processes of the cluster in the TF_CONFIG environment variable.
+    """
+    if name == 'mirrored':
+        return tf.distribute.MirroredStrategy()
+    if name == 'multi_worker':
+        return tf.distribute.MultiWorkerMirroredStrategy()
+    assert name == 'default', f'Unknown distribution strategy {name}.'
+    return tf.distribute.get_strategy()
+
+
+def is_chief(strategy: tf.distribute.Strategy) -> bool:
+    """ Whether this worker writes the checkpoints and summaries. """
+    return strategy.extended.should_checkpoint
+
+
+def worker_directory(directory, strategy: tf.distribute.Strategy) -> Path:
+    """ directory for the chief, a temporary directory for the other workers, which take part in saving
+    the checkpoints (the variables can be read with collective operations) but discard them.
+    """
+    directory = Path(directory)
+    if is_chief(strategy):
+        return directory
+    return directory / f'.worker_{strategy.cluster_resolver.task_id}'
+
+
+def save_checkpoint(manager: tf.train.CheckpointManager, strategy: tf.distribute.Strategy):
+    """ Saves on every worker (see worker_directory), keeping the checkpoint of the chief only. """
+    save_path = manager.save()
+    if not is_chief(strategy):
+        tf.io.gfile.rmtree(manager.directory)
+    return save_path
+
+
+class DistributedSteps:
+    """ Runs step functions (e.g. model.train_step) on the per-replica batches of a distributed Dataset.
+    
+    The replicas run the Python functions of the steps within a single tf.function, as gradient aggregation
+    is not supported in nested tf.functions, so the steps are not compiled with XLA. The outputs are those of
+    the first local replica, but for the losses, which are averaged over all replicas. Without distribution
+    (the default strategy), the step functions are called directly.
+    """
+    
+    def __init__(self, strategy: tf.distribute.Strategy):
+        self.strategy = strategy
+        self.distributed = isinstance(strategy, (tf.distribute.MirroredStrategy,
+                                                 tf.distribute.MultiWorkerMirroredStrategy))
+        self._functions = {}
+    
+    def _distributed_function(self, step_function):
+        # the step functions of the autoregressive model are replaced when the reduction factor changes
+        if step_function not in self._functions:
+            replica_function = getattr(step_function, 'python_function', step_function)
+            
+            def replica_step(batch):
+                return replica_function(**batch)
+            
+            def run_step(**batch):
+                return self.strategy.run(replica_step, args=(batch,))
+            
+            self._functions[step_function] = tf.function(run_step, reduce_retracing=True)
+        return self._functions[step_function]
+    
+    def __call__(self, step_function, **batch):
+        if not self.distributed:
+            return step_function(**batch)
+        outputs = self._distributed_function(step_function)(**batch)
+        local_outputs = self.local_values(outputs)
+        local_outputs['loss'] = self.strategy.reduce(tf.distribute.ReduceOp.MEAN, outputs['loss'], axis=None)
+        local_outputs['losses'] = {name: self.strategy.reduce(tf.distribute.ReduceOp.MEAN, loss, axis=None)
+                                   for name, loss in outputs['losses'].items()}
+        return local_outputs
+    
+    def reduce(self, reduce_op: tf.distribute.ReduceOp, function, values):
+        """ Reduces function of the per-replica values (e.g. the size of a batch) over all replicas. """
+        if not self.distributed:
+            return function(values)
+        return self.strategy.reduce(reduce_op, self.strategy.run(function, args=(values,)), axis=None)
+    
+    def local_values(self, values):
+        """ The values of the first local replica, e.g. of a per-replica batch. """
+        if not self.distributed:
+            return values
+        return tf.nest.map_structure(lambda value: self.strategy.experimental_local_results(value)[0], values)
+    
+    def replicate(self, values):
+        """ The same (batch) values on every replica. """
+        if not self.distributed:
+            return values
+        return self.strategy.experimental_distribute_values_from_function(lambda context: values)
@@ -0,0 +1,120 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from model.models import ForwardTransformer
+
+
+class DocumentSynthesizer:
+    """ Synthesizes long documents sentence by sentence.
+    
+    The document is split into lines and sentences, all sentences are phonemized with a single phonemizer
+    call and synthesized in batches of sentences of similar length. The batches run in a background thread,
+    one window ahead, while the mels are yielded in document order, each followed by a sentence (or, at the
+    end of a line, paragraph) silence.
+    
+    E.g.:
+        synthesizer = DocumentSynthesizer(model)
+        mel = np.concatenate(list(synthesizer(text)), axis=0)
+    """
+    
+    def __init__(self,
+                 model,
+                 batch_size: int = 16,
+                 window_batches: int = 4,
+                 sentence_silence: int = 10,
+                 paragraph_silence: int = 30,
+                 silence_value: float = np.log(1e-5),
+                 speed_regulator: float = 1.,
+                 max_length: int = 1000):
+        """
+        :param model: ForwardTransformer or AutoregressiveTransformer.
+        :param window_batches: sentences are sorted by length within windows of window_batches * batch_size
+            consecutive sentences, a window is yielded once all of its batches are synthesized.
+        :param sentence_silence: number of silent frames appended to each sentence.
+        :param paragraph_silence: number of silent frames appended to the last sentence of each line.
+        :param silence_value: normalized mel value of silence, the default is the one of the MelGAN normalizer.
+        :param speed_regulator: speed of the ForwardTransformer, ignored by the AutoregressiveTransformer.
+        :param max_length: maximum decoding length of the AutoregressiveTransformer.
+        """
+        self.model = model
+        self.pipeline = model.text_pipeline
+        self.batch_size = batch_size
+        self.window_size = batch_size * window_batches
+        self.sentence_silence = sentence_silence
+        self.paragraph_silence = paragraph_silence
+        self.silence_value = silence_value
+        self.speed_regulator = speed_regulator
+        self.max_length = max_length
+    
+    def segment(self, text: str):
+        """ Splits the text into cleaned sentences.
+        
+        :return: list of sentences and list of the number of silent frames following each sentence.
+        """
+        sentences, silences = [], []
+        for line in text.splitlines():
+            line_sentences = self.pipeline.cleaner.split_sentences(line)
+            sentences.extend(line_sentences)
+            silences.extend([self.sentence_silence] * len(line_sentences))
+            if len(line_sentences) > 0:
+                silences[-1] = self.paragraph_silence
+        return sentences, silences
+    
+    def encode(self, sentences: list):
+        """ Phonemizes all the (cleaned) sentences with a single phonemizer call. """
+        if len(sentences) == 0:
+            return []
+        phonemes = self.pipeline.phonemizer(sentences)
+        return [self.pipeline.tokenizer(p) for p in phonemes]
+    
+    def _predict(self, sequences: list):
+        if isinstance(self.model, ForwardTransformer):
+            mels = self.model.predict_batch(sequences, batch_size=len(sequences), encode=False,
+                                            speed_regulator=self.speed_regulator)
+        else:
+            outputs = self.model.predict_batch(sequences, max_length=self.max_length, encode=False)
+            mels = [out['mel'] for out in outputs]
+        return [mel.numpy() for mel in mels]
+    
+    def _windows(self, n_sequences: int):
+        for start in range(0, n_sequences, self.window_size):
+            yield list(range(start, min(start + self.window_size, n_sequences)))
+    
+    def _submit_window(self, executor, sequences: list, window: list):
+        window = sorted(window, key=lambda i: len(sequences[i]))
+        batches = [window[i:i + self.batch_size] for i in range(0, len(window), self.batch_size)]
+        return [(batch, executor.submit(self._predict, [sequences[i] for i in batch])) for batch in batches]
+    
+    def _window_mels(self, window_futures: list, silences: list):
+        mels = {}
+        for batch, future in window_futures:
+            mels.update(zip(batch, future.result()))
+        for i in sorted(mels.keys()):
+            silence = np.full((silences[i], mels[i].shape[-1]), self.silence_value, dtype=mels[i].dtype)
+            yield np.concatenate([mels[i], silence], axis=0)
+    
+    def synthesize_sequences(self, sequences: list, silences: list):
+        """ Yields the mel of each encoded sentence, followed by its silence, in order.
+        
+        The next window is submitted when the current one is consumed, so that at most one window is
+        synthesized ahead. Closing the generator cancels the batches that have not started yet.
+        """
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            in_flight = []
+            try:
+                for window in self._windows(len(sequences)):
+                    in_flight.append(self._submit_window(executor, sequences, window))
+                    if len(in_flight) > 1:
+                        yield from self._window_mels(in_flight.pop(0), silences)
+                while len(in_flight) > 0:
+                    yield from self._window_mels(in_flight.pop(0), silences)
+            finally:
+                for window_futures in in_flight:
+                    for _, future in window_futures:
+                        future.cancel()
+    
+    def __call__(self, text: str):
+        sentences, silences = self.segment(text)
+        sequences = self.encode(sentences)
+        return self.synthesize_sequences(sequences, silences)
@@ -0,0 +1,134 @@
+import tempfile
+from pathlib import Path
+
+import tensorflow as tf
+
+from model.models import AutoregressiveTransformer, ForwardTransformer
+
+
+def _tokenizer_module(module, tokenizer, vocab_dir: Path):
+    """ Adds the tokenizer vocabulary (as asset and lookup table) and a phoneme string tokenizer to module. """
+    tokens = [tokenizer.idx_to_token[i] for i in sorted(tokenizer.idx_to_token.keys())]
+    vocab_path = vocab_dir / 'vocab.txt'
+    with open(str(vocab_path), 'w', encoding='utf-8') as f:
+        f.write('\n'.join(tokens))
+    module.vocab_file = tf.saved_model.Asset(str(vocab_path))
+    module.vocab = tf.Variable(tokens, trainable=False)
+    # only the phonemes are looked up, like Tokenizer does when encoding
+    phonemes = [s for i, s in tokenizer.idx_to_token.items() if i in range(1, len(tokenizer.alphabet) + 1)]
+    module.tokenizer_table = tf.lookup.StaticHashTable(
+        tf.lookup.KeyValueTensorInitializer(tf.constant(phonemes),
+                                            tf.constant([tokenizer.token_to_idx[s] for s in phonemes],
+                                                        dtype=tf.int32)),
+        default_value=-1)
+    
+    @tf.function(input_signature=[tf.TensorSpec(shape=(), dtype=tf.string)])
+    def tokenize(phonemes):
+        ids = module.tokenizer_table.lookup(tf.strings.unicode_split(phonemes, 'UTF-8'))
+        ids = tf.boolean_mask(ids, ids >= 0)
+        if tokenizer.add_start_end:
+            ids = tf.concat([[tokenizer.start_token_index], ids, [tokenizer.end_token_index]], axis=0)
+        return ids
+    
+    module.tokenize = tokenize
+    return module
+
+
+def _forward_module(model: ForwardTransformer):
+    module = tf.Module()
+    
+    @tf.function(input_signature=model.forward_input_signature)
+    def forward(input_sequence, durations_scalar):
+        out = model._forward(input_sequence, durations_scalar=durations_scalar)
+        mel_lengths = tf.cast(tf.reduce_sum(1. - out['expanded_mask'][:, 0, 0, :], axis=-1), tf.int32)
+        return {'mel': out['mel'], 'duration': out['duration'], 'mel_lengths': mel_lengths}
+    
+    @tf.function(input_signature=model.forward_input_signature)
+    def predict_durations(input_sequence, durations_scalar):
+        return model._forward_durations(input_sequence, durations_scalar=durations_scalar)
+    
+    module.forward = forward
+    module.predict_durations = predict_durations
+    signatures = {'serving_default': forward, 'forward': forward, 'predict_durations': predict_durations}
+    return module, signatures
+
+
+def _autoregressive_module(model: AutoregressiveTransformer):
+    module = tf.Module()
+    module.start_vec = tf.Variable(model.start_vec, trainable=False)
+    module.reduction_factor = tf.Variable(model.r, trainable=False)
+    module.stop_prob_index = tf.Variable(model.stop_prob_index, trainable=False)
+    
+    @tf.function(input_signature=model.encoder_signature)
+    def encoder(inputs):
+        encoder_output, padding_mask, _ = model._forward_encoder(inputs)
+        return {'encoder_output': encoder_output, 'padding_mask': padding_mask}
+    
+    @tf.function(input_signature=model.decoder_signature[:1])
+    def init_decoder_cache(encoder_output):
+        return model._init_decoder_cache(encoder_output)
+    
+    @tf.function(input_signature=model._decoder_step_signature())
+    def decoder_step(targets, encoder_padding_mask, cache):
+        out = model._forward_decoder_step(targets, encoder_padding_mask, cache)
+        return {'final_output': out['final_output'], 'stop_prob': out['stop_prob'], 'cache': out['cache']}
+    
+    @tf.function(input_signature=model.generate_signature)
+    def generate(inp, max_length):
+        return {'mel': model._generate(inp, max_length)['mel']}
+    
+    @tf.function(input_signature=model.generate_batch_signature)
+    def generate_batch(inp, max_length):
+        out = model._generate_batch(inp, max_length)
+        return {'mel': out['mel'], 'mel_lengths': out['mel_lengths']}
+    
+    module.encoder = encoder
+    module.init_decoder_cache = init_decoder_cache
+    module.decoder_step = decoder_step
+    module.generate = generate
+    module.generate_batch = generate_batch
+    # the decoder step takes a nested cache, so it is a function of the loaded object, not a signature
+    signatures = {'serving_default': generate, 'generate': generate, 'generate_batch': generate_batch,
+                  'encoder': encoder}
+    return module, signatures
+
+
+def export_saved_model(model, export_dir: str):
+    """ Exports the inference functions of model as SavedModel, with the weights and tokenizer vocabulary.
+    
+    The functions are traced with the current constants (reduction factor, dropped heads, attention
+    window), which are therefore fixed in the export. Phonemization is not part of the graph: the exported
+    tokenize function takes an already phonemized string.
+    """
+    if isinstance(model, ForwardTransformer):
+        module, signatures = _forward_module(model)
+    else:
+        module, signatures = _autoregressive_module(model)
+    module.model_variables = list(model.variables)
+    module.warmup_sequence = tf.Variable(list(range(1, len(model.text_pipeline.tokenizer.alphabet) + 1))[:20],
+                                         dtype=tf.int32, trainable=False)
+    with tempfile.TemporaryDirectory() as vocab_dir:
+        _tokenizer_module(module, model.text_pipeline.tokenizer, Path(vocab_dir))
+        tf.saved_model.save(module, str(export_dir), signatures=signatures)
+
+
+def warmup(loaded):
+    """ Runs every exported function once, so that the first request does not pay for the initialization. """
+    sequence = tf.convert_to_tensor(loaded.warmup_sequence)
+    if hasattr(loaded, 'forward'):
+        loaded.forward(sequence[tf.newaxis], tf.constant(1.))
+        loaded.predict_durations(sequence[tf.newaxis], tf.constant(1.))
+    else:
+        encoder_out = loaded.encoder(sequence[tf.newaxis])
+        cache = loaded.init_decoder_cache(encoder_out['encoder_output'])
+        loaded.decoder_step(tf.convert_to_tensor(loaded.start_vec)[tf.newaxis], encoder_out['padding_mask'], cache)
+        loaded.generate(sequence, tf.constant(2))
+        loaded.generate_batch(sequence[tf.newaxis], tf.constant(2))
+    loaded.tokenize(tf.constant(''))
+
+
+def load_saved_model(export_dir: str, warm_up=True):
+    loaded = tf.saved_model.load(str(export_dir))
+    if warm_up:
+        warmup(loaded)
+    return loaded
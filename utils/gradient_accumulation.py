@@ -0,0 +1,57 @@
+import numpy as np
+import tensorflow as tf
+
+from utils.distribution import DistributedSteps
+
+
+class GradientAccumulation:
+    """ Decides which batches end a training step, with model.train_step, while the batches before them are
+    micro-batches, with model.accumulate_step: a step ends after bucket_accumulation_steps[i] batches when its
+    last batch is of bucket i, or once its batches reach frame_budget (padded) mel frames, whichever comes first.
+    
+    With a distribution strategy, the frames of all replicas are counted and the bucket of a batch is the
+    longest among the replicas, so that every worker runs the same steps.
+    
+        :arg bucket_boundaries: mel bucket boundaries of the training dataset
+        :arg bucket_accumulation_steps: number of batches per step for each bucket, None for frame_budget only
+        :arg frame_budget: number of (padded) mel frames per step, None for no budget
+    """
+    
+    def __init__(self, bucket_boundaries: list, bucket_accumulation_steps: list = None, frame_budget: int = None):
+        if bucket_accumulation_steps is not None:
+            assert len(bucket_accumulation_steps) == len(bucket_boundaries) + 1, \
+                'bucket_accumulation_steps needs one entry per bucket, as bucket_batch_sizes.'
+        self.bucket_boundaries = bucket_boundaries
+        self.bucket_accumulation_steps = bucket_accumulation_steps
+        self.frame_budget = frame_budget
+        self.n_batches = 0
+        self.n_frames = 0
+    
+    @property
+    def enabled(self):
+        return (self.bucket_accumulation_steps is not None) or (self.frame_budget is not None)
+    
+    def _batch_statistics(self, mel):
+        """ The bucket of mel (one hot) and its frames. """
+        mel_shape = tf.shape(mel)
+        bucket = tf.searchsorted(tf.constant(self.bucket_boundaries, dtype=tf.int32), mel_shape[1:2], side='right')
+        return tf.concat([tf.one_hot(bucket[0], len(self.bucket_boundaries) + 1),
+                          [tf.cast(mel_shape[0] * mel_shape[1], tf.float32)]], axis=0)
+    
+    def apply_gradients(self, mel, distributed_steps: DistributedSteps) -> bool:
+        """ Counts the batch of mel, returning whether it ends the training step. """
+        if not self.enabled:
+            return True
+        statistics = distributed_steps.reduce(tf.distribute.ReduceOp.SUM, self._batch_statistics, mel).numpy()
+        self.n_batches += 1
+        self.n_frames += int(statistics[-1])
+        bucket = np.nonzero(statistics[:-1])[0].max()
+        apply = False
+        if self.bucket_accumulation_steps is not None:
+            apply = self.n_batches >= self.bucket_accumulation_steps[bucket]
+        if self.frame_budget is not None:
+            apply = apply or (self.n_frames >= self.frame_budget)
+        if apply:
+            self.n_batches = 0
+            self.n_frames = 0
+        return apply
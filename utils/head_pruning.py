@@ -0,0 +1,99 @@
+import numpy as np
+import tensorflow as tf
+
+from model.models import ForwardTransformer
+from utils.metrics import attention_score
+from utils.spectrogram_ops import mel_lengths, phoneme_lengths
+
+
+def attention_layers(model) -> dict:
+    """ The MultiHeadAttention layers of model by checkpoint path (as in Config.save_inference_weights),
+    each with the sequences its queries and keys come from ('encoder' or 'decoder').
+    """
+    layers = {}
+    for stack_name in ['encoder', 'decoder']:
+        stack = getattr(model, stack_name)
+        for blocks_name in ['encoder_SADB', 'encoder_SACB', 'CADB', 'CACB']:
+            for i, block in enumerate(getattr(stack, blocks_name, [])):
+                path = f'{stack_name}/{blocks_name}/{i}'
+                layers[f'{path}/sarn/mha'] = (block.sarn.mha, stack_name, stack_name)
+                if hasattr(block, 'carn'):
+                    layers[f'{path}/carn/mha'] = (block.carn.mha, 'decoder', 'encoder')
+    return layers
+
+
+def _val_step(model, batch):
+    if isinstance(model, ForwardTransformer):
+        mel, phonemes, durations = batch
+        return model._val_step(input_sequence=phonemes, target_sequence=mel, target_durations=durations)
+    mel, phonemes, stop = batch
+    return model._val_step(inp=phonemes, tar=mel, stop_prob=stop)
+
+
+def _sequence_lengths(model, batch):
+    if isinstance(model, ForwardTransformer):
+        mel, phonemes, durations = batch
+        return {'encoder': phoneme_lengths(phonemes),
+                'decoder': tf.cast(tf.reduce_sum(durations, axis=-1), tf.int32)}
+    mel, phonemes, stop = batch
+    return {'encoder': phoneme_lengths(phonemes),
+            'decoder': mel_lengths(mel_batch=mel, padding_value=0) // model.r}
+
+
+def score_heads(model, batches):
+    """ Scores every head of every attention layer over (validation) batches with attention_score.
+    
+    The score of a head is the sum of its jumpiness, peakiness and diagonality, as when selecting the
+    alignment heads in utils.alignments. The validation steps run eagerly, to record the attention weights.
+    
+    :param batches: iterable of (mel, phonemes, durations) for the ForwardTransformer or of
+        (mel, phonemes, stop_prob) for the AutoregressiveTransformer.
+    :return: dictionary of mean head scores by layer path, mean validation loss.
+    """
+    layers = attention_layers(model)
+    scores = {name: [] for name in layers}
+    losses = []
+    for mha, _, _ in layers.values():
+        mha.attention_recorder = []
+    try:
+        for batch in batches:
+            losses.append(float(_val_step(model, batch)['loss']))
+            lengths = _sequence_lengths(model, batch)
+            for name, (mha, queries, keys) in layers.items():
+                # decoder queries cover r frames in the cross-attention of the autoregressive model
+                r = model.r if (queries, keys) == ('decoder', 'encoder') else 1
+                jumpiness, peakiness, diagonality = attention_score(att=mha.attention_recorder.pop(),
+                                                                    mel_len=lengths[queries],
+                                                                    phon_len=lengths[keys],
+                                                                    r=r)
+                scores[name].append((jumpiness + peakiness + diagonality).numpy())
+    finally:
+        for mha, _, _ in layers.values():
+            mha.attention_recorder = None
+    return {name: np.mean(np.concatenate(s), axis=0) for name, s in scores.items()}, float(np.mean(losses))
+
+
+def prune_heads(model, scores: dict, n_heads: int = 1):
+    """ Removes the n_heads lowest scoring heads of every attention layer, keeping at least one head per layer.
+    
+    :return: dictionary of the removed heads by layer path.
+    """
+    pruned = {}
+    for name, (mha, _, _) in attention_layers(model).items():
+        heads = np.argsort(scores[name])[:min(n_heads, mha.num_heads - 1)]
+        mha.prune_heads(heads.tolist())
+        pruned[name] = sorted(heads.tolist())
+    model.reset_encoder_cache()
+    model._apply_all_signatures()
+    return pruned
+
+
+def prune_to_checkpoint(model, checkpoint_path: str):
+    """ Shrinks the attention layers of a new model to the number of heads in a checkpoint of a pruned model. """
+    shapes = tf.train.load_checkpoint(checkpoint_path).get_variable_to_shape_map()
+    for name, (mha, _, _) in attention_layers(model).items():
+        key = f'{name}/wq/kernel/.ATTRIBUTES/VARIABLE_VALUE'
+        if (key in shapes) and (shapes[key][-1] < mha.num_heads * mha.depth):
+            mha.prune_heads(list(range(shapes[key][-1] // mha.depth, mha.num_heads)))
+    model._apply_all_signatures()
+    return model
@@ -0,0 +1,64 @@
+from time import time
+
+import numpy as np
+import tensorflow as tf
+
+from model.layers import CNNResNorm
+from model.models import ForwardTransformer
+
+
+def optimize_for_inference(model, prenet_dropout: bool = False):
+    """ Rewrites a loaded (and built) model for inference.
+    
+    Folds the batch normalizations of all CNNResNorm layers and makes the decoder prenet deterministic,
+    unless prenet_dropout is True (the autoregressive model is trained to rely on it at inference).
+    The weights are modified: the model can no longer be trained or saved as training checkpoint.
+    """
+    model.decoder_prenet.inference_dropout = prenet_dropout
+    for layer in model.submodules:
+        if isinstance(layer, CNNResNorm) and (layer.folded_normalization is None) and \
+                all(isinstance(norm, tf.keras.layers.BatchNormalization) for norm in layer.normalization):
+            assert layer.built, 'the model must be built (called once) before optimizing it.'
+            layer.fold_normalization()
+    model.reset_encoder_cache()
+    model._apply_all_signatures()
+    return model
+
+
+def _run_forward(model, inputs):
+    if isinstance(model, ForwardTransformer):
+        return model.forward(inputs, durations_scalar=tf.constant(1.))['mel']
+    phonemes, targets = inputs
+    return model.forward(phonemes, targets)['final_output']
+
+
+def _mean_run_time(model, inputs, n_runs):
+    _run_forward(model, inputs)
+    start = time()
+    for _ in range(n_runs):
+        _run_forward(model, inputs)
+    return (time() - start) / n_runs
+
+
+def optimize_and_verify(model, inputs, prenet_dropout: bool = False, n_runs: int = 10):
+    """ Optimizes the model for inference, verifying the outputs and measuring the speedup of forward.
+    
+    :param inputs: phoneme batch for the ForwardTransformer, (phoneme batch, mel batch) for the
+        AutoregressiveTransformer.
+    :return: dictionary with the maximum absolute output difference, the forward times and the speedup.
+    """
+    time_before = _mean_run_time(model, inputs, n_runs)
+    # compare the outputs with a deterministic prenet on both sides
+    model.decoder_prenet.inference_dropout = False
+    model._apply_all_signatures()
+    reference = _run_forward(model, inputs)
+    optimize_for_inference(model, prenet_dropout=False)
+    optimized = _run_forward(model, inputs)
+    time_after = _mean_run_time(model, inputs, n_runs)
+    if prenet_dropout:
+        model.decoder_prenet.inference_dropout = True
+        model._apply_all_signatures()
+    return {'max_abs_error': float(np.max(np.abs(reference - optimized))),
+            'time_before': time_before,
+            'time_after': time_after,
+            'speedup': time_before / time_after}
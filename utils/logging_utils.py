@@ -28,6 +28,7 @@ class SummaryManager:
         :arg log_dir: base directory where logs of a config are created
         :arg config: configuration dictionary
         :arg max_plot_frequency: every how many steps to plot
+        :arg enabled: whether to write at all (e.g. only from the chief worker of a distributed training)
     """
     
     def __init__(self,
@@ -35,8 +36,10 @@ class SummaryManager:
                  log_dir: str,
                  config: dict,
                  max_plot_frequency=10,
-                 default_writer='log_dir'):
+                 default_writer='log_dir',
+                 enabled=True):
         self.model = model
+        self.enabled = enabled
         self.log_dir = Path(log_dir)
         self.config = config
         self.audio = Audio(config)
@@ -54,7 +57,10 @@ class SummaryManager:
         if not tag:
             tag = path
         if tag not in self.writers.keys():
-            self.writers[tag] = tf.summary.create_file_writer(str(path))
+            if self.enabled:
+                self.writers[tag] = tf.summary.create_file_writer(str(path))
+            else:
+                self.writers[tag] = tf.summary.create_noop_writer()
         if default:
             self.default_writer = tag
         return self.writers[tag]
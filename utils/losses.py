@@ -1,5 +1,8 @@
 import tensorflow as tf
 
+# The keras losses do not reduce: keras rejects averaging over the (per-replica) batch within a distribution
+# strategy. The mean over all elements is the keras default reduction (SUM_OVER_BATCH_SIZE) outside of one.
+
 
 def new_scaled_crossentropy(index=2, scaling=1.0):
     """
@@ -8,44 +11,44 @@ def new_scaled_crossentropy(index=2, scaling=1.0):
     """
     
     def masked_crossentropy(targets: tf.Tensor, logits: tf.Tensor) -> tf.Tensor:
-        crossentropy = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True)
+        crossentropy = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True, reduction='none')
         padding_mask = tf.math.equal(targets, 0)
         padding_mask = tf.math.logical_not(padding_mask)
         padding_mask = tf.cast(padding_mask, dtype=tf.float32)
         stop_mask = tf.math.equal(targets, index)
         stop_mask = tf.cast(stop_mask, dtype=tf.float32) * (scaling - 1.)
         combined_mask = padding_mask + stop_mask
-        loss = crossentropy(targets, logits, sample_weight=combined_mask)
+        loss = tf.reduce_mean(crossentropy(targets, logits, sample_weight=combined_mask))
         return loss
     
     return masked_crossentropy
 
 
 def masked_crossentropy(targets: tf.Tensor, logits: tf.Tensor) -> tf.Tensor:
-    crossentropy = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True)
+    crossentropy = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True, reduction='none')
     mask = tf.math.logical_not(tf.math.equal(targets, 0))
     mask = tf.cast(mask, dtype=tf.int32)
-    loss = crossentropy(targets, logits, sample_weight=mask)
+    loss = tf.reduce_mean(crossentropy(targets, logits, sample_weight=mask))
     return loss
 
 
 def masked_mean_squared_error(targets: tf.Tensor, logits: tf.Tensor) -> tf.Tensor:
-    mse = tf.keras.losses.MeanSquaredError()
+    mse = tf.keras.losses.MeanSquaredError(reduction='none')
     mask = tf.math.logical_not(tf.math.equal(targets, 0))
     mask = tf.cast(mask, dtype=tf.int32)
     mask = tf.reduce_max(mask, axis=-1)
-    loss = mse(targets, logits, sample_weight=mask)
+    loss = tf.reduce_mean(mse(targets, logits, sample_weight=mask))
     return loss
 
 
 def masked_mean_absolute_error(targets: tf.Tensor, logits: tf.Tensor, mask_value=0,
                                mask: tf.Tensor = None) -> tf.Tensor:
-    mae = tf.keras.losses.MeanAbsoluteError()
+    mae = tf.keras.losses.MeanAbsoluteError(reduction='none')
     if mask is not None:
         mask = tf.math.logical_not(tf.math.equal(targets, mask_value))
         mask = tf.cast(mask, dtype=tf.int32)
         mask = tf.reduce_max(mask, axis=-1)
-    loss = mae(targets, logits, sample_weight=mask)
+    loss = tf.reduce_mean(mae(targets, logits, sample_weight=mask))
     return loss
 
 
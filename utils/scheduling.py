@@ -29,19 +29,42 @@ def piecewise_linear(step, X, Y):
 
 
 def piecewise_linear_schedule(step, schedule):
-    schedule = np.array(schedule)
-    x_schedule = schedule[:, 0]
-    y_schedule = schedule[:, 1]
-    value = piecewise_linear(step, x_schedule, y_schedule)
-    return tf.cast(value, tf.float32)
+    return tf.cast(PiecewiseLinearSchedule(schedule)(step), tf.float32)
 
 
 def reduction_schedule(step, schedule):
-    schedule = np.array(schedule)
-    r = schedule[0, 0]
-    for i in range(schedule.shape[0]):
-        if schedule[i, 0] <= step:
-            r = schedule[i, 1]
-        else:
-            break
-    return int(r)
+    return StepSchedule(schedule)(step)
+
+
+class PiecewiseLinearSchedule:
+    """ piecewise_linear_schedule with the breakpoints converted once, to be evaluated at every training step. """
+    
+    def __init__(self, schedule):
+        schedule = np.array(schedule, dtype=np.float64)
+        self.x_schedule = schedule[:, 0]
+        self.y_schedule = schedule[:, 1]
+    
+    def __call__(self, step):
+        if step < self.x_schedule[0]:
+            return np.float32(self.y_schedule[0])
+        idx = np.searchsorted(self.x_schedule, step, side='right') - 1
+        if idx == (len(self.y_schedule) - 1):
+            return np.float32(self.y_schedule[-1])
+        return np.float32(linear_function(step, self.x_schedule[idx], self.x_schedule[idx + 1],
+                                          self.y_schedule[idx], self.y_schedule[idx + 1]))
+
+
+class StepSchedule:
+    """ reduction_schedule with the breakpoints converted once: the value of the last breakpoint reached. """
+    
+    def __init__(self, schedule):
+        schedule = np.array(schedule)
+        self.x_schedule = schedule[:, 0]
+        self.y_schedule = schedule[:, 1].astype(np.int64)
+    
+    def __call__(self, step):
+        idx = np.searchsorted(self.x_schedule, step, side='right') - 1
+        if idx < 0:
+            # before the first breakpoint (as reduction_schedule, which returns its step)
+            return int(self.x_schedule[0])
+        return int(self.y_schedule[idx])
@@ -3,6 +3,8 @@ import argparse
 
 import tensorflow as tf
 
+from utils.distribution import STRATEGIES
+
 
 def dynamic_memory_allocation():
     gpus = tf.config.experimental.list_physical_devices('GPU')
@@ -11,8 +13,8 @@ def dynamic_memory_allocation():
             # Currently, memory growth needs to be the same across GPUs
             for gpu in gpus:
                 tf.config.experimental.set_memory_growth(gpu, True)
-            logical_gpus = tf.config.experimental.list_logical_devices('GPU')
-            print(len(gpus), 'Physical GPUs,', len(logical_gpus), 'Logical GPUs')
+            # listing the logical devices would initialize the runtime before a distribution strategy
+            print(len(gpus), 'Physical GPUs')
         except Exception:
             traceback.print_exc()
 
@@ -26,4 +28,6 @@ def basic_train_parser():
                         help="deletes logs under this config's folder.")
     parser.add_argument('--reset_weights', dest='clear_weights', action='store_true',
                         help="deletes weights under this config's folder.")
+    parser.add_argument('--strategy', dest='strategy', type=str, default='default', choices=STRATEGIES,
+                        help="'mirrored' trains on all local devices, 'multi_worker' on the workers in TF_CONFIG.")
     return parser
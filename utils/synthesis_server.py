@@ -0,0 +1,165 @@
+import io
+import json
+import time
+import wave
+import asyncio
+from collections import Counter
+
+import numpy as np
+
+
+class BatchingSynthesizer:
+    """ Collects concurrent synthesis requests into batches for the ForwardTransformer.
+    
+    A batch is closed once it holds max_batch_size requests or max_wait seconds after its first request,
+    then it is encoded with a single pipeline call and run through forward (in a worker thread, so that the
+    event loop keeps accepting requests). Requests with different speeds are run as separate forward calls.
+    """
+    
+    def __init__(self, model, max_batch_size: int = 16, max_wait: float = 0.01):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = None
+        self.batch_sizes = Counter()
+        self.n_requests = 0
+    
+    async def synthesize(self, text: str = None, tokens: list = None, speed: float = 1.):
+        """ Queues a request, given either as text or as encoded phoneme tokens, and awaits its mel. """
+        assert (text is None) != (tokens is None), 'Pass either text or tokens.'
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((text, tokens, float(speed), future))
+        return await future
+    
+    def start(self) -> asyncio.Future:
+        """ Creates the request queue and starts the batching task in the running event loop. """
+        self.queue = asyncio.Queue()
+        return asyncio.ensure_future(self.run())
+    
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self.batch_sizes[len(batch)] += 1
+            self.n_requests += len(batch)
+            try:
+                mels = await loop.run_in_executor(None, self._predict, batch)
+                for request, mel in zip(batch, mels):
+                    # the future of a client that went away is already cancelled
+                    if not request[-1].done():
+                        request[-1].set_result(mel)
+            except Exception as e:
+                for request in batch:
+                    if not request[-1].done():
+                        request[-1].set_exception(e)
+    
+    def _predict(self, batch):
+        texts = [text for text, tokens, speed, future in batch if text is not None]
+        encoded = iter(self.model.encode_text(texts) if len(texts) > 0 else [])
+        sequences = [tokens if tokens is not None else next(encoded) for text, tokens, speed, future in batch]
+        mels = [None] * len(batch)
+        for speed in set(request[2] for request in batch):
+            indices = [i for i, request in enumerate(batch) if request[2] == speed]
+            speed_mels = self.model.predict_batch([sequences[i] for i in indices], batch_size=len(indices),
+                                                  speed_regulator=speed, encode=False)
+            for i, mel in zip(indices, speed_mels):
+                mels[i] = mel.numpy()
+        return mels
+    
+    def metrics(self):
+        n_batches = sum(self.batch_sizes.values())
+        return {'queue_depth': self.queue.qsize() if self.queue is not None else 0,
+                'requests': self.n_requests,
+                'batches': n_batches,
+                'mean_batch_size': self.n_requests / n_batches if n_batches > 0 else 0.,
+                'batch_sizes': {str(size): count for size, count in sorted(self.batch_sizes.items())}}
+
+
+class SynthesisServer:
+    """ Minimal local HTTP server in front of a BatchingSynthesizer.
+    
+    POST /synthesize with a JSON body {"text": ..., "speed": 1., "format": "mel"} returns the mel as JSON list;
+    instead of "text", "tokens" can hold already encoded phonemes. With "format": "wav" it returns a Griffin-Lim
+    wav, which requires audio (utils.audio.Audio). GET /metrics returns queue depth and batch size statistics.
+    """
+    
+    def __init__(self, synthesizer: BatchingSynthesizer, audio=None, host: str = '127.0.0.1', port: int = 5000):
+        self.synthesizer = synthesizer
+        self.audio = audio
+        self.host = host
+        self.port = port
+        self.server = None
+        self.batching_task = None
+    
+    async def start(self):
+        self.batching_task = self.synthesizer.start()
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+    
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        if self.batching_task is not None:
+            self.batching_task.cancel()
+            self.batching_task = None
+    
+    async def serve_forever(self):
+        await self.start()
+        print(f'Serving on http://{self.host}:{self.port}')
+        await self.server.serve_forever()
+    
+    async def _handle(self, reader, writer):
+        try:
+            method, path, _ = (await reader.readline()).decode().split(' ', 2)
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode().strip()
+                if line == '':
+                    break
+                key, value = line.split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            status, content_type, content = await self._route(method, path, body)
+        except Exception as e:
+            status, content_type, content = '500 Internal Server Error', 'application/json', \
+                                            json.dumps({'error': str(e)}).encode()
+        writer.write(f'HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n'
+                     f'Content-Length: {len(content)}\r\nConnection: close\r\n\r\n'.encode() + content)
+        await writer.drain()
+        writer.close()
+    
+    async def _route(self, method, path, body):
+        if (method == 'GET') and (path == '/metrics'):
+            return '200 OK', 'application/json', json.dumps(self.synthesizer.metrics()).encode()
+        if (method == 'POST') and (path == '/synthesize'):
+            request = json.loads(body)
+            start = time.time()
+            mel = await self.synthesizer.synthesize(text=request.get('text'), tokens=request.get('tokens'),
+                                                    speed=request.get('speed', 1.))
+            if request.get('format', 'mel') == 'wav':
+                wav = await asyncio.get_running_loop().run_in_executor(None, self._to_wav, mel)
+                return '200 OK', 'audio/wav', wav
+            response = {'mel': mel.tolist(), 'latency': time.time() - start}
+            return '200 OK', 'application/json', json.dumps(response).encode()
+        return '404 Not Found', 'application/json', json.dumps({'error': f'{method} {path} not found'}).encode()
+    
+    def _to_wav(self, mel):
+        wav = self.audio.reconstruct_waveform(mel.T)
+        buffer = io.BytesIO()
+        with wave.open(buffer, 'wb') as wav_file:
+            wav_file.setnchannels(1)
+            wav_file.setsampwidth(2)
+            wav_file.setframerate(self.audio.config['sampling_rate'])
+            wav_file.writeframes((np.clip(wav, -1., 1.) * 32767).astype(np.int16).tobytes())
+        return buffer.getvalue()
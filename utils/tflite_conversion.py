@@ -0,0 +1,67 @@
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+
+from model.models import ForwardTransformer
+from utils.export import export_saved_model
+
+
+def convert_forward_model(model: ForwardTransformer, quantization: str = None) -> bytes:
+    """ Converts the forward signature of the ForwardTransformer to a TFLite flatbuffer.
+    
+    :param quantization: None for float32, 'int8' for dynamic range int8 weights or 'float16' for float16 weights.
+    """
+    assert quantization in [None, 'int8', 'float16'], f'Unknown quantization {quantization}.'
+    with tempfile.TemporaryDirectory() as saved_model_dir:
+        export_saved_model(model, saved_model_dir)
+        converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_dir, signature_keys=['forward'])
+        # the padding of the expanded sequences (RaggedTensorToTensor) has no builtin TFLite op
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+        if quantization is not None:
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if quantization == 'float16':
+            converter.target_spec.supported_types = [tf.float16]
+        return converter.convert()
+
+
+class TFLiteForwardTransformer:
+    """ Runs a converted ForwardTransformer with the TFLite interpreter, mirroring ForwardTransformer.predict. """
+    
+    def __init__(self, model_content: bytes = None, model_path: str = None, text_pipeline=None, num_threads=None):
+        self.interpreter = tf.lite.Interpreter(model_content=model_content, model_path=model_path,
+                                               num_threads=num_threads)
+        self.runner = self.interpreter.get_signature_runner('forward')
+        self.text_pipeline = text_pipeline
+    
+    def encode_text(self, text):
+        return self.text_pipeline(text)
+    
+    def forward(self, input_sequence, durations_scalar):
+        return self.runner(input_sequence=np.array(input_sequence, dtype=np.int32),
+                           durations_scalar=np.array(durations_scalar, dtype=np.float32))
+    
+    def predict(self, inp, encode=True, speed_regulator=1.):
+        if encode:
+            inp = self.encode_text(inp)
+            inp = np.expand_dims(inp, 0)
+        out = self.forward(inp, durations_scalar=1. / speed_regulator)
+        out['mel'] = np.squeeze(out['mel'])
+        return out
+
+
+def mel_error(model: ForwardTransformer, tflite_model: TFLiteForwardTransformer, phonemes):
+    """ Mean absolute mel and duration errors of the TFLite model against the float model on a batch.
+    
+    The mels are compared over the frames of the float model that both models predict, since the rounded
+    durations (and therefore the mel lengths) can differ after quantization.
+    """
+    out = model.forward(phonemes, durations_scalar=tf.constant(1.))
+    tflite_out = tflite_model.forward(phonemes, durations_scalar=1.)
+    frames = min(out['mel'].shape[1], tflite_out['mel'].shape[1])
+    mel_mask = 1. - out['expanded_mask'][:, 0, 0, :frames, tf.newaxis].numpy()
+    mel_errors = np.abs(out['mel'][:, :frames].numpy() - tflite_out['mel'][:, :frames]) * mel_mask
+    phoneme_mask = (phonemes != 0)[..., np.newaxis]
+    duration_errors = np.abs(out['duration'].numpy() - tflite_out['duration']) * phoneme_mask
+    return {'mel': float(mel_errors.sum() / (mel_mask.sum() * mel_errors.shape[-1])),
+            'duration': float(duration_errors.sum() / phoneme_mask.sum())}
@@ -0,0 +1,53 @@
+import tensorflow as tf
+
+from model.models import ForwardTransformer
+from utils.distribution import DistributedSteps
+
+
+def _step_inputs(model, batch):
+    if isinstance(model, ForwardTransformer):
+        mel, phonemes, durations, _ = batch
+        return {'input_sequence': phonemes, 'target_sequence': mel, 'target_durations': durations}
+    mel, phonemes, stop, _ = batch
+    return {'inp': phonemes, 'tar': mel, 'stop_prob': stop}
+
+
+def warm_up(model, train_dataset, valid_dataset=None, distributed_steps: DistributedSteps = None):
+    """ Compiles train_step (accumulate_step and val_step) for every bucket of datasets with static bucket shapes,
+    so that XLA does not compile during training.
+    
+    The steps run on batches of padding only. Their (masked) losses have zero gradients, but the optimizer
+    would still count the steps and apply its momentum, so the weights and optimizer state are restored
+    (and the accumulated gradients reset).
+    Only the traces of the current reduction factor of the autoregressive model are compiled.
+    With distributed_steps, the train steps run on every replica (see utils.distribution).
+    
+    :return: number of compiled step shapes.
+    """
+    if distributed_steps is None:
+        distributed_steps = DistributedSteps(tf.distribute.get_strategy())
+    train_batches = train_dataset.padding_batches()
+    # creates the layer variables and optimizer slots (restoring pending checkpoint values) before saving them
+    with distributed_steps.strategy.scope():
+        model._val_step(**_step_inputs(model, train_batches[0]))
+        model.optimizer.build(model.trainable_variables)
+    variables = model.variables + model.optimizer.variables
+    values = [v.numpy() for v in variables]
+    n_shapes = 0
+    try:
+        for batch in train_batches:
+            distributed_steps(model.train_step, **distributed_steps.replicate(_step_inputs(model, batch)))
+            n_shapes += 1
+            if model.gradient_accumulation:
+                distributed_steps(model.accumulate_step, **distributed_steps.replicate(_step_inputs(model, batch)))
+                n_shapes += 1
+        if valid_dataset is not None:
+            for batch in valid_dataset.padding_batches():
+                model.val_step(**_step_inputs(model, batch))
+                n_shapes += 1
+    finally:
+        for variable, value in zip(variables, values):
+            variable.assign(value)
+        if model.gradient_accumulation:
+            model.gradient_accumulator.reset()
+    return n_shapes